@@ -1,25 +1,62 @@
-from flask import Flask, request, jsonify
-from pymongo import MongoClient
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from googleapiclient.http import MediaIoBaseUpload
+from flask import Flask, Request, request, jsonify, g
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import ConnectionFailure, DuplicateKeyError
+from pymongo import monitoring, timeout as plazo_mongo
+import base64
 import io
 import json
 import os
 import pytz
-from datetime import datetime
-from google.oauth2 import service_account
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from flask_cors import CORS
-import replicate 
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.datastructures import FileStorage
+import gridfs
+import uuid
 from io import BytesIO
+from preclasificador import preclasificar, prerreducir_imagen, reducir_imagen
+from prometheus_client import CONTENT_TYPE_LATEST
+from metricas import registro_metricas, iniciar_peticion, terminar_peticion, registrar_etapa, medir_etapa, en_contexto, log_estructurado
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import queue
+import threading
+import time
+import hashlib
+import multiprocessing
+import random
+import re
+import tempfile
 
 # Carga las variables de entorno desde el archivo .env
 load_dotenv()
 
+# Tamaño hasta el que un archivo subido se guarda en memoria; por encima se pasa a disco
+SPOOL_MAX_MEMORIA = int(os.getenv("SPOOL_MAX_MEMORIA", str(8 * 1024 * 1024)))
+
+# Tamaño máximo de una petición (Flask responde 413 si se supera)
+SUBIDA_MAX_BYTES = int(os.getenv("SUBIDA_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+
+# Tamaño de cada trozo de las subidas reanudables a Drive (múltiplo de 256 KB)
+SUBIDA_CHUNK_BYTES = int(os.getenv("SUBIDA_CHUNK_BYTES", str(8 * 1024 * 1024)))
+
+
+class RequestSpooled(Request):
+    """
+    Petición de Flask que guarda cada archivo recibido en un único buffer temporal:
+    en memoria hasta SPOOL_MAX_MEMORIA y en disco a partir de ahí.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORIA, mode="w+b")
+
+
 # Crea una instancia de la aplicación Flask
 app = Flask(__name__)
+app.request_class = RequestSpooled
+app.config["MAX_CONTENT_LENGTH"] = SUBIDA_MAX_BYTES
 
 # Variable global para almacenar la conexión a la base de datos MongoDB
 db = None
@@ -37,86 +74,939 @@ servicio = None
 prompt =  "Analyze the provided image for significant damage. Return ONLY a 0 or a 1. NOT include any other text or explanations. Classification Criteria:*   Black and White Images: Exercise extra caution when evaluating damage.*   Buildings: If the image depicts buildings with extensive structural damage (perimeter or local gaps significantly impacting the structure), return 1.*   Emphasis the Analyze the image to find people: Do NOT get confused, they must be images of people in different places. Damage Assessment (Prioritized by Impact): 1.  Face (if present): Damage affecting the face has the highest priority. Return 1 if:    *   Damage significantly distorts facial features (e.g., missing eye, distorted nose/mouth).    *   Large obscuring gaps or extreme discoloration hinder face identification.2.  Image Composition (Perimeter Gaps): Evaluate loss of information at the image edges. Return 1 if perimeter gaps severely compromise the image composition.  3.Local Gaps: Evaluate loss of information within the image. Return 1 if multiple large local gaps obscure significant details, especially facial features.  4.Smudges: Unwanted marks that appear on the surface of the image, Return 1. Return 0 if the damage is minor and does NOT significantly affect the face (if present) or the overall composition. Examples of Minor Damage (Return 0):*   Scratches (especially on edges)*   Small Scattered stains NOT affecting the FACE*   Slight discoloration*   Minor wrinkles*   Missing corner NOT affecting the FACE. Examples: Eye erased by a gap: 1.Large stain covering PART of the FACE: 1. Slight discoloration and small wrinkle: 0.More Discoloration and more wrinkles(barely distinguishable image): 1.  IMPORTANT REMEMBER: Return ONLY a 0 or a 1. NOT include any other text or explanations."
 
 
+class LectorCompartido(io.RawIOBase):
+    """
+    Lector independiente sobre el buffer de un archivo subido. Cada lector tiene su propia
+    posición y lee con el buffer bloqueado, de modo que la clasificación y la subida a Drive
+    pueden leer el mismo archivo (incluso a la vez) sin copiarlo en memoria.
+    """
+    def __init__(self, flujo, lock, nombre=None):
+        self.flujo = flujo
+        self.lock = lock
+        self.posicion = 0
+        self.name = nombre or "archivo"
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        with self.lock:
+            self.flujo.seek(self.posicion)
+            datos = self.flujo.read(len(buffer))
+        buffer[:len(datos)] = datos
+        self.posicion += len(datos)
+        return len(datos)
+
+    def seek(self, desplazamiento, origen=io.SEEK_SET):
+        if origen == io.SEEK_SET:
+            self.posicion = desplazamiento
+        elif origen == io.SEEK_CUR:
+            self.posicion += desplazamiento
+        else:
+            self.posicion = self.tamano() + desplazamiento
+        return self.posicion
+
+    def tell(self):
+        return self.posicion
+
+    def tamano(self):
+        with self.lock:
+            return self.flujo.seek(0, io.SEEK_END)
+
+
+# Protege la creación del lock de lectura de cada archivo
+lock_lectores = threading.Lock()
+
+
+def abrir_lector(archivo):
+    """
+    Devuelve un nuevo LectorCompartido sobre el buffer de un archivo recibido en la solicitud.
+    """
+    with lock_lectores:
+        if not hasattr(archivo, "lock_lectura"):
+            archivo.lock_lectura = threading.Lock()
+    return LectorCompartido(archivo.stream, archivo.lock_lectura, archivo.filename)
+
+
+def leer_booleano(valor):
+    """
+    Convierte un parámetro de la petición ("1", "true", "si"...) en booleano.
+    """
+    return str(valor).lower() in ("1", "true", "si", "sí")
+
+
+# Credenciales de la cuenta de servicio, compartidas por todos los clientes de Drive
+credenciales_drive = None
+
+
+# Documento de descubrimiento de Drive v3 incluido en google-api-python-client, leído una sola vez
+documento_drive = None
+
+lock_drive = threading.Lock()
+
+
+def obtener_credenciales_drive():
+    """
+    Devuelve las credenciales de la cuenta de servicio, creándolas la primera vez.
+    """
+    global credenciales_drive
+    with lock_drive:
+        if credenciales_drive is None:
+            # Importación diferida: el stack de Google tarda en cargarse y no hace falta para arrancar
+            from google.oauth2 import service_account
+
+            SCOPES = ['https://www.googleapis.com/auth/drive']
+            credenciales_dict = json.loads(credenciales_json)
+            credenciales_drive = service_account.Credentials.from_service_account_info(
+                credenciales_dict, scopes=SCOPES
+            )
+        return credenciales_drive
+
+
+def obtener_documento_drive():
+    """
+    Devuelve el documento de descubrimiento de Drive v3 que viene con la librería, ya parseado,
+    para crear servicios sin descargarlo ni volver a leerlo.
+    """
+    global documento_drive
+    with lock_drive:
+        if documento_drive is None:
+            from googleapiclient.discovery_cache import get_static_doc
+
+            documento_drive = json.loads(get_static_doc("drive", "v3"))
+        return documento_drive
+
+
+def crear_http_drive():
+    """
+    Crea un objeto httplib2.Http autorizado con las credenciales compartidas.
+    """
+    from google_auth_httplib2 import AuthorizedHttp
+    import httplib2
+
+    return AuthorizedHttp(obtener_credenciales_drive(), http=httplib2.Http())
+
+
 def autenticar_drive():
     """
     Autentica en la API de Google Drive utilizando las credenciales proporcionadas
     y devuelve un objeto de servicio para interactuar con la API.
-    """
-    SCOPES = ['https://www.googleapis.com/auth/drive']
 
+    El servicio solo se usa para construir peticiones; se ejecutan con los objetos HTTP
+    de `pool_drive`, que comparten las credenciales (el token se renueva una sola vez).
+    """
+    from googleapiclient.discovery import build_from_document
 
-    credenciales_dict = json.loads(credenciales_json)
-    credenciales = service_account.Credentials.from_service_account_info(
-        credenciales_dict, scopes=SCOPES
-    )
-    servicio = build('drive', 'v3', credentials=credenciales)
+    servicio = build_from_document(obtener_documento_drive(), http=crear_http_drive())
     return servicio
 
 
+# Número máximo de objetos HTTP de Drive en el pool (llamadas simultáneas). Por defecto el doble
+# de hilos de gunicorn, porque una petición puede tener varias subidas en paralelo
+DRIVE_POOL_TAMANO = int(os.getenv("DRIVE_POOL_TAMANO", str(2 * int(os.getenv("GUNICORN_HILOS", "16")))))
+
+# Segundos máximos esperando un objeto HTTP libre del pool
+DRIVE_POOL_ESPERA_SEGUNDOS = float(os.getenv("DRIVE_POOL_ESPERA_SEGUNDOS", "30"))
+
+
+class PoolDrive:
+    """
+    Pool de objetos HTTP autorizados de Drive (httplib2.Http), que mantienen abiertas sus
+    conexiones keep-alive entre llamadas. httplib2 no es thread-safe, así que cada llamada a Drive
+    toma uno prestado, lo usa en exclusiva mientras dura y lo devuelve (ver `ejecutar_drive`).
+    Se crean bajo demanda hasta `tamano`; después, quien pide uno espera a que se devuelva alguno.
+    """
+
+    def __init__(self, tamano, espera_segundos):
+        self.tamano = max(1, tamano)
+        self.espera_segundos = espera_segundos
+        self.libres = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.creados = 0
+        self.en_uso = 0
+        self.uso_maximo = 0
+        self.prestamos = 0
+        self.esperas = 0
+        self.tiempo_espera_total = 0.0
+        self.tiempo_espera_maximo = 0.0
+        self.agotados = 0
+
+    def intentar_tomar(self):
+        """
+        Toma un objeto HTTP libre, o crea uno nuevo si aún no se ha llegado a `tamano`, sin esperar.
+
+        Returns:
+            El objeto HTTP, o None si están todos prestados.
+        """
+        try:
+            http = self.libres.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                crear = self.creados < self.tamano
+                if crear:
+                    self.creados += 1
+            if not crear:
+                return None
+            registro_metricas.pool_drive_creados.inc()
+            try:
+                http = crear_http_drive()
+            except Exception:
+                with self.lock:
+                    self.creados -= 1
+                registro_metricas.pool_drive_creados.dec()
+                raise
+        self._registrar_prestamo()
+        return http
+
+    def tomar(self):
+        """
+        Toma un objeto HTTP libre, o crea uno nuevo si aún no se ha llegado a `tamano`.
+        Si están todos prestados, espera a que se devuelva alguno.
+
+        Raises:
+            TimeoutError: Si no queda ningún objeto HTTP libre en `espera_segundos`.
+        """
+        http = self.intentar_tomar()
+        if http is not None:
+            return http
+
+        inicio = time.monotonic()
+        try:
+            http = self.libres.get(timeout=self.espera_segundos)
+        except queue.Empty:
+            with self.lock:
+                self.agotados += 1
+            raise TimeoutError(f"No hay objetos HTTP de Drive libres tras {self.espera_segundos} s")
+        espera = time.monotonic() - inicio
+        with self.lock:
+            self.esperas += 1
+            self.tiempo_espera_total += espera
+            self.tiempo_espera_maximo = max(self.tiempo_espera_maximo, espera)
+        registro_metricas.pool_drive_esperas.inc()
+        self._registrar_prestamo()
+        return http
+
+    def _registrar_prestamo(self):
+        with self.lock:
+            self.prestamos += 1
+            self.en_uso += 1
+            self.uso_maximo = max(self.uso_maximo, self.en_uso)
+        registro_metricas.pool_drive_en_uso.inc()
+
+    def devolver(self, http):
+        """
+        Devuelve al pool un objeto HTTP prestado.
+        """
+        with self.lock:
+            self.en_uso -= 1
+        registro_metricas.pool_drive_en_uso.dec()
+        self.libres.put(http)
+
+    @contextmanager
+    def prestar(self):
+        """
+        Presta un objeto HTTP durante un bloque `with` y lo devuelve al salir.
+        """
+        http = self.tomar()
+        try:
+            yield http
+        finally:
+            self.devolver(http)
+
+    def estadisticas(self):
+        """
+        Devuelve las métricas de uso del pool.
+        """
+        with self.lock:
+            return {
+                "tamano": self.tamano,
+                "creados": self.creados,
+                "en_uso": self.en_uso,
+                "uso_maximo": self.uso_maximo,
+                "utilizacion": self.en_uso / self.tamano,
+                "prestamos": self.prestamos,
+                "esperas": self.esperas,
+                "espera_media_segundos": self.tiempo_espera_total / self.esperas if self.esperas else 0.0,
+                "espera_maxima_segundos": self.tiempo_espera_maximo,
+                "agotados": self.agotados,
+            }
+
+
+pool_drive = PoolDrive(DRIVE_POOL_TAMANO, DRIVE_POOL_ESPERA_SEGUNDOS)
+
+
+@contextmanager
+def http_drive(http=None):
+    """
+    Presta un objeto HTTP de `pool_drive` durante un bloque `with`, salvo que ya se indique uno.
+    """
+    if http is not None:
+        yield http
+        return
+    with pool_drive.prestar() as http_prestado:
+        yield http_prestado
+
+
+# Llamadas por segundo a Drive al arrancar (0 = sin límite hasta el primer error de cuota;
+# a partir de ahí la tasa se adapta a los errores de cuota)
+DRIVE_TASA_INICIAL = float(os.getenv("DRIVE_TASA_INICIAL", "0"))
+
+# Llamadas por segundo mínima y máxima una vez limitada. La cuota por usuario de Drive es
+# de 12.000 consultas por minuto (200 por segundo)
+DRIVE_TASA_MINIMA = float(os.getenv("DRIVE_TASA_MINIMA", "1"))
+DRIVE_TASA_MAXIMA = float(os.getenv("DRIVE_TASA_MAXIMA", "200"))
+
+# Llamadas que se pueden hacer de golpe por encima de la tasa (capacidad del token bucket):
+# por defecto, un batch completo
+DRIVE_RAFAGA = float(os.getenv("DRIVE_RAFAGA", "100"))
+
+# Llamadas por segundo que se recuperan por cada llamada correcta tras una reducción de la tasa
+DRIVE_TASA_INCREMENTO = float(os.getenv("DRIVE_TASA_INCREMENTO", "0.05"))
+
+# Cuota que consume cada petición dentro de un batch: Drive cuenta cada una como una petición
+DRIVE_COSTE_SUBPETICION = float(os.getenv("DRIVE_COSTE_SUBPETICION", "1"))
+
+# Reintentos ante errores de cuota (403 rateLimitExceeded, 429) o del servidor (5xx) y espera máxima entre ellos
+DRIVE_MAX_REINTENTOS = int(os.getenv("DRIVE_MAX_REINTENTOS", "6"))
+DRIVE_ESPERA_MAXIMA_SEGUNDOS = float(os.getenv("DRIVE_ESPERA_MAXIMA_SEGUNDOS", "32"))
+
+# Motivos de los errores 403 que indican cuota superada
+MOTIVOS_LIMITE_DRIVE = ("userRateLimitExceeded", "rateLimitExceeded")
+
+
+class LimitadorDrive:
+    """
+    Token bucket compartido por todas las llamadas a Drive, con tasa adaptativa: cada error
+    de cuota reduce la tasa a la mitad (como mucho una vez por segundo) y cada llamada correcta
+    la vuelve a subir poco a poco, de modo que se trabaja cerca del máximo que permite la cuota.
+
+    Con `tasa` 0 las llamadas no se limitan hasta el primer error de cuota; entonces la tasa
+    pasa a ser la mitad de la medida en el último segundo y a partir de ahí se adapta igual.
+    """
+
+    def __init__(self, tasa, rafaga, tasa_minima, tasa_maxima, incremento):
+        self.tasa = tasa or None
+        self.rafaga = rafaga
+        self.tasa_minima = tasa_minima
+        self.tasa_maxima = tasa_maxima
+        self.incremento = incremento
+        self.tokens = rafaga
+        self.ultima_recarga = time.monotonic()
+        self.ultima_reduccion = 0.0
+        self.recientes = deque()
+        self.lock = threading.Lock()
+        self.llamadas = 0
+        self.reintentos = 0
+        self.limitadas = 0
+        self.errores = 0
+        self.tiempo_espera_total = 0.0
+
+    def adquirir(self, cantidad=1):
+        """
+        Reserva `cantidad` llamadas y espera hasta que haya tokens para ellas. Las reservas
+        se atienden en orden: quien llega después espera también a que se repongan los anteriores.
+        """
+        with self.lock:
+            ahora = time.monotonic()
+            self.llamadas += cantidad
+            if self.tasa is None:
+                # Sin límite: solo se anotan las llamadas para medir la tasa alcanzada
+                self.recientes.append((ahora, cantidad))
+                while self.recientes[0][0] < ahora - 1.0:
+                    self.recientes.popleft()
+                return
+            self.tokens = min(self.rafaga, self.tokens + (ahora - self.ultima_recarga) * self.tasa)
+            self.ultima_recarga = ahora
+            self.tokens -= cantidad
+            espera = max(0.0, -self.tokens / self.tasa)
+            self.tiempo_espera_total += espera
+        if espera > 0:
+            time.sleep(espera)
+
+    def registrar_exito(self, cantidad=1):
+        with self.lock:
+            if self.tasa is not None:
+                self.tasa = min(self.tasa_maxima, self.tasa + self.incremento * cantidad)
+                registro_metricas.drive_tasa.set(self.tasa)
+
+    def registrar_limite(self):
+        registro_metricas.drive_limitadas.inc()
+        with self.lock:
+            self.limitadas += 1
+            ahora = time.monotonic()
+            if self.tasa is None:
+                medida = sum(cantidad for instante, cantidad in self.recientes if instante >= ahora - 1.0)
+                self.tasa = max(self.tasa_minima, min(self.tasa_maxima, medida) / 2)
+                self.tokens = 0.0
+                self.ultima_recarga = ahora
+                self.ultima_reduccion = ahora
+                self.recientes.clear()
+                print(f"Cuota de Drive superada a {medida} llamadas/s: tasa limitada a {self.tasa:.1f} llamadas/s")
+            elif ahora - self.ultima_reduccion >= 1.0:
+                self.tasa = max(self.tasa_minima, self.tasa / 2)
+                self.ultima_reduccion = ahora
+                print(f"Cuota de Drive superada: tasa reducida a {self.tasa:.1f} llamadas/s")
+            registro_metricas.drive_tasa.set(self.tasa)
+
+    def registrar_reintento(self):
+        registro_metricas.drive_reintentos.inc()
+        with self.lock:
+            self.reintentos += 1
+
+    def registrar_error(self):
+        with self.lock:
+            self.errores += 1
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                "tasa": self.tasa,
+                "tokens": self.tokens,
+                "llamadas": self.llamadas,
+                "reintentos": self.reintentos,
+                "limitadas": self.limitadas,
+                "errores": self.errores,
+                "espera_total_segundos": self.tiempo_espera_total,
+            }
+
+
+limitador_drive = LimitadorDrive(DRIVE_TASA_INICIAL, DRIVE_RAFAGA, DRIVE_TASA_MINIMA, DRIVE_TASA_MAXIMA, DRIVE_TASA_INCREMENTO)
+
+
+def clasificar_error_drive(error):
+    """
+    Indica si un error de Drive es de cuota ("limite"), transitorio ("transitorio")
+    o definitivo (None, no se reintenta).
+    """
+    from googleapiclient.errors import HttpError
+    import httplib2
+
+    if isinstance(error, HttpError):
+        estado = error.resp.status
+        if estado == 429:
+            return "limite"
+        if estado == 403:
+            try:
+                motivos = [detalle.get("reason") for detalle in json.loads(error.content)["error"]["errors"]]
+            except Exception:
+                motivos = []
+            return "limite" if any(motivo in MOTIVOS_LIMITE_DRIVE for motivo in motivos) else None
+        return "transitorio" if estado >= 500 else None
+    # Errores de red (conexión cortada, timeout)
+    if isinstance(error, (OSError, httplib2.HttpLib2Error)):
+        return "transitorio"
+    return None
+
+
+def reintento_seguro_drive(peticion):
+    """
+    Indica si una petición de Drive puede repetirse tras un error transitorio (5xx o de red),
+    que no garantiza que Drive no la haya aplicado. Un `files.create` sin ID preasignado
+    (ver `generar_ids_drive`) crearía un duplicado; con ID, la repetición falla en vez de duplicar.
+    Las subidas reanudables continúan la misma sesión, así que también son seguras.
+    """
+    if not (getattr(peticion, "methodId", None) or "").endswith("files.create"):
+        return True
+    if getattr(peticion, "resumable", None) is not None:
+        return True
+    try:
+        metadatos = json.loads(getattr(peticion, "body", None) or "{}")
+    except (TypeError, ValueError):
+        return False
+    return bool(metadatos.get("id"))
+
+
+def espera_reintento_drive(intento):
+    """
+    Backoff exponencial con jitter: entre la mitad y el total de 2^intento segundos, con tope.
+    """
+    return min(DRIVE_ESPERA_MAXIMA_SEGUNDOS, 2 ** intento) * random.uniform(0.5, 1.0)
+
+
+def ejecutar_drive(peticion, http=None):
+    """
+    Ejecuta una petición de la API de Drive a través del limitador compartido, reintentando
+    con backoff exponencial los errores de cuota y los transitorios (estos solo si
+    `reintento_seguro_drive`). Las subidas reanudables continúan desde el último fragmento confirmado.
+
+    Cada intento se ejecuta con un objeto HTTP prestado por `pool_drive` (o con `http`, si se
+    indica), que se devuelve al terminar la llamada y no se retiene durante las esperas.
+
+    Raises:
+        Exception: El último error, si no es reintentable o se agotan los reintentos.
+    """
+    etapa = getattr(peticion, "methodId", None) or "drive.peticion"
+    for intento in range(DRIVE_MAX_REINTENTOS + 1):
+        limitador_drive.adquirir()
+        try:
+            with http_drive(http) as http_llamada, medir_etapa(etapa):
+                respuesta = peticion.execute(http=http_llamada)
+            limitador_drive.registrar_exito()
+            return respuesta
+        except Exception as e:
+            tipo = clasificar_error_drive(e)
+            if tipo == "limite":
+                limitador_drive.registrar_limite()
+            if tipo == "transitorio" and not reintento_seguro_drive(peticion):
+                tipo = None
+            if tipo is None or intento == DRIVE_MAX_REINTENTOS:
+                limitador_drive.registrar_error()
+                raise
+            limitador_drive.registrar_reintento()
+            espera = espera_reintento_drive(intento)
+            print(f"Error reintentable de Drive ({e}), reintento {intento + 1} en {espera:.1f} s")
+            time.sleep(espera)
+
+
+def ejecutar_lote_drive(servicio, peticiones, http=None, tamano_lote=None):
+    """
+    Ejecuta varias peticiones de Drive en peticiones batch a través del limitador compartido,
+    cada batch con un objeto HTTP prestado por `pool_drive` (o con `http`, si se indica).
+    Las peticiones que fallan por cuota o por un error transitorio (este solo si
+    `reintento_seguro_drive`) se reintentan en un nuevo batch tras un backoff exponencial.
+
+    Returns:
+        list: Tuplas (respuesta, excepción) por petición, en el mismo orden que `peticiones`.
+    """
+    tamano_lote = tamano_lote or TAMANO_LOTE_DRIVE
+    resultados = [(None, None)] * len(peticiones)
+    pendientes = list(range(len(peticiones)))
+
+    for intento in range(DRIVE_MAX_REINTENTOS + 1):
+        reintentar = []
+        ultimo = intento == DRIVE_MAX_REINTENTOS
+
+        def callback(request_id, respuesta, excepcion):
+            indice = int(request_id)
+            resultados[indice] = (respuesta, excepcion)
+            if excepcion is None:
+                limitador_drive.registrar_exito()
+                return
+            tipo = clasificar_error_drive(excepcion)
+            if tipo == "limite":
+                limitador_drive.registrar_limite()
+            if tipo == "transitorio" and not reintento_seguro_drive(peticiones[indice]):
+                tipo = None
+            if tipo is not None and not ultimo:
+                reintentar.append(indice)
+            else:
+                limitador_drive.registrar_error()
+
+        for inicio in range(0, len(pendientes), tamano_lote):
+            bloque = pendientes[inicio:inicio + tamano_lote]
+            lote = servicio.new_batch_http_request(callback=callback)
+            for indice in bloque:
+                lote.add(peticiones[indice], request_id=str(indice))
+            # Un batch consume la petición HTTP y la cuota de cada una de sus peticiones
+            limitador_drive.adquirir(1 + len(bloque) * DRIVE_COSTE_SUBPETICION)
+            try:
+                with http_drive(http) as http_lote, medir_etapa("drive.batch"):
+                    lote.execute(http=http_lote)
+            except Exception as e:
+                # Falla el batch entero: se reintentan todas sus peticiones si el error lo permite
+                tipo = clasificar_error_drive(e)
+                if tipo == "limite":
+                    limitador_drive.registrar_limite()
+                for indice in bloque:
+                    resultados[indice] = (None, e)
+                    if tipo is None or ultimo or (tipo == "transitorio" and not reintento_seguro_drive(peticiones[indice])):
+                        limitador_drive.registrar_error()
+                    else:
+                        reintentar.append(indice)
+
+        if not reintentar:
+            break
+        pendientes = sorted(set(reintentar))
+        for _ in pendientes:
+            limitador_drive.registrar_reintento()
+        espera = espera_reintento_drive(intento)
+        print(f"{len(pendientes)} peticiones de Drive del batch se reintentan en {espera:.1f} s")
+        time.sleep(espera)
+
+    return resultados
+
+
+lock_servicio_drive = threading.Lock()
+
+
 def obtener_servicio_drive():
     """
-    Obtiene el servicio de Google Drive autenticado. Si aún no se ha autenticado,
-    llama a la función `autenticar_drive()`.
+    Obtiene el servicio de Google Drive autenticado, compartido por todos los hilos. El servicio
+    solo construye las peticiones: `ejecutar_drive` y `ejecutar_lote_drive` las ejecutan con un
+    objeto HTTP de `pool_drive`, así que no se retiene ninguna conexión fuera de cada llamada.
     """
     global servicio
-    if servicio is None:
-        servicio = autenticar_drive()
-    return servicio
+    with lock_servicio_drive:
+        if servicio is None:
+            servicio = autenticar_drive()
+        return servicio
+
+
+# Días que se conserva una clasificación en la caché de clasificaciones
+CACHE_CLASIFICACION_DIAS = int(os.getenv("CACHE_CLASIFICACION_DIAS", "90"))
+
+# Índices de MongoDB que se aseguran al arrancar, por colección
+INDICES_MONGODB = {
+    "lotes": [
+        IndexModel([("nRegistro", ASCENDING)], unique=True, name="nRegistro_unico"),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+    ],
+    "subcarpetas": [
+        IndexModel([("nRegistro", ASCENDING)], unique=True, name="nRegistro_unico"),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+        IndexModel([("id_subcarpeta", ASCENDING)], name="id_subcarpeta"),
+    ],
+    "subcarpetainternas": [
+        IndexModel([("nRegistro", ASCENDING)], unique=True, name="nRegistro_unico"),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+        IndexModel([("imagenes.classification", ASCENDING)], name="imagenes_classification"),
+        IndexModel([("subcarpetas_internas_id", ASCENDING)], name="subcarpetas_internas_id"),
+    ],
+    "archivos": [
+        IndexModel([("carpeta_id", ASCENDING), ("nombre", ASCENDING), ("_id", ASCENDING)], name="listado_carpeta"),
+    ],
+    "trabajos": [
+        IndexModel([("estado", ASCENDING), ("created_at", ASCENDING)], name="estado_created_at"),
+    ],
+    "clasificaciones_cache": [
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=CACHE_CLASIFICACION_DIAS * 86400),
+    ],
+}
+
+# Consultas de las rutas críticas que nunca deben recorrer la colección entera
+CONSULTAS_CRITICAS = [
+    ("lotes", {"nRegistro": "0000-0000"}),
+    ("subcarpetas", {"nRegistro": "0000-0000-F"}),
+    ("subcarpetainternas", {"nRegistro": "0000-0000-S-A01"}),
+    ("archivos", {"carpeta_id": "0", "eliminado": False, "$or": [{"nombre": {"$gt": ""}}, {"nombre": "", "_id": {"$gt": ""}}]}),
+]
+
+# Comprobar al arrancar que las consultas críticas usan índices
+MONGODB_VERIFICAR_PLANES = leer_booleano(os.getenv("MONGODB_VERIFICAR_PLANES", "true"))
+
+
+def crear_indices(db):
+    """
+    Crea (si no existen) los índices declarados en INDICES_MONGODB.
+    `create_indexes` no hace nada con los índices que ya existen con la misma definición.
+
+    Returns:
+        bool: False si no se pudo contactar con MongoDB, True en otro caso.
+    """
+    for coleccion, indices in INDICES_MONGODB.items():
+        try:
+            nombres = db[coleccion].create_indexes(indices)
+            print(f"Índices asegurados en '{coleccion}': {nombres}")
+        except ConnectionFailure as e:
+            print(f"No se pudo contactar con MongoDB para crear índices: {e}")
+            return False
+        except Exception as e:
+            print(f"Error al crear índices en '{coleccion}': {e}")
+    return True
+
+
+def etapas_plan(plan):
+    """
+    Devuelve todas las etapas ("stage") de un plan de consulta de MongoDB, recorriéndolo entero.
+    """
+    etapas = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            etapas.append(plan["stage"])
+        for valor in plan.values():
+            etapas.extend(etapas_plan(valor))
+    elif isinstance(plan, list):
+        for valor in plan:
+            etapas.extend(etapas_plan(valor))
+    return etapas
+
+
+def verificar_planes_consulta(db):
+    """
+    Comprueba con `explain` que ninguna consulta de CONSULTAS_CRITICAS usa COLLSCAN.
+
+    Raises:
+        RuntimeError: Si alguna consulta crítica recorre la colección completa.
+    """
+    for coleccion, filtro in CONSULTAS_CRITICAS:
+        plan = db[coleccion].find(filtro).explain()
+        if "COLLSCAN" in etapas_plan(plan.get("queryPlanner", {}).get("winningPlan", {})):
+            raise RuntimeError(f"La consulta {filtro} sobre '{coleccion}' usa COLLSCAN: falta un índice")
+    print("Planes de consulta verificados: todas las consultas críticas usan índices.")
+
+
+class MonitorMongo(monitoring.CommandListener):
+    """
+    Registra la duración de cada comando de MongoDB como etapa `mongo.<comando>`.
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        registrar_etapa(f"mongo.{event.command_name}", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        registrar_etapa(f"mongo.{event.command_name}", event.duration_micros / 1e6, error=True)
 
 
 def init_db():
     """
     Inicializa la conexión a la base de datos MongoDB utilizando la URI proporcionada
-    en la variable de entorno.
+    en la variable de entorno, y asegura los índices de las colecciones.
+
+    Raises:
+        RuntimeError: Si MONGODB_VERIFICAR_PLANES está activo y alguna consulta crítica usa COLLSCAN.
     """
     global db
     try:
         churro = os.getenv("MONGODB_URI")
-        client = MongoClient(churro)
+        client = MongoClient(churro, event_listeners=[MonitorMongo()])
         print("Conexión a MongoDB establecida.")
         db = client["ProyectoUPV"]
         print("Base de datos seleccionada:", db.name)
     except Exception as e:
         print(f"Error al conectar a MongoDB: {e}")
         db = None
+        return
+
+    if crear_indices(db) and MONGODB_VERIFICAR_PLANES:
+        verificar_planes_consulta(db)
 
 
-# Crear una carpeta en Google Drive
-def crear_carpeta(servicio, nombre_carpeta, carpeta_padre_id=None):
+# Carpeta de Drive bajo la que se crean todos los lotes
+CARPETA_RAIZ_ID = '1bPAWz9cOhe9_sO-M_jGPaoInEqYTfzCE'
+
+# Número máximo de llamadas por petición batch (límite de la API de Drive: 100)
+TAMANO_LOTE_DRIVE = int(os.getenv("DRIVE_BATCH_SIZE", "100"))
+
+
+# Reservar los IDs de Drive por adelantado para escribir Drive y MongoDB en paralelo
+DRIVE_IDS_PREASIGNADOS = leer_booleano(os.getenv("DRIVE_IDS_PREASIGNADOS", "false"))
+
+
+def crear_carpetas_en_lote(servicio, carpetas, ids=None):
     """
-    Crea una nueva carpeta en Google Drive.
+    Crea varias carpetas en Google Drive agrupando las llamadas en peticiones batch.
 
     Args:
         servicio: Objeto de servicio de Google Drive autenticado.
-        nombre_carpeta: Nombre de la nueva carpeta.
-        carpeta_padre_id: ID de la carpeta padre (opcional).
+        carpetas: Lista de tuplas (nombre_carpeta, carpeta_padre_id).
+        ids: Lista opcional de IDs ya asignados a cada carpeta (None para que Drive lo genere).
 
     Returns:
-        str: ID de la carpeta creada.
+        list: IDs de las carpetas creadas, en el mismo orden que `carpetas`.
 
     Raises:
-        Exception: Si ocurre un error al crear la carpeta.
+        Exception: Si falla la creación de alguna de las carpetas.
     """
-    try:
+    if ids is None:
+        ids = [None] * len(carpetas)
+
+    peticiones = []
+    for (nombre_carpeta, carpeta_padre_id), carpeta_id in zip(carpetas, ids):
         metadatos_carpeta = {
             'name': nombre_carpeta,
             'mimeType': 'application/vnd.google-apps.folder',
         }
         if carpeta_padre_id:
             metadatos_carpeta['parents'] = [carpeta_padre_id]
+        if carpeta_id:
+            metadatos_carpeta['id'] = carpeta_id
+        peticiones.append(servicio.files().create(body=metadatos_carpeta, fields='id'))
+
+    # Una sola carpeta no compensa el sobrecoste de una petición batch
+    if len(peticiones) == 1:
+        return [ejecutar_drive(peticiones[0]).get('id')]
+
+    ids_creados = [None] * len(peticiones)
+    errores = []
+    for indice, (respuesta, excepcion) in enumerate(ejecutar_lote_drive(servicio, peticiones)):
+        if excepcion is not None:
+            errores.append((carpetas[indice][0], excepcion))
+        else:
+            ids_creados[indice] = respuesta.get('id')
 
-        carpeta = servicio.files().create(body=metadatos_carpeta, fields='id').execute()
-        print(f"Carpeta creada: {nombre_carpeta} (ID: {carpeta.get('id')})")
-        return carpeta.get('id')
-    except Exception as e:
-        print(f"Error al crear carpeta en Google Drive: {e}")
-        raise
+    if errores:
+        nombre_carpeta, excepcion = errores[0]
+        print(f"Error al crear {len(errores)} carpeta(s) en Google Drive, primera: {nombre_carpeta}: {excepcion}")
+        raise excepcion
+
+    print(f"{len(ids_creados)} carpetas creadas en lote")
+    return ids_creados
+
+
+def planificar_subcarpetas_internas(n_registro_subcarpeta, tipo_subcarpeta, cantidad_albumes, cantidad_marcos, cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas):
+    """
+    Calcula las subcarpetas internas que corresponden a una subcarpeta principal.
+
+    Args:
+        n_registro_subcarpeta: nRegistro de la subcarpeta principal (p. ej. "XXXX-M").
+        tipo_subcarpeta: Tipo de la subcarpeta principal ("M", "O", "S", "R" o "F").
+        cantidad_*: Número de subcarpetas de cada tipo a crear.
+
+    Returns:
+        list: Tuplas (nRegistro, tipo) en el orden de creación. Vacía para R y F.
+    """
+    if tipo_subcarpeta == "O":
+        grupos = [("A", "A", cantidad_albumes)]
+    elif tipo_subcarpeta in ["M", "S"]:
+        grupos = [
+            ("A", "A", cantidad_albumes),
+            ("MC", "MC", cantidad_marcos),
+            ("NG", "NG", cantidad_negativos),
+            ("P", "P", cantidad_diapositivas),
+            ("Z", "P", cantidad_fotos_sueltas),  # Las fotos sueltas se registran con tipo "P"
+        ]
+    else:
+        return []
+
+    subcarpetas_internas = [
+        (f"{n_registro_subcarpeta}-{prefijo}{i:02d}", tipo)
+        for prefijo, tipo, cantidad in grupos
+        for i in range(1, cantidad + 1)
+    ]
+    # Subcarpetas internas fijas
+    if tipo_subcarpeta == "S":
+        subcarpetas_internas.append((f"{n_registro_subcarpeta}-D", "D"))
+    return subcarpetas_internas
+
+
+def planificar_estructura(nombre_principal, cantidad_albumes, cantidad_marcos, cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas):
+    """
+    Construye el diccionario de la estructura de un lote sin crear nada en Google Drive.
+    Los IDs de las carpetas quedan a None hasta que se crean.
+
+    Returns:
+        dict: Estructura con el mismo formato que devuelve `crear_estructura_completa`.
+    """
+    estructura = {
+        "nRegistro": nombre_principal,
+        "carpeta_principal_id": None,
+        "subcarpetas": []
+    }
+    for tipo_subcarpeta in ["M", "O", "S", "R", "F"]:
+        n_registro_subcarpeta = f"{nombre_principal}-{tipo_subcarpeta}"
+        if tipo_subcarpeta in ["M", "O", "S"]:
+            internas = planificar_subcarpetas_internas(
+                n_registro_subcarpeta, tipo_subcarpeta, cantidad_albumes, cantidad_marcos,
+                cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas
+            )
+            subcarpeta = {
+                "nRegistro": n_registro_subcarpeta,
+                "id_subcarpeta": None,
+                "tipo": tipo_subcarpeta,
+                "subcarpetas_internas": [
+                    {
+                        "nRegistro": n_registro_interna,
+                        "subcarpetas_internas_id": None,
+                        "tipo": tipo_interna,
+                        "imagenes": []
+                    }
+                    for n_registro_interna, tipo_interna in internas
+                ]
+            }
+        else:
+            subcarpeta = {
+                "nRegistro": n_registro_subcarpeta,
+                "id_subcarpeta": None,
+                "tipo": tipo_subcarpeta,
+                "imagenes": []  # Lista vacía para F y R
+            }
+        estructura["subcarpetas"].append(subcarpeta)
+    return estructura
+
+
+def crear_carpetas_de_estructura(servicio, estructura):
+    """
+    Crea en Google Drive las carpetas de una estructura planificada, nivel a nivel:
+    una llamada para la carpeta principal, un batch para las subcarpetas y otro
+    (o varios, según TAMANO_LOTE_DRIVE) para todas las subcarpetas internas.
+
+    Si la estructura ya trae IDs asignados se usan; si no, se rellenan con los de Drive.
+    """
+    # Nivel 0: carpeta principal
+    estructura["carpeta_principal_id"] = crear_carpetas_en_lote(
+        servicio,
+        [(estructura["nRegistro"], CARPETA_RAIZ_ID)],
+        [estructura["carpeta_principal_id"]]
+    )[0]
+    print("Carpeta Main creada")
+
+    # Nivel 1: subcarpetas M, O, S, R, F
+    subcarpetas = estructura["subcarpetas"]
+    ids_subcarpetas = crear_carpetas_en_lote(
+        servicio,
+        [(subcarpeta["nRegistro"], estructura["carpeta_principal_id"]) for subcarpeta in subcarpetas],
+        [subcarpeta["id_subcarpeta"] for subcarpeta in subcarpetas]
+    )
+    for subcarpeta, subcarpeta_id in zip(subcarpetas, ids_subcarpetas):
+        subcarpeta["id_subcarpeta"] = subcarpeta_id
+
+    # Nivel 2: subcarpetas internas de todas las subcarpetas a la vez
+    internas = [
+        (interna, subcarpeta["id_subcarpeta"])
+        for subcarpeta in subcarpetas
+        for interna in subcarpeta.get("subcarpetas_internas", [])
+    ]
+    if internas:
+        ids_internas = crear_carpetas_en_lote(
+            servicio,
+            [(interna["nRegistro"], padre_id) for interna, padre_id in internas],
+            [interna["subcarpetas_internas_id"] for interna, _ in internas]
+        )
+        for (interna, _), interna_id in zip(internas, ids_internas):
+            interna["subcarpetas_internas_id"] = interna_id
+    return estructura
+
+
+def generar_ids_drive(servicio, cantidad):
+    """
+    Reserva IDs de Google Drive con `files.generateIds` para crear archivos o carpetas con ID conocido.
+
+    Args:
+        servicio: Objeto de servicio de Google Drive autenticado.
+        cantidad: Número de IDs a reservar.
+
+    Returns:
+        list: IDs generados por Drive.
+    """
+    ids = []
+    while len(ids) < cantidad:
+        # La API devuelve como máximo 1000 IDs por llamada
+        pendientes = min(cantidad - len(ids), 1000)
+        respuesta = ejecutar_drive(servicio.files().generateIds(count=pendientes, space='drive', type='files'))
+        ids.extend(respuesta.get('ids', []))
+    return ids
+
+
+def asignar_ids_estructura(servicio, estructura):
+    """
+    Rellena todos los IDs de una estructura planificada con IDs reservados en Drive,
+    de forma que pueda guardarse en MongoDB antes de que existan las carpetas.
+    """
+    subcarpetas = estructura["subcarpetas"]
+    internas = [interna for subcarpeta in subcarpetas for interna in subcarpeta.get("subcarpetas_internas", [])]
+    ids = iter(generar_ids_drive(servicio, 1 + len(subcarpetas) + len(internas)))
+
+    estructura["carpeta_principal_id"] = next(ids)
+    for subcarpeta in subcarpetas:
+        subcarpeta["id_subcarpeta"] = next(ids)
+    for interna in internas:
+        interna["subcarpetas_internas_id"] = next(ids)
+    return estructura
 
 
 def crear_estructura_completa(servicio, nombre_principal, cantidad_albumes, cantidad_marcos, cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas):
     """
     Crea una estructura jerárquica de carpetas en Google Drive y registra la información en MongoDB.
 
+    Las carpetas se crean nivel a nivel mediante peticiones batch, por lo que el número de
+    viajes a Drive depende de la profundidad del árbol y no del número de carpetas.
+
     Args:
         servicio: Objeto de servicio de Google Drive autenticado.
         nombre_principal: Nombre de la carpeta principal.
@@ -133,185 +1023,11 @@ def crear_estructura_completa(servicio, nombre_principal, cantidad_albumes, cant
         Exception: Si ocurre un error al crear la estructura.
     """
     try:
-        estructura_creada = {
-            "nRegistro": nombre_principal,
-            "carpeta_principal_id": None,
-            "subcarpetas": []
-        }
-        # Crear carpeta principal
-        carpeta_main_id = crear_carpeta(servicio, nombre_principal, carpeta_padre_id='1bPAWz9cOhe9_sO-M_jGPaoInEqYTfzCE')
-        estructura_creada["carpeta_principal_id"] = carpeta_main_id
-        print("Carpeta Main creada")
-
-        # Crear subcarpetas
-        subcarpetas_main = ["M", "O", "S", "R", "F"]
-        for tipo_subcarpeta in subcarpetas_main:
-            n_registro_subcarpeta = f"{nombre_principal}-{tipo_subcarpeta}"
-            subcarpeta_id = crear_carpeta(servicio, n_registro_subcarpeta, carpeta_main_id)            # Inicializar subcarpetas internas solo para M, S
-            
-            if tipo_subcarpeta in ["M"]:
-                subcarpeta = {
-                    "nRegistro": n_registro_subcarpeta,
-                    "id_subcarpeta": subcarpeta_id,
-                    "tipo": tipo_subcarpeta,
-                    "subcarpetas_internas": []
-                }
-
-                # Subcarpetas dinámicas
-                for i in range(1, cantidad_albumes + 1):
-                    n_registro_album = f"{n_registro_subcarpeta}-A{i:02d}"
-                    album_id = crear_carpeta(servicio, n_registro_album, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_album,
-                        "subcarpetas_internas_id": album_id,
-                        "tipo": "A",
-                        "imagenes": []
-                    })
-
-                # Subcarpetas de marcos
-                for i in range(1, cantidad_marcos + 1):
-                    n_registro_marco = f"{n_registro_subcarpeta}-MC{i:02d}"
-                    marco_id = crear_carpeta(servicio, n_registro_marco, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_marco,
-                        "subcarpetas_internas_id": marco_id,
-                        "tipo": "MC",
-                        "imagenes": []
-                    })
-
-                # Subcarpetas de negativos
-                for i in range(1, cantidad_negativos + 1):
-                    n_registro_negativo = f"{n_registro_subcarpeta}-NG{i:02d}"
-                    negativo_id = crear_carpeta(servicio, n_registro_negativo, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_negativo,
-                        "subcarpetas_internas_id": negativo_id,
-                        "tipo": "NG",
-                        "imagenes": []
-                    })
-                # Subcarpetas de diapositivas
-                for i in range(1, cantidad_diapositivas + 1):
-                    n_registro_diapositivas = f"{n_registro_subcarpeta}-P{i:02d}"
-                    diapositivas_id = crear_carpeta(servicio, n_registro_diapositivas, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_diapositivas,
-                        "subcarpetas_internas_id": diapositivas_id,
-                        "tipo": "P",
-                        "imagenes": []
-                    })
-                # Subcarpetas de diapositivas
-                for i in range(1, cantidad_fotos_sueltas + 1):
-                    n_registro_fotos_sueltas = f"{n_registro_subcarpeta}-Z{i:02d}"
-                    fotos_sueltas_id = crear_carpeta(servicio, n_registro_fotos_sueltas, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_fotos_sueltas,
-                        "subcarpetas_internas_id": fotos_sueltas_id,
-                        "tipo": "P",
-                        "imagenes": []
-                    })
-
-
-            elif tipo_subcarpeta in ["O"]:
-                subcarpeta = {
-                    "nRegistro": n_registro_subcarpeta,
-                    "id_subcarpeta": subcarpeta_id,
-                    "tipo": tipo_subcarpeta,
-                    "subcarpetas_internas": []
-                }
-                                # Subcarpetas dinámicas
-                for i in range(1, cantidad_albumes + 1):
-                    n_registro_album = f"{n_registro_subcarpeta}-A{i:02d}"
-                    album_id = crear_carpeta(servicio, n_registro_album, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_album,
-                        "subcarpetas_internas_id": album_id,
-                        "tipo": "A",
-                        "imagenes": []
-                    })
-
-            elif tipo_subcarpeta in ["S"]:
-                subcarpeta = {
-                    "nRegistro": n_registro_subcarpeta,
-                    "id_subcarpeta": subcarpeta_id,
-                    "tipo": tipo_subcarpeta,
-                    "subcarpetas_internas": []
-                }
-
-                # Subcarpetas dinámicas
-                for i in range(1, cantidad_albumes + 1):
-                    n_registro_album = f"{n_registro_subcarpeta}-A{i:02d}"
-                    album_id = crear_carpeta(servicio, n_registro_album, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_album,
-                        "subcarpetas_internas_id": album_id,
-                        "tipo": "A",
-                        "imagenes": []
-                    })
-
-                # Subcarpetas de marcos
-                for i in range(1, cantidad_marcos + 1):
-                    n_registro_marco = f"{n_registro_subcarpeta}-MC{i:02d}"
-                    marco_id = crear_carpeta(servicio, n_registro_marco, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_marco,
-                        "subcarpetas_internas_id": marco_id,
-                        "tipo": "MC",
-                        "imagenes": []
-                    })
-
-                # Subcarpetas de negativos
-                for i in range(1, cantidad_negativos + 1):
-                    n_registro_negativo = f"{n_registro_subcarpeta}-NG{i:02d}"
-                    negativo_id = crear_carpeta(servicio, n_registro_negativo, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_negativo,
-                        "subcarpetas_internas_id": negativo_id,
-                        "tipo": "NG",
-                        "imagenes": []
-                    })
-                # Subcarpetas de diapositivas
-                for i in range(1, cantidad_diapositivas + 1):
-                    n_registro_diapositivas = f"{n_registro_subcarpeta}-P{i:02d}"
-                    diapositivas_id = crear_carpeta(servicio, n_registro_diapositivas, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_diapositivas,
-                        "subcarpetas_internas_id": diapositivas_id,
-                        "tipo": "P",
-                        "imagenes": []
-                    })
-                # Subcarpetas de diapositivas
-                for i in range(1, cantidad_fotos_sueltas + 1):
-                    n_registro_fotos_sueltas = f"{n_registro_subcarpeta}-Z{i:02d}"
-                    fotos_sueltas_id = crear_carpeta(servicio, n_registro_fotos_sueltas, subcarpeta_id)
-                    subcarpeta["subcarpetas_internas"].append({
-                        "nRegistro": n_registro_fotos_sueltas,
-                        "subcarpetas_internas_id": fotos_sueltas_id,
-                        "tipo": "P",
-                        "imagenes": []
-                    })
-                                # Subcarpetas internas fijas
-                subcarpetas_fijas = ["D"]
-                for tipo_fija in subcarpetas_fijas:
-                    n_registro_fija = f"{n_registro_subcarpeta}-{tipo_fija}"
-                    subcarpeta_fija_id = crear_carpeta(servicio, n_registro_fija, subcarpeta_id)
-                    subcarpeta_interna = {
-                        "nRegistro": n_registro_fija,
-                        "subcarpetas_internas_id": subcarpeta_fija_id,
-                        "tipo": tipo_fija,
-                        "imagenes": []
-                    }
-                    subcarpeta["subcarpetas_internas"].append(subcarpeta_interna)
-
-            
-            else:
-                # Inicializar como lista vacía para imágenes
-                subcarpeta = {
-                    "nRegistro": n_registro_subcarpeta,
-                    "id_subcarpeta": subcarpeta_id,
-                    "tipo": tipo_subcarpeta,
-                    "imagenes": []  # Lista vacía para F y R
-                }
-            estructura_creada["subcarpetas"].append(subcarpeta)
+        estructura_creada = planificar_estructura(
+            nombre_principal, cantidad_albumes, cantidad_marcos,
+            cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas
+        )
+        crear_carpetas_de_estructura(servicio, estructura_creada)
 
         print("Estructura completa creada")
         return estructura_creada
@@ -321,11 +1037,18 @@ def crear_estructura_completa(servicio, nombre_principal, cantidad_albumes, cant
 # Zona horaria de España
 spain_timezone = pytz.timezone("Europe/Madrid")
 
+# Escribir cada lote en MongoDB dentro de una transacción (requiere replica set, p. ej. Atlas)
+MONGODB_TRANSACCIONES = leer_booleano(os.getenv("MONGODB_TRANSACCIONES", "false"))
+
 
 def crear_estructura_en_mongodb(db, estructura_creada):
     """
     Inserta la información de la estructura creada en la base de datos MongoDB.
 
+    Las escrituras se agrupan: un `insert_many` para las subcarpetas internas, otro para
+    las subcarpetas y un único `insert_one` del lote con su lista `subCarpetas` definitiva.
+    Si MONGODB_TRANSACCIONES está activo, las tres escrituras se hacen en una transacción.
+
     Args:
         db: Objeto de conexión a la base de datos MongoDB.
         estructura_creada: Diccionario que representa la estructura creada.
@@ -339,16 +1062,11 @@ def crear_estructura_en_mongodb(db, estructura_creada):
             return False
         print("Datos a insertar en MongoDB:", estructura_creada)
 
-        lote = {
-            "nRegistro": estructura_creada["nRegistro"],
-            "carpeta_principal_id": estructura_creada["carpeta_principal_id"],
-            "subCarpetas": [],
-            "created_at": datetime.now(spain_timezone)
-        }
-        lote_id = db.lotes.insert_one(lote).inserted_id
-        print(f"Lote insertado con ID: {lote_id}")
+        ahora = datetime.now(spain_timezone)
+        subcarpetas_internas_docs = []
+        subcarpetas_docs = []
 
-        # Procesar subcarpetas
+        # Preparar subcarpetas
         for subcarpeta in estructura_creada["subcarpetas"]:
             # Caso para M, O, S: Subcarpetas internas
             if subcarpeta["tipo"] in ["M", "O", "S"]:
@@ -357,47 +1075,255 @@ def crear_estructura_en_mongodb(db, estructura_creada):
                     "id_subcarpeta": subcarpeta["id_subcarpeta"],
                     "tipo": subcarpeta["tipo"],
                     "subCarpetasInternas": [],  # Inicializar subcarpetas internas
-                    "created_at": datetime.now(spain_timezone)
+                    "created_at": ahora
                 }
-                # Insertar cada subcarpeta interna
                 for subcarpeta_interna in subcarpeta["subcarpetas_internas"]:
-                    subcarpeta_interna_doc = {
+                    subcarpetas_internas_docs.append({
                         "nRegistro": subcarpeta_interna["nRegistro"],
                         "subcarpetas_internas_id": subcarpeta_interna["subcarpetas_internas_id"],
                         "tipo": subcarpeta_interna["tipo"],
                         "imagenes": subcarpeta_interna["imagenes"],
-                        "created_at": datetime.now(spain_timezone)
-                    }
-                    # Insertar subcarpetas internas en MongoDB
-                    db.subcarpetainternas.insert_one(subcarpeta_interna_doc)
-                    subcarpeta_doc["subCarpetasInternas"].append(subcarpeta_interna_doc["subcarpetas_internas_id"])
-             # Caso para F y R: Lista de imágenes, sin subcarpetas internas
+                        "created_at": ahora
+                    })
+                    subcarpeta_doc["subCarpetasInternas"].append(subcarpeta_interna["subcarpetas_internas_id"])
+            # Caso para F y R: Lista de imágenes, sin subcarpetas internas
             elif subcarpeta["tipo"] in ["F", "R"]:
                 subcarpeta_doc = {
                     "nRegistro": subcarpeta["nRegistro"],
                     "id_subcarpeta": subcarpeta["id_subcarpeta"],
                     "tipo": subcarpeta["tipo"],
                     "imagenes": subcarpeta.get("imagenes", []),  # Inicializar lista de imágenes
-                    "created_at": datetime.now(spain_timezone)
+                    "created_at": ahora
                 }
-            subcarpeta_id = db.subcarpetas.insert_one(subcarpeta_doc).inserted_id
-            print(f"Subcarpeta insertada con ID: {subcarpeta_id}")
+            subcarpetas_docs.append(subcarpeta_doc)
+
+        def escribir(session=None):
+            if subcarpetas_internas_docs:
+                db.subcarpetainternas.insert_many(subcarpetas_internas_docs, session=session)
+            subcarpetas_ids = db.subcarpetas.insert_many(subcarpetas_docs, session=session).inserted_ids
+            lote = {
+                "nRegistro": estructura_creada["nRegistro"],
+                "carpeta_principal_id": estructura_creada["carpeta_principal_id"],
+                "subCarpetas": subcarpetas_ids,
+                "created_at": ahora
+            }
+            return db.lotes.insert_one(lote, session=session).inserted_id
 
-            # Actualizar el lote con la subcarpeta
-            db.lotes.update_one(
-                {"_id": lote_id},
-                {"$push": {"subCarpetas": subcarpeta_id}}
-            )
+        if MONGODB_TRANSACCIONES:
+            with db.client.start_session() as session:
+                lote_id = session.with_transaction(escribir)
+        else:
+            lote_id = escribir()
+
+        print(f"Lote insertado con ID: {lote_id} ({len(subcarpetas_docs)} subcarpetas, {len(subcarpetas_internas_docs)} subcarpetas internas)")
         print("Estructura almacenada en MongoDB con éxito.")
+        precargar_cache_carpetas(estructura_creada)
         return True
     except Exception as e:
         print(f"Error al crear la estructura en MongoDB: {e}")
         return False
 
 
+def eliminar_estructura_en_mongodb(db, estructura_creada):
+    """
+    Elimina de MongoDB los documentos de un lote (lotes, subcarpetas y subcarpetainternas).
+    Se usa para deshacer el registro cuando falla la creación de las carpetas en Drive.
+    """
+    try:
+        subcarpetas = estructura_creada["subcarpetas"]
+        n_registros_internas = [
+            interna["nRegistro"]
+            for subcarpeta in subcarpetas
+            for interna in subcarpeta.get("subcarpetas_internas", [])
+        ]
+        db.subcarpetainternas.delete_many({"nRegistro": {"$in": n_registros_internas}})
+        db.subcarpetas.delete_many({"nRegistro": {"$in": [subcarpeta["nRegistro"] for subcarpeta in subcarpetas]}})
+        db.lotes.delete_one({"nRegistro": estructura_creada["nRegistro"]})
+        for n_registro in n_registros_internas + [subcarpeta["nRegistro"] for subcarpeta in subcarpetas]:
+            cache_carpetas.invalidar(n_registro)
+        print(f"Estructura eliminada de MongoDB para nRegistro: {estructura_creada['nRegistro']}")
+    except Exception as e:
+        print(f"Error al eliminar la estructura de MongoDB: {e}")
+
+
+def crear_estructura_concurrente(servicio, db, nombre_principal, cantidad_albumes, cantidad_marcos, cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas):
+    """
+    Crea la estructura de un lote reservando antes todos los IDs de Drive, de modo que
+    la creación de carpetas en Drive y la inserción en MongoDB se ejecutan en paralelo.
+
+    Returns:
+        tuple: (estructura_creada, guardado_en_mongo).
+
+    Raises:
+        Exception: Si ocurre un error al crear las carpetas en Drive. En ese caso se
+        deshace el registro en MongoDB.
+    """
+    estructura_creada = planificar_estructura(
+        nombre_principal, cantidad_albumes, cantidad_marcos,
+        cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas
+    )
+    asignar_ids_estructura(servicio, estructura_creada)
+    print("IDs de Drive reservados para la estructura")
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futuro_drive = executor.submit(en_contexto(crear_carpetas_de_estructura), servicio, estructura_creada)
+        futuro_mongo = executor.submit(en_contexto(crear_estructura_en_mongodb), db, estructura_creada)
+        guardado_en_mongo = futuro_mongo.result()
+        try:
+            futuro_drive.result()
+        except Exception as e:
+            print(f"Error al crear estructura en Google Drive: {e}")
+            if guardado_en_mongo:
+                eliminar_estructura_en_mongodb(db, estructura_creada)
+            raise
+
+    print("Estructura completa creada")
+    return estructura_creada, guardado_en_mongo
+
+
+class CacheCarpetas:
+    """
+    Caché nRegistro -> ID de carpeta de Drive.
+
+    Combina un LRU en memoria con TTL (también para resultados negativos) y, opcionalmente,
+    un almacén compartido compatible con Redis para que todas las instancias aprovechen
+    las búsquedas de las demás.
+    """
+    # Valor con el que se guarda en el almacén compartido un nRegistro inexistente
+    NO_ENCONTRADO = ""
+
+    def __init__(self, max_entradas=10000, ttl=3600, ttl_negativo=30, compartido=None):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self.compartido = compartido
+        self.entradas = OrderedDict()
+        self.lock = threading.Lock()
+        self.contadores = {"aciertos": 0, "aciertos_compartido": 0, "aciertos_negativos": 0, "fallos": 0}
+
+    def obtener(self, nRegistro):
+        """
+        Busca un nRegistro en la caché.
+
+        Returns:
+            tuple: (encontrado, valor). `valor` es None si está cacheado como inexistente.
+        """
+        with self.lock:
+            entrada = self.entradas.get(nRegistro)
+            if entrada is not None and entrada[1] > time.monotonic():
+                self.entradas.move_to_end(nRegistro)
+                clave = "aciertos" if entrada[0] is not None else "aciertos_negativos"
+                self.contadores[clave] += 1
+                return True, entrada[0]
+            if entrada is not None:
+                del self.entradas[nRegistro]
+
+        if self.compartido is not None:
+            try:
+                valor = self.compartido.get(f"carpeta:{nRegistro}")
+            except Exception as e:
+                print(f"Error al leer la caché compartida: {e}")
+                valor = None
+            if valor is not None:
+                valor = valor or None
+                self.guardar(nRegistro, valor, compartir=False)
+                with self.lock:
+                    self.contadores["aciertos_compartido"] += 1
+                return True, valor
+
+        with self.lock:
+            self.contadores["fallos"] += 1
+        return False, None
+
+    def guardar(self, nRegistro, valor, compartir=True):
+        """
+        Guarda el ID de carpeta de un nRegistro (None para cachear que no existe).
+        """
+        ttl = self.ttl if valor is not None else self.ttl_negativo
+        with self.lock:
+            self.entradas[nRegistro] = (valor, time.monotonic() + ttl)
+            self.entradas.move_to_end(nRegistro)
+            while len(self.entradas) > self.max_entradas:
+                self.entradas.popitem(last=False)
+
+        if compartir and self.compartido is not None:
+            try:
+                self.compartido.set(f"carpeta:{nRegistro}", valor or self.NO_ENCONTRADO, ex=ttl)
+            except Exception as e:
+                print(f"Error al escribir en la caché compartida: {e}")
+
+    def invalidar(self, nRegistro):
+        """
+        Elimina un nRegistro de la caché en memoria y de la compartida.
+        """
+        with self.lock:
+            self.entradas.pop(nRegistro, None)
+        if self.compartido is not None:
+            try:
+                self.compartido.delete(f"carpeta:{nRegistro}")
+            except Exception as e:
+                print(f"Error al invalidar la caché compartida: {e}")
+
+    def estadisticas(self):
+        """
+        Devuelve los contadores de aciertos y fallos y el número de entradas en memoria.
+        """
+        with self.lock:
+            return dict(self.contadores, entradas=len(self.entradas), compartida=self.compartido is not None)
+
+
+def crear_almacen_compartido():
+    """
+    Conecta con el almacén compartido de la caché si CACHE_REDIS_URL está definida.
+    El paquete `redis` es opcional: si no está instalado solo se usa la caché en memoria.
+    """
+    url = os.getenv("CACHE_REDIS_URL")
+    if not url:
+        return None
+    try:
+        import redis
+        return redis.Redis.from_url(url, decode_responses=True, socket_timeout=0.5)
+    except Exception as e:
+        print(f"Caché compartida no disponible, se usa solo la caché en memoria: {e}")
+        return None
+
+
+# Caché de IDs de carpeta de Drive por nRegistro
+cache_carpetas = CacheCarpetas(
+    max_entradas=int(os.getenv("CACHE_CARPETAS_MAX", "10000")),
+    ttl=int(os.getenv("CACHE_CARPETAS_TTL", "3600")),
+    ttl_negativo=int(os.getenv("CACHE_CARPETAS_TTL_NEGATIVO", "30")),
+    compartido=crear_almacen_compartido()
+)
+
+
+def precargar_cache_carpetas(estructura_creada):
+    """
+    Carga en la caché los IDs de todas las subcarpetas y subcarpetas internas de un lote
+    recién guardado en MongoDB, sustituyendo posibles entradas negativas anteriores.
+    """
+    for subcarpeta in estructura_creada["subcarpetas"]:
+        cache_carpetas.guardar(subcarpeta["nRegistro"], subcarpeta["id_subcarpeta"])
+        for interna in subcarpeta.get("subcarpetas_internas", []):
+            cache_carpetas.guardar(interna["nRegistro"], interna["subcarpetas_internas_id"])
+
+
+def coleccion_de_nregistro(nRegistro):
+    """
+    Determina la colección de MongoDB de una carpeta según el formato de su nRegistro.
+
+    Returns:
+        tuple: (colección, campo con el ID de Drive).
+    """
+    if "-" in nRegistro[8:]:  # Si hay algo después del octavo carácter, es una subcarpeta interna
+        return "subcarpetainternas", "subcarpetas_internas_id"
+    return "subcarpetas", "id_subcarpeta"
+
+
 def obtener_id_subcarpeta(db, nRegistro):
     """
     Obtiene el ID del documento correcto dependiendo de la colección (subcarpetas o subcarpetainternas).
+    Consulta primero `cache_carpetas`; los resultados de MongoDB (también los negativos) se cachean.
 
     Args:
         db: Objeto de conexión a la base de datos MongoDB.
@@ -410,14 +1336,12 @@ def obtener_id_subcarpeta(db, nRegistro):
     if not nRegistro:
         print("Error: Faltan parámetros necesarios (nRegistro)")
         return None
-    
-    # Determinar la colección según el formato de nRegistro
-    if "-" in nRegistro[8:]:  # Si hay algo después del octavo carácter, es una subcarpeta interna
-        coleccion = "subcarpetainternas"
-        campo = "subcarpetas_internas_id"  # Campo a buscar en subcarpetainternas
-    else:  # Si no, es una subcarpeta normal
-        coleccion = "subcarpetas"
-        campo = "id_subcarpeta"  # Campo a buscar en subcarpetas
+
+    encontrado, valor = cache_carpetas.obtener(nRegistro)
+    if encontrado:
+        return valor
+
+    coleccion, campo = coleccion_de_nregistro(nRegistro)
 
     try:
         # Realizar la consulta en la colección 'subcarpetainternas'
@@ -434,9 +1358,11 @@ def obtener_id_subcarpeta(db, nRegistro):
         # Procesar el resultado
         if resultado and campo in resultado:
             print(f"{campo} encontrado en colección '{coleccion}': {resultado[campo]}")
+            cache_carpetas.guardar(nRegistro, resultado[campo])
             return resultado[campo]
         else:
             print(f"No se encontró el campo '{campo}' para nRegistro: {nRegistro} en la colección '{coleccion}'")
+            cache_carpetas.guardar(nRegistro, None)
             return None
         
     except Exception as e:
@@ -444,326 +1370,1600 @@ def obtener_id_subcarpeta(db, nRegistro):
         return None
     
 
-def subir_archivo(servicio, archivo, subcarpeta_id, nRegistro, db):
-    """
-    Sube un archivo específico a una carpeta de Google Drive.
+def subir_archivo(servicio, archivo, subcarpeta_id, nRegistro, db):
+    """
+    Sube un archivo específico a una carpeta de Google Drive.
+
+    Args:
+        servicio: Objeto de servicio de Google Drive autenticado.
+        archivo: Archivo recibido en la solicitud.
+        subcarpeta_id: ID de la subcarpeta de destino.
+        nRegistro: Identificador único de la estructura.
+
+    Returns:
+        dict: Datos del archivo subido (ID y nombre).
+    """
+    contador = 1
+    try:
+        # Extraer información del archivo recibido
+        mime_type = archivo.content_type  # Tipo MIME del archivo
+
+        # Generar nombre único para el archivo
+        nombre_archivo = f"{nRegistro}-F-{contador:03}"
+
+        # Preparar el archivo para subirlo a Google Drive, por trozos y sin copiarlo en memoria
+        from googleapiclient.http import MediaIoBaseUpload
+
+        media = MediaIoBaseUpload(abrir_lector(archivo), mimetype=mime_type, chunksize=SUBIDA_CHUNK_BYTES, resumable=True)
+        metadatos_archivo = {
+            'name': nombre_archivo,
+            'parents': [subcarpeta_id]
+        }
+
+        # Subir el archivo a Google Drive
+        archivo_subido = ejecutar_drive(servicio.files().create(body=metadatos_archivo, media_body=media, fields='id'))
+        archivo_id = archivo_subido.get('id')
+        print(f"Archivo subido: {nombre_archivo} (ID: {archivo_id})")
+
+        try:
+            pdf_con_timestamp = {
+                "id_pdf": archivo_id,
+                "created_at": datetime.now(spain_timezone)  # Usar timezone si es necesario, como spain_timezone
+            }
+
+            # Actualizar en la colección "subcarpetainternas"
+            resultado = db['subcarpetas'].update_one(
+                {"nRegistro": nRegistro},  # Filtrar por nRegistro
+                {"$set": {"pdf": pdf_con_timestamp}}  # Actualizar o insertar el PDF
+            )
+
+            # Verificar resultado de la operación en MongoDB
+            if resultado.matched_count == 0:
+                print(f"[ERROR] No se encontró la carpeta para nRegistro: {nRegistro}")
+            elif resultado.modified_count > 0:
+                print(f"[SUCCESS] PDF actualizado en MongoDB para nRegistro: {nRegistro}")
+            else:
+                print(f"[INFO] No se modificó el documento para nRegistro: {nRegistro}")
+        except Exception as e:
+            print(f"Error al actualizar MongoDB: {e}")
+            return None
+
+        return {
+            'id': archivo_id,
+            'nombre': nombre_archivo
+        }
+
+    except Exception as e:
+        print(f"Error al subir el archivo '{archivo.filename}': {e}")
+        return None
+
+
+def nombre_final_archivo(nRegistro, numero, classification=None):
+    """
+    Calcula el nombre definitivo de una foto: `nRegistro-NNN`, con el sufijo `-IA` o `-PS`
+    si la foto se ha clasificado. Otros resultados (errores, archivo vacío) no se añaden al nombre.
+    """
+    nombre = f"{nRegistro}-{numero:03}"
+    if classification in ("IA", "PS"):
+        nombre = f"{nombre}-{classification}"
+    return nombre
+
+
+def mayor_numero_en_carpeta(db, servicio, nRegistro, carpeta_id):
+    """
+    Devuelve el mayor número `NNN` de los archivos `nRegistro-NNN...` de una carpeta (0 si no hay
+    ninguno). Se consulta el índice `archivos` si la carpeta está indexada y, si no, se hace un solo
+    listado en Drive de los archivos cuyo nombre contiene el nRegistro.
+    """
+    patron = re.compile(rf"^{re.escape(nRegistro)}-(\d+)")
+    if carpeta_indexada(db, nRegistro):
+        nombres = [
+            documento["nombre"] for documento in db.archivos.find(
+                {"carpeta_id": carpeta_id, "eliminado": False, "nombre": {"$regex": patron.pattern}},
+                {"nombre": 1, "_id": 0}
+            )
+        ]
+    else:
+        archivados, _ = listar_archivos_drive(
+            servicio, carpeta_id, 1000, todos=True, consulta=f"name contains '{nRegistro}-'", campos="name"
+        )
+        nombres = [archivo.get("name", "") for archivo in archivados]
+    numeros = [int(coincidencia.group(1)) for coincidencia in map(patron.match, nombres) if coincidencia]
+    return max(numeros, default=0)
+
+
+def reservar_numeros_archivos(db, servicio, nRegistro, carpeta_id, cantidad):
+    """
+    Reserva de forma atómica un bloque contiguo de `cantidad` números de foto para una carpeta,
+    con un único `find_one_and_update` `$inc` sobre la colección `secuencias`. Así varias
+    estaciones pueden subir a la misma carpeta a la vez sin repetir números.
+
+    La primera vez que se usa una carpeta, su secuencia parte del mayor número que ya haya en ella
+    (`base`, ver `mayor_numero_en_carpeta`) y se crea con un solo upsert `$max`/`$inc`: si dos
+    peticiones la crean a la vez, ninguna pierde su reserva.
+
+    Returns:
+        int: Primer número del bloque reservado.
+
+    Raises:
+        RuntimeError: Si no hay conexión con MongoDB. Los errores de MongoDB y Drive se propagan:
+            sin numeración no se puede subir sin riesgo de repetir nombres.
+    """
+    if db is None:
+        raise RuntimeError(f"No se puede reservar la numeración para {nRegistro}: no hay conexión con MongoDB")
+    if cantidad <= 0:
+        return 1
+
+    secuencia = db.secuencias.find_one_and_update(
+        {"_id": nRegistro},
+        {"$inc": {"ultimo": cantidad}},
+        return_document=ReturnDocument.AFTER
+    )
+    if secuencia is None:
+        semilla = mayor_numero_en_carpeta(db, servicio, nRegistro, carpeta_id)
+        try:
+            secuencia = db.secuencias.find_one_and_update(
+                {"_id": nRegistro},
+                {"$max": {"base": semilla}, "$inc": {"ultimo": cantidad}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Otra petición ha creado la secuencia a la vez: el upsert se repite como actualización
+            secuencia = db.secuencias.find_one_and_update(
+                {"_id": nRegistro},
+                {"$max": {"base": semilla}, "$inc": {"ultimo": cantidad}},
+                return_document=ReturnDocument.AFTER
+            )
+
+    ultimo = secuencia.get("base", 0) + secuencia["ultimo"]
+    primer_numero = ultimo - cantidad + 1
+    print(f"Números reservados para {nRegistro}: {primer_numero:03}-{ultimo:03}")
+    return primer_numero
+
+
+# Campos de Drive que se guardan de cada archivo para poder listarlo desde MongoDB
+CAMPOS_ARCHIVO_DRIVE = "id, name, mimeType, webViewLink, webContentLink"
+
+# Número de hilos para subir archivos a Drive en paralelo (1 = subida secuencial)
+SUBIDA_MAX_HILOS = int(os.getenv("SUBIDA_MAX_HILOS", "4"))
+
+
+def subir_un_archivo(servicio, archivo, carpeta_id, nombre=None, http=None):
+    """
+    Sube un archivo a una carpeta de Google Drive.
+
+    Args:
+        servicio: Objeto de servicio de Google Drive autenticado.
+        archivo: Archivo recibido en la solicitud.
+        carpeta_id: ID de la carpeta de destino.
+        nombre: Nombre con el que se crea el archivo en Drive (por defecto el original).
+        http: Objeto HTTP con el que ejecutar la petición (por defecto el del servicio).
+
+    Returns:
+        dict: {'id', 'nombre'} si la subida fue bien, o {'nombre', 'error'} si falló.
+    """
+    try:
+        # Extraer información del archivo recibido
+        nombre_archivo = nombre or archivo.filename
+        mime_type = archivo.content_type  # Tipo MIME del archivo (por ejemplo, 'image/jpeg')
+
+        # Preparar el archivo para subirlo a Google Drive, por trozos y sin copiarlo en memoria
+        from googleapiclient.http import MediaIoBaseUpload
+
+        media = MediaIoBaseUpload(abrir_lector(archivo), mimetype=mime_type, chunksize=SUBIDA_CHUNK_BYTES, resumable=True)
+        metadatos_archivo = {
+            'name': nombre_archivo,
+            'parents': [carpeta_id]
+        }
+
+        # Subir el archivo a Google Drive
+        archivo_subido = ejecutar_drive(servicio.files().create(body=metadatos_archivo, media_body=media, fields=CAMPOS_ARCHIVO_DRIVE), http=http)
+        return {
+            'id': archivo_subido.get('id'),
+            'nombre': nombre_archivo,
+            'tipo': archivo_subido.get('mimeType', mime_type),
+            'link_visualizacion': archivo_subido.get('webViewLink'),
+            'link_descarga': archivo_subido.get('webContentLink')
+        }
+
+    except Exception as e:
+        print(f"Error al subir el archivo '{archivo.filename}': {e}")
+        return {
+            'nombre': nombre or archivo.filename,
+            'error': str(e)
+        }
+
+
+# Función para subir múltiples archivos
+def subir_multiples_archivos(servicio, archivos, subcarpetas_internas_id, nRegistro, nombres=None, max_hilos=None):
+    """
+    Sube múltiples archivos a una carpeta específica en Google Drive.
+
+    Con más de un hilo, cada subida toma prestado un objeto HTTP de `pool_drive` mientras dura
+    (ver `ejecutar_drive`), así que las conexiones keep-alive se reutilizan entre peticiones.
+
+    Args:
+        servicio: Objeto de servicio de Google Drive autenticado.
+        archivos: Lista de archivos a subir.
+        subcarpetas_internas_id: ID de la carpeta de destino.
+        nRegistro: Nombre base proporcionado por el usuario.
+        nombres: Nombres definitivos de los archivos en Drive (por defecto los originales).
+        max_hilos: Subidas simultáneas (por defecto SUBIDA_MAX_HILOS).
+
+    Returns:
+        list: Un resultado por archivo, en el mismo orden que `archivos`:
+        {'id', 'nombre'} si se subió o {'nombre', 'error'} si falló.
+    """
+    max_hilos = max_hilos or SUBIDA_MAX_HILOS
+    nombres = nombres or [None] * len(archivos)
+
+    if max_hilos <= 1 or len(archivos) <= 1:
+        resultados = [
+            subir_un_archivo(servicio, archivo, subcarpetas_internas_id, nombre=nombre)
+            for archivo, nombre in zip(archivos, nombres)
+        ]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_hilos, len(archivos))) as executor:
+            resultados = list(executor.map(
+                en_contexto(lambda archivo, nombre: subir_un_archivo(servicio, archivo, subcarpetas_internas_id, nombre=nombre)),
+                archivos, nombres
+            ))
+
+    errores = sum(1 for resultado in resultados if 'error' in resultado)
+    print(f"Subida de multiples archivos terminada: {len(resultados) - errores} correctos, {errores} con error")
+    return resultados
+
+
+# Modelo de Replicate usado para clasificar
+MODELO_LLAVA = "yorickvp/llava-v1.6-mistral-7b:19be067b589d0c46689ffa7cc3ff321447a441986a7694c01225973c2eafc874"
+
+
+# Tiempo máximo (segundos) para clasificar una imagen con LLaVA antes de cancelar la predicción
+CLASIFICACION_PLAZO_SEGUNDOS = float(os.getenv("CLASIFICACION_PLAZO_SEGUNDOS", "60"))
+
+# Máximo de tokens que puede generar LLaVA; la respuesta es un único "0" o "1"
+CLASIFICACION_MAX_TOKENS = int(os.getenv("CLASIFICACION_MAX_TOKENS", "4"))
+
+# Clasificación que se asigna si LLaVA no responde a tiempo ("PS" manda la foto a revisar; "" la deja sin sufijo)
+CLASIFICACION_POR_DEFECTO = os.getenv("CLASIFICACION_POR_DEFECTO", "PS").upper()
+
+# Respuestas de LLaVA y su clasificación
+RESPUESTAS_LLAVA = {"0": "IA", "1": "PS"}
+
+
+class PlazoClasificacionAgotado(TimeoutError):
+    """La predicción de LLaVA no respondió dentro de CLASIFICACION_PLAZO_SEGUNDOS."""
+
+
+# Cliente de Replicate del proceso, creado la primera vez que se necesita
+cliente_replicate = None
+lock_cliente_replicate = threading.Lock()
+
+
+def obtener_cliente_replicate():
+    """
+    Devuelve el cliente de Replicate, creándolo si aún no existe. Ninguna operación de red
+    (conexión, envío de la imagen, lectura) puede durar más que CLASIFICACION_PLAZO_SEGUNDOS.
+    """
+    global cliente_replicate
+    with lock_cliente_replicate:
+        if cliente_replicate is None:
+            # Importación diferida: replicate tarda en cargarse y solo hace falta para clasificar
+            import httpx
+            import replicate
+
+            cliente_replicate = replicate.Client(
+                api_token=REPLICATE_API_TOKEN,
+                timeout=httpx.Timeout(CLASIFICACION_PLAZO_SEGUNDOS)
+            )
+        return cliente_replicate
+
+
+# Funcion de clasificador
+def classification_llava(img_bytes, plazo=None, max_tokens=None):
+    """
+    Clasifica una imagen a partir de un objeto en memoria (BytesIO o bytes).
+
+    Lee la salida de la predicción en streaming y decide con el primer token que no sea
+    espacio en blanco, cancelando la predicción en Replicate en ese momento. El plazo cuenta
+    desde antes de crear la predicción (que incluye enviar la imagen); si se supera, se cancela
+    la predicción y se lanza `PlazoClasificacionAgotado`.
+
+    :param img_bytes: Contenido de la imagen en formato bytes o BytesIO.
+    :param plazo: Segundos máximos de espera (por defecto CLASIFICACION_PLAZO_SEGUNDOS).
+    :param max_tokens: Tokens máximos a leer (por defecto CLASIFICACION_MAX_TOKENS).
+    :return: "IA" o "PS".
+    """
+    # Si el input es bytes, conviértelo en BytesIO
+    if isinstance(img_bytes, bytes):
+        img_stream = BytesIO(img_bytes)
+    elif hasattr(img_bytes, "read"):
+        img_stream = img_bytes
+    else:
+        raise ValueError("El argumento img_bytes debe ser bytes o un objeto similar a BytesIO.")
+
+    plazo = plazo or CLASIFICACION_PLAZO_SEGUNDOS
+    max_tokens = max_tokens or CLASIFICACION_MAX_TOKENS
+
+    # Crear el diccionario de entrada
+    input_data = {
+        "image": img_stream,
+        "prompt": prompt,
+        "max_tokens": max_tokens,
+    }
+
+    import httpx
+    from replicate.stream import ServerSentEvent
+
+    # Al vencer el plazo se cancela la predicción, lo que cierra el stream aunque esté esperando.
+    # Si vence mientras se crea, se cancela en cuanto se ha creado
+    inicio = time.monotonic()
+    plazo_vencido = threading.Event()
+    creada = []
+
+    def cancelar_por_plazo():
+        plazo_vencido.set()
+        for prediccion_creada in creada:
+            cancelar_prediccion(prediccion_creada)
+
+    temporizador = threading.Timer(plazo, cancelar_por_plazo)
+    temporizador.daemon = True
+    temporizador.start()
+
+    try:
+        with medir_etapa("replicate.crear_prediccion"):
+            prediccion = obtener_cliente_replicate().predictions.create(
+                version=MODELO_LLAVA.split(":", 1)[1],
+                input=input_data,
+                stream=True,
+            )
+    except httpx.TimeoutException as e:
+        temporizador.cancel()
+        raise PlazoClasificacionAgotado(f"LLaVA no respondió en {plazo} s: {e}") from e
+    except Exception:
+        temporizador.cancel()
+        raise
+    creada.append(prediccion)
+    if plazo_vencido.is_set():
+        cancelar_prediccion(prediccion)
+        raise PlazoClasificacionAgotado(f"LLaVA no respondió en {plazo} s")
+
+    salida = ""
+    tokens = 0
+    try:
+        for event in prediccion.stream():
+            if plazo_vencido.is_set():
+                break
+            # El SDK da el tipo de evento como enum (ServerSentEvent.EventType), no como texto
+            if event.event != ServerSentEvent.EventType.OUTPUT:
+                if event.event == ServerSentEvent.EventType.ERROR:
+                    raise ValueError(f"Error en la predicción: {event.data}")
+                continue
+            tokens += 1
+            salida += event.data.replace("{}", "")
+            respuesta = salida.strip()
+            if respuesta:
+                # Decidir con el primer carácter no vacío y no esperar al resto de la salida
+                cancelar_prediccion(prediccion)
+                if respuesta[0] in RESPUESTAS_LLAVA:
+                    print(f"Clasificación decidida en {time.monotonic() - inicio:.2f} s con {tokens} token(s)")
+                    return RESPUESTAS_LLAVA[respuesta[0]]
+                raise ValueError(f"Valor inesperado en la salida: {respuesta}")
+            if tokens >= max_tokens:
+                cancelar_prediccion(prediccion)
+                raise ValueError(f"La salida no contiene una clasificación tras {tokens} tokens")
+    except Exception:
+        if not plazo_vencido.is_set():
+            raise
+    finally:
+        temporizador.cancel()
+
+    if plazo_vencido.is_set():
+        raise PlazoClasificacionAgotado(f"LLaVA no respondió en {plazo} s")
+    raise ValueError(f"La predicción terminó sin clasificación: '{salida.strip()}'")
+
+
+def cancelar_prediccion(prediccion):
+    """
+    Cancela una predicción de Replicate que ya no se necesita. Los errores se ignoran
+    (la predicción puede haber terminado ya).
+    """
+    try:
+        prediccion.cancel()
+    except Exception as e:
+        print(f"No se pudo cancelar la predicción {getattr(prediccion, 'id', '')}: {e}")
+
+
+# Número máximo de clasificaciones en curso a la vez contra Replicate en cada proceso,
+# sumando todas las peticiones que se atienden en paralelo
+CLASIFICACION_MAX_CONCURRENCIA = int(os.getenv("CLASIFICACION_MAX_CONCURRENCIA", "4"))
+
+# Clasificador que se usa: "llava" (Replicate) u "onnx" (modelo local en CPU, ver clasificador_onnx.py)
+CLASIFICADOR_BACKEND = os.getenv("CLASIFICADOR_BACKEND", "llava").lower()
+
+
+# Limita las llamadas a Replicate en curso de todo el proceso, no solo las de una petición
+limite_replicate = threading.BoundedSemaphore(CLASIFICACION_MAX_CONCURRENCIA)
+
+
+class ClasificadorLlava:
+    """
+    Clasificador remoto con LLaVA en Replicate. Cada imagen se reduce antes de enviarla.
+
+    Todos los clasificadores exponen `version` (parte de la clave de la caché de clasificaciones),
+    `concurrencia` (clasificaciones en paralelo recomendadas) y `clasificar(imagen)`, que devuelve
+    "IA" o "PS".
+    """
+
+    def __init__(self):
+        self.version = f"{MODELO_LLAVA}:{hashlib.sha256(prompt.encode('utf-8')).hexdigest()}"
+        self.concurrencia = CLASIFICACION_MAX_CONCURRENCIA
+
+    def clasificar(self, imagen, nombre_archivo=""):
+        imagen_modelo = preparar_imagen_modelo(nombre_archivo, imagen)
+        with limite_replicate, medir_etapa("replicate.clasificacion"):
+            return classification_llava(imagen_modelo)
+
+
+# Clasificador en uso, creado la primera vez que se necesita
+clasificador = None
+lock_clasificador = threading.Lock()
+
+
+def obtener_clasificador():
+    """
+    Devuelve el clasificador configurado en CLASIFICADOR_BACKEND, creándolo si aún no existe.
+    """
+    global clasificador
+    with lock_clasificador:
+        if clasificador is None:
+            if CLASIFICADOR_BACKEND == "onnx":
+                # Solo se importa si se usa: necesita onnxruntime, que no está en requirements.txt
+                from clasificador_onnx import ClasificadorOnnx
+
+                clasificador = ClasificadorOnnx()
+            elif CLASIFICADOR_BACKEND == "llava":
+                clasificador = ClasificadorLlava()
+            else:
+                raise ValueError(f"CLASIFICADOR_BACKEND desconocido: {CLASIFICADOR_BACKEND}")
+        return clasificador
+
+
+def clave_cache_clasificacion(lector):
+    """
+    Calcula la clave de la caché de clasificaciones: SHA-256 de la imagen y versión del clasificador
+    (modelo y SHA-256 del prompt en LLaVA, SHA-256 del modelo en ONNX), de modo que cambiar
+    el clasificador, el modelo o el prompt invalida la caché.
+    La imagen se lee por trozos desde `lector`, que queda de nuevo al principio.
+    """
+    hash_imagen = hashlib.sha256()
+    lector.seek(0)
+    for trozo in iter(lambda: lector.read(1024 * 1024), b""):
+        hash_imagen.update(trozo)
+    lector.seek(0)
+    return f"{hash_imagen.hexdigest()}:{obtener_clasificador().version}"
+
+
+def buscar_clasificacion_en_cache(db, clave):
+    """
+    Devuelve la clasificación guardada para una clave, o None si no está en caché.
+    """
+    if db is None:
+        return None
+    try:
+        documento = db.clasificaciones_cache.find_one({"_id": clave}, {"classification": 1})
+        return documento["classification"] if documento else None
+    except Exception as e:
+        print(f"Error al consultar la caché de clasificaciones: {e}")
+        return None
+
+
+def guardar_clasificacion_en_cache(db, clave, classification):
+    """
+    Guarda una clasificación en la colección `clasificaciones_cache` (con caducidad por TTL).
+    """
+    if db is None:
+        return
+    try:
+        db.clasificaciones_cache.update_one(
+            {"_id": clave},
+            {"$setOnInsert": {"classification": classification, "created_at": datetime.now(spain_timezone)}},
+            upsert=True
+        )
+    except Exception as e:
+        print(f"Error al guardar en la caché de clasificaciones: {e}")
+
+
+# Reducir y recodificar las imágenes antes de enviarlas a Replicate
+IMAGEN_REDUCIR = leer_booleano(os.getenv("IMAGEN_REDUCIR", "true"))
+
+# Lado mayor máximo de la imagen enviada al modelo (LLaVA 1.6 trabaja como mucho a 1344 px)
+IMAGEN_LADO_MAX = int(os.getenv("IMAGEN_LADO_MAX", "1344"))
+
+# Formato ("JPEG" o "WEBP") y calidad de la imagen enviada al modelo
+IMAGEN_FORMATO = os.getenv("IMAGEN_FORMATO", "JPEG").upper()
+IMAGEN_CALIDAD = int(os.getenv("IMAGEN_CALIDAD", "90"))
+
+# Procesos para terminar de reducir y codificar imágenes fuera de los hilos de las peticiones (0 = en el propio hilo)
+IMAGEN_PROCESOS = int(os.getenv("IMAGEN_PROCESOS", "2"))
+
+# Pool de procesos para reducir imágenes, creado la primera vez que se usa
+pool_imagenes = None
+lock_pool_imagenes = threading.Lock()
+
+
+def obtener_pool_imagenes():
+    """
+    Devuelve el pool de procesos de reducción de imágenes, creándolo si aún no existe.
+    Los procesos salen de un forkserver y no de un fork del worker, que tiene hilos y locks
+    (MongoDB, httplib2, logging) que podrían quedar bloqueados en el proceso hijo.
+    """
+    global pool_imagenes
+    with lock_pool_imagenes:
+        if pool_imagenes is None:
+            pool_imagenes = ProcessPoolExecutor(max_workers=IMAGEN_PROCESOS, mp_context=multiprocessing.get_context("forkserver"))
+        return pool_imagenes
+
+
+def preparar_imagen_modelo(nombre_archivo, lector):
+    """
+    Reduce la imagen a IMAGEN_LADO_MAX y la recodifica en IMAGEN_FORMATO antes de enviarla
+    a Replicate. Si no se puede reducir, se devuelve el lector original.
+
+    La imagen se decodifica en el propio hilo leyendo del buffer del archivo y se prerreduce
+    (`prerreducir_imagen`); al pool de procesos solo se envían los píxeles ya reducidos.
+
+    Returns:
+        Objeto tipo archivo con la imagen a enviar al modelo.
+    """
+    global pool_imagenes
+    if not IMAGEN_REDUCIR:
+        return lector
+    try:
+        lector.seek(0)
+        with medir_etapa("imagen.reduccion"):
+            prerreducida = prerreducir_imagen(lector, IMAGEN_LADO_MAX)
+            if IMAGEN_PROCESOS > 0:
+                reducida = obtener_pool_imagenes().submit(reducir_imagen, prerreducida, IMAGEN_LADO_MAX, IMAGEN_FORMATO, IMAGEN_CALIDAD).result()
+            else:
+                reducida = reducir_imagen(prerreducida, IMAGEN_LADO_MAX, IMAGEN_FORMATO, IMAGEN_CALIDAD)
+        print(f"Imagen {nombre_archivo} reducida de {lector.tamano()} a {len(reducida)} bytes para el modelo")
+        imagen_modelo = BytesIO(reducida)
+        imagen_modelo.name = f"imagen.{IMAGEN_FORMATO.lower()}"
+        return imagen_modelo
+    except Exception as e:
+        print(f"No se pudo reducir la imagen {nombre_archivo}, se envía la original: {e}")
+        if isinstance(e, BrokenProcessPool):
+            with lock_pool_imagenes:
+                pool_imagenes = None
+        lector.seek(0)
+        return lector
+
+
+# Decidir localmente los casos claros antes de llamar a LLaVA (ver preclasificador.py)
+PRECLASIFICADOR_ACTIVO = leer_booleano(os.getenv("PRECLASIFICADOR_ACTIVO", "false"))
+
+
+def clasificar_contenido(nombre_archivo, lector):
+    """
+    Clasifica el contenido de un archivo leyendo de su buffer (`LectorCompartido`). Si la misma
+    imagen ya se clasificó con el mismo modelo y prompt, se devuelve el resultado guardado sin
+    llamar a Replicate; si no, los casos claros los decide el preclasificador local.
+
+    Returns:
+        str: "IA"/"PS" (CLASIFICACION_POR_DEFECTO si LLaVA no responde a tiempo), o un mensaje
+        si el archivo está vacío o la clasificación falla.
+    """
+    # Validar si el archivo tiene contenido
+    if lector.tamano() == 0:
+        print(f"El archivo '{nombre_archivo}' está vacío. Saltando clasificación.")
+        return "Archivo vacío"
+
+    clave = clave_cache_clasificacion(lector)
+    classification_result = buscar_clasificacion_en_cache(db, clave)
+    if classification_result:
+        print(f"Clasificación de {nombre_archivo} obtenida de la caché: {classification_result}")
+        return classification_result
+
+    # Casos claros (foto limpia o muy dañada): decide el preclasificador local sin llamar a Replicate
+    if PRECLASIFICADOR_ACTIVO:
+        try:
+            with medir_etapa("clasificacion.preclasificador"):
+                classification_local, puntuacion, _ = preclasificar(lector)
+            if classification_local:
+                print(f"Clasificación local de {nombre_archivo}: {classification_local} (puntuación {puntuacion:.3f})")
+                return classification_local
+        except Exception as e:
+            print(f"Error en el preclasificador local de {nombre_archivo}: {e}")
+        finally:
+            lector.seek(0)
+
+    # Clasificar la imagen con el clasificador configurado
+    try:
+        with medir_etapa(f"clasificacion.{CLASIFICADOR_BACKEND}"):
+            classification_result = obtener_clasificador().clasificar(lector, nombre_archivo)
+        guardar_clasificacion_en_cache(db, clave, classification_result)
+        return classification_result
+    except PlazoClasificacionAgotado as e:
+        # Sin respuesta a tiempo: clasificación por defecto, que no se guarda en la caché
+        print(f"Plazo agotado al clasificar {nombre_archivo}: {e}. Se asigna '{CLASIFICACION_POR_DEFECTO}'")
+        return CLASIFICACION_POR_DEFECTO or "Clasificación no realizada"
+    except Exception as e:
+        print(f"Error durante la clasificación de {nombre_archivo}: {e}")
+        return "Error durante clasificación"
+
+
+# Funcion de Clasificacion
+def clasificacion(archivos, max_concurrencia=None):
+    """
+    Clasifica varias imágenes con hasta `max_concurrencia` clasificaciones en paralelo.
+
+    Args:
+        archivos: Lista de archivos recibidos en la solicitud.
+        max_concurrencia: Clasificaciones simultáneas (por defecto la recomendada por el clasificador).
+
+    Returns:
+        list: Una clasificación por archivo, en el mismo orden que `archivos`.
+    """
+    lectores = []
+    for archivo in archivos:
+        try:
+            lectores.append(abrir_lector(archivo))
+        except Exception as e:
+            print(f"Error al procesar el archivo '{archivo.filename}': {e}")
+            lectores.append(None)
+
+    try:
+        max_concurrencia = max_concurrencia or obtener_clasificador().concurrencia
+    except Exception as e:
+        print(f"Error al cargar el clasificador '{CLASIFICADOR_BACKEND}': {e}")
+        return ["Error durante clasificación"] * len(archivos)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_concurrencia, len(archivos)))) as executor:
+        futuros = [
+            executor.submit(en_contexto(clasificar_contenido), archivo.filename, lector) if lector is not None else None
+            for archivo, lector in zip(archivos, lectores)
+        ]
+        return [futuro.result() if futuro is not None else "Error general" for futuro in futuros]
+
+
+# Actualizar la colección subcarpetainternas en MongoDB
+def actualizar_imagenes_en_mongo(db, nRegistro, ids_imagenes, classifications=None):
+    """
+    Actualiza la colección "subcarpetainternas"  o las carpetas F/R en MongoDB con los IDs de las imágenes subidas.
+
+    Args:
+        db: Objeto de conexión a la base de datos MongoDB.
+        nRegistro: Identificador único de la estructura.
+        ids_imagenes: Lista de IDs de las imágenes subidas.
+    """
+    try:
+         # Crear una lista de objetos con id_imagen y created_at
+        imagenes_con_timestamp = []  # Lista vacía para almacenar los resultados
+        if nRegistro.split("-")[2] == "S":
+            for indice, id_imagen in enumerate(ids_imagenes):
+                imagen_con_datos = {
+                    "id_imagen": id_imagen,
+                    "created_at": datetime.now(spain_timezone),
+                    "classification": classifications[indice]
+                }
+                imagenes_con_timestamp.append(imagen_con_datos)
+        else:
+            for id_imagen in ids_imagenes:
+                imagen_con_datos = {
+                    "id_imagen": id_imagen,
+                    "created_at": datetime.now(spain_timezone)
+                }
+                imagenes_con_timestamp.append(imagen_con_datos)
+
+        resultado = db['subcarpetainternas'].update_one(
+            {"nRegistro": nRegistro}, # Filtrar por el nombre único de la carpeta
+            {"$push": {"imagenes": {"$each": imagenes_con_timestamp}}} # Agregar imágenes a la lista
+        )
+
+        if nRegistro.split("-")[2] == "F":
+            resultado = db['subcarpetas'].update_one(
+            {"nRegistro": nRegistro}, # Filtrar por el nombre único de la carpeta
+            {"$push": {"imagenes": {"$each": imagenes_con_timestamp}}} # Agregar imágenes a la lista
+        )
+
+        # Verificar el resultado
+        if resultado.matched_count == 0:
+            print(f"[ERROR] No se encontró la carpeta para nRegistro: {nRegistro}")
+        elif resultado.modified_count > 0:
+            print(f"[SUCCESS] Imágenes actualizadas en MongoDB para nRegistro: {nRegistro}")
+        else:
+            print(f"[INFO] No se modificó el documento para nRegistro: {nRegistro}")
+
+    except Exception as e:
+        print(f"Error al actualizar imágenes en MongoDB: {e}")
+
+
+# En carpetas S, clasificar y subir cada archivo a la vez en lugar de clasificar todo antes de subir
+SUBIDA_PIPELINE = leer_booleano(os.getenv("SUBIDA_PIPELINE", "true"))
+
+
+def procesar_subida(servicio, nRegistro, subcarpetas_internas_id, archivos, progreso=None):
+    """
+    Clasifica (carpetas S), numera y sube a Drive un conjunto de archivos, y registra
+    el resultado en MongoDB. Lo usan tanto /subir_archivos como los trabajos en segundo plano.
+
+    Args:
+        servicio: Objeto de servicio de Google Drive autenticado.
+        nRegistro: nRegistro de la carpeta de destino.
+        subcarpetas_internas_id: ID de Drive de la carpeta de destino.
+        archivos: Lista de archivos (FileStorage) a subir.
+        progreso: Función opcional `progreso(etapa, datos)` que se llama al terminar
+            la clasificación ("clasificado") y la subida ("subido").
+
+    Returns:
+        tuple: (ids_y_nombres de los archivos subidos, archivos_con_error).
+    """
+    # Inicializar classifications para evitar errores
+    classifications = []
+    es_carpeta_s = nRegistro.split("-")[2] == "S"
+
+    # Reservar la numeración de los archivos
+    primer_numero = reservar_numeros_archivos(db, servicio, nRegistro, subcarpetas_internas_id, len(archivos))
+
+    if es_carpeta_s and SUBIDA_PIPELINE:
+        # Clasificar y subir a la vez: cada archivo se sube como `nRegistro-NNN` mientras se
+        # clasifica, y el sufijo -IA/-PS se añade al final con un único rename en batch
+        nombres_subida = [nombre_final_archivo(nRegistro, primer_numero + indice) for indice in range(len(archivos))]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            futuro_clasificacion = executor.submit(en_contexto(clasificacion), archivos)
+            archivos_subidos = subir_multiples_archivos(servicio, archivos, subcarpetas_internas_id, nRegistro, nombres=nombres_subida)
+            classifications = futuro_clasificacion.result()
+    else:
+        # Clasificación de imágenes
+        if es_carpeta_s:
+            classifications = clasificacion(archivos)
+        archivos_subidos = None
+
+    # Calcular el nombre definitivo de cada archivo
+    nombres = [
+        nombre_final_archivo(nRegistro, primer_numero + indice, classifications[indice] if classifications else None)
+        for indice in range(len(archivos))
+    ]
+    print(f"Nombres de los archivos: {nombres}")
+    if progreso and classifications:
+        progreso("clasificado", classifications)
+
+    # Subir los archivos ya con su nombre definitivo si no se han subido durante la clasificación
+    if archivos_subidos is None:
+        archivos_subidos = subir_multiples_archivos(servicio, archivos, subcarpetas_internas_id, nRegistro, nombres=nombres)
+    if progreso:
+        progreso("subido", {"archivos_subidos": archivos_subidos, "nombres": nombres})
+
+    # Extraer IDs y nombres de los archivos subidos para la respuesta
+    ids_y_nombres = []
+    classifications_subidas = []
+    renombrados_pendientes = []
+    archivos_con_error = [archivo for archivo in archivos_subidos if "error" in archivo]
+    for indice, archivo in enumerate(archivos_subidos):
+        if "id" not in archivo:
+            continue
+        ids_y_nombres.append({
+            "id": archivo["id"],
+            "nombre": nombres[indice]
+        })
+        if classifications:
+            classifications_subidas.append(classifications[indice])
+        if archivo["nombre"] != nombres[indice]:
+            renombrados_pendientes.append({"id": archivo["id"], "nombre": nombres[indice]})
+
+    # Actualizar la colección subcarpetainternas en MongoDB
+    actualizar_imagenes_en_mongo(db, nRegistro, ids_y_nombres, classifications_subidas)
+
+    # Registrar los archivos en el índice de listado con su nombre definitivo
+    registrar_archivos_en_indice(
+        db, nRegistro, subcarpetas_internas_id,
+        [dict(archivo, nombre=nombres[indice]) for indice, archivo in enumerate(archivos_subidos) if "id" in archivo],
+        classifications_subidas
+    )
+
+    # Renombrar en una sola petición batch los archivos que no tengan ya su nombre definitivo
+    if renombrados_pendientes:
+        renombrar_archivos_en_lote(servicio, renombrados_pendientes)
+
+    return ids_y_nombres, archivos_con_error
+
+
+def renombrar_archivos_en_lote(servicio, archivos):
+    """
+    Renombra varios archivos de Google Drive agrupando las llamadas en peticiones batch.
+
+    Args:
+        servicio: Objeto autenticado del servicio de Google Drive.
+        archivos: Lista de diccionarios con el "id" del archivo y su nuevo "nombre".
+
+    Returns:
+        list: Para cada archivo, {'id', 'nombre'} si se renombró o None si falló, en el mismo orden.
+    """
+    renombrados = [None] * len(archivos)
+    peticiones = [
+        servicio.files().update(fileId=archivo["id"], body={"name": archivo["nombre"]}, fields="id, name")
+        for archivo in archivos
+    ]
+    for indice, (respuesta, excepcion) in enumerate(ejecutar_lote_drive(servicio, peticiones)):
+        if excepcion is not None:
+            print(f"Error al renombrar el archivo con ID {archivos[indice]['id']}: {excepcion}")
+        else:
+            renombrados[indice] = {"id": respuesta["id"], "nombre": respuesta["name"]}
+
+    print(f"Archivos renombrados en lote: {sum(1 for r in renombrados if r)} de {len(archivos)}")
+    return renombrados
+
+
+def configurar_permisos(servicio, archivo_id):
+    """
+    Configura los permisos para permitir que cualquier persona con el enlace tenga acceso de lectura.
+
+    :param servicio: Objeto autenticado de la API de Google Drive.
+    :param archivo_id: ID del archivo o carpeta en Google Drive.
+    """
+    try:
+        permiso = {
+            'type': 'anyone',  # Cualquiera con el enlace
+            'role': 'reader'   # Permisos de lectura
+        }
+        ejecutar_drive(servicio.permissions().create(fileId=archivo_id, body=permiso))
+        print(f"Permisos configurados para el archivo/carpeta: {archivo_id}")
+    except Exception as e:
+        print(f"Error al configurar permisos: {e}")
+        raise
+
+
+# Tamaño de página por defecto de /listar_archivos
+LISTADO_TAMANO_PAGINA = int(os.getenv("LISTADO_TAMANO_PAGINA", "100"))
+
+# nRegistros de carpetas ya compartidas que conoce este proceso
+carpetas_compartidas = set()
+
+
+def carpeta_compartida(db, nRegistro):
+    """
+    Indica si una carpeta ya tiene el permiso de lectura "anyone with the link".
+    """
+    if nRegistro in carpetas_compartidas:
+        return True
+    coleccion, _ = coleccion_de_nregistro(nRegistro)
+    try:
+        if db is not None and db[coleccion].find_one({"nRegistro": nRegistro, "compartida": True}, {"_id": 1}):
+            carpetas_compartidas.add(nRegistro)
+            return True
+    except Exception as e:
+        print(f"Error al consultar si la carpeta {nRegistro} está compartida: {e}")
+    return False
+
+
+def asegurar_carpeta_compartida(servicio, db, nRegistro, carpeta_id):
+    """
+    Da permiso de lectura "anyone with the link" a una carpeta una sola vez. Los archivos
+    de la carpeta heredan el permiso, así que no hace falta configurarlo archivo a archivo.
+    El estado se guarda en MongoDB (campo `compartida`) para no repetirlo entre instancias.
+    """
+    if carpeta_compartida(db, nRegistro):
+        return
+
+    configurar_permisos(servicio, carpeta_id)
+    carpetas_compartidas.add(nRegistro)
+    if db is not None:
+        coleccion, _ = coleccion_de_nregistro(nRegistro)
+        try:
+            db[coleccion].update_one({"nRegistro": nRegistro}, {"$set": {"compartida": True}})
+        except Exception as e:
+            print(f"Error al marcar la carpeta {nRegistro} como compartida: {e}")
+
+
+# Responder /listar_archivos desde el índice de MongoDB en lugar de Drive
+LISTADO_DESDE_MONGO = leer_booleano(os.getenv("LISTADO_DESDE_MONGO", "true"))
+
+# Segundos entre pasadas del reconciliador de cambios de Drive (0 = desactivado)
+DRIVE_RECONCILIAR_SEGUNDOS = int(os.getenv("DRIVE_RECONCILIAR_SEGUNDOS", "60"))
+
+# nRegistros de carpetas cuyo contenido ya está copiado en el índice
+carpetas_indexadas = set()
+
+
+def archivo_drive_a_resultado(archivo):
+    """
+    Convierte un archivo tal como lo devuelve la API de Drive al formato de respuesta de la API.
+    """
+    return {
+        "id": archivo.get('id'),
+        "nombre": archivo.get('name'),
+        "tipo": archivo.get('mimeType'),
+        "link_visualizacion": archivo.get('webViewLink'),  # Para vista previa
+        "link_descarga": archivo.get('webContentLink')  # Para descargar
+    }
+
+
+def listar_archivos_drive(servicio, carpeta_id, page_size, cursor=None, todos=False, http=None, consulta=None, campos=CAMPOS_ARCHIVO_DRIVE):
+    """
+    Lista los archivos de una carpeta directamente en Google Drive.
+
+    Args:
+        consulta: Condición adicional de la búsqueda en Drive (p. ej. "name contains '...'").
+        campos: Campos de cada archivo que se piden a Drive.
+
+    Returns:
+        tuple: (archivos de Drive, siguiente cursor o None).
+    """
+    q = f"'{carpeta_id}' in parents and trashed = false"
+    if consulta:
+        q = f"{q} and {consulta}"
+    archivados = []
+    while True:
+        resultados = ejecutar_drive(servicio.files().list(
+            q=q,
+            fields=f"nextPageToken, files({campos})",
+            pageSize=page_size,
+            pageToken=cursor,
+            orderBy="name"
+        ), http=http)
+        archivados.extend(resultados.get('files', []))
+        cursor = resultados.get('nextPageToken')
+        if not todos or not cursor:
+            return archivados, cursor
+
+
+def registrar_archivos_en_indice(db, nRegistro, carpeta_id, archivos, classifications=None):
+    """
+    Inserta o actualiza en la colección `archivos` (índice de listado) los archivos de una carpeta,
+    en una sola operación `bulk_write`.
+
+    Args:
+        db: Objeto de conexión a la base de datos MongoDB.
+        nRegistro: nRegistro de la carpeta.
+        carpeta_id: ID de Drive de la carpeta.
+        archivos: Lista de {'id', 'nombre', 'tipo', 'link_visualizacion', 'link_descarga'}.
+        classifications: Clasificación de cada archivo, en el mismo orden (opcional).
+    """
+    if db is None or not archivos:
+        return
+    ahora = datetime.now(spain_timezone)
+    operaciones = []
+    for indice, archivo in enumerate(archivos):
+        documento = {
+            "nRegistro": nRegistro,
+            "carpeta_id": carpeta_id,
+            "nombre": archivo.get("nombre"),
+            "tipo": archivo.get("tipo"),
+            "link_visualizacion": archivo.get("link_visualizacion"),
+            "link_descarga": archivo.get("link_descarga"),
+            "eliminado": False,
+            "updated_at": ahora
+        }
+        if classifications:
+            documento["classification"] = classifications[indice]
+        operaciones.append(UpdateOne(
+            {"_id": archivo["id"]},
+            {"$set": documento, "$setOnInsert": {"created_at": ahora}},
+            upsert=True
+        ))
+    try:
+        db.archivos.bulk_write(operaciones, ordered=False)
+    except Exception as e:
+        print(f"Error al registrar archivos en el índice para nRegistro {nRegistro}: {e}")
+
+
+def carpeta_indexada(db, nRegistro):
+    """
+    Indica si el contenido de una carpeta ya se ha copiado al índice `archivos`.
+    """
+    if nRegistro in carpetas_indexadas:
+        return True
+    coleccion, _ = coleccion_de_nregistro(nRegistro)
+    if db[coleccion].find_one({"nRegistro": nRegistro, "indexada": True}, {"_id": 1}):
+        carpetas_indexadas.add(nRegistro)
+        return True
+    return False
+
+
+def indexar_carpeta_desde_drive(servicio, db, nRegistro, carpeta_id):
+    """
+    Copia al índice `archivos` todo el contenido actual de una carpeta de Drive y la marca
+    como indexada. A partir de ahí la mantienen al día las subidas y el reconciliador.
+    """
+    archivados, _ = listar_archivos_drive(servicio, carpeta_id, 1000, todos=True)
+    registrar_archivos_en_indice(db, nRegistro, carpeta_id, [archivo_drive_a_resultado(archivo) for archivo in archivados])
+    coleccion, _ = coleccion_de_nregistro(nRegistro)
+    db[coleccion].update_one({"nRegistro": nRegistro}, {"$set": {"indexada": True}})
+    carpetas_indexadas.add(nRegistro)
+    print(f"Carpeta {nRegistro} indexada en MongoDB con {len(archivados)} archivos")
+
+
+class CursorNoValido(ValueError):
+    """El cursor de /listar_archivos no es uno devuelto por el listado desde MongoDB."""
+
+
+def codificar_cursor(nombre, archivo_id):
+    """
+    Codifica la posición del último archivo devuelto (nombre e ID) en un cursor opaco.
+    """
+    return base64.urlsafe_b64encode(json.dumps([nombre, archivo_id]).encode("utf-8")).decode("ascii")
+
+
+def decodificar_cursor(cursor):
+    """
+    Devuelve el (nombre, ID) codificado en un cursor de `codificar_cursor`.
+
+    Raises:
+        CursorNoValido: Si el cursor no se puede decodificar.
+    """
+    try:
+        nombre, archivo_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise CursorNoValido(f"Cursor no válido: {cursor}")
+    return nombre, archivo_id
+
+
+def listar_archivos_desde_indice(db, carpeta_id, page_size, cursor=None, todos=False):
+    """
+    Lista los archivos de una carpeta desde el índice `archivos`, ordenados por nombre e ID.
+    El cursor codifica el nombre y el ID del último archivo devuelto (paginación por clave):
+    los archivos con el mismo nombre, habituales en carpetas antiguas, se desempatan por ID.
+
+    Returns:
+        tuple: (archivos en formato de respuesta, siguiente cursor o None).
+
+    Raises:
+        CursorNoValido: Si `cursor` no es uno devuelto por este listado.
+    """
+    filtro = {"carpeta_id": carpeta_id, "eliminado": False}
+    if cursor:
+        nombre, archivo_id = decodificar_cursor(cursor)
+        filtro["$or"] = [
+            {"nombre": {"$gt": nombre}},
+            {"nombre": nombre, "_id": {"$gt": archivo_id}}
+        ]
+    consulta = db.archivos.find(
+        filtro,
+        {"nombre": 1, "tipo": 1, "link_visualizacion": 1, "link_descarga": 1}
+    ).sort([("nombre", ASCENDING), ("_id", ASCENDING)])
+    if not todos:
+        consulta = consulta.limit(page_size + 1)
+
+    documentos = list(consulta)
+    siguiente_cursor = None
+    if not todos and len(documentos) > page_size:
+        documentos = documentos[:page_size]
+        siguiente_cursor = codificar_cursor(documentos[-1].get("nombre"), documentos[-1]["_id"])
+
+    respuesta = [
+        {
+            "id": documento["_id"],
+            "nombre": documento.get("nombre"),
+            "tipo": documento.get("tipo"),
+            "link_visualizacion": documento.get("link_visualizacion"),
+            "link_descarga": documento.get("link_descarga")
+        }
+        for documento in documentos
+    ]
+    return respuesta, siguiente_cursor
+
+
+def buscar_carpeta_por_id(db, carpeta_id):
+    """
+    Devuelve el nRegistro de la carpeta con ese ID de Drive, o None si no es una carpeta de la app.
+    """
+    documento = db.subcarpetainternas.find_one({"subcarpetas_internas_id": carpeta_id}, {"nRegistro": 1}) or \
+        db.subcarpetas.find_one({"id_subcarpeta": carpeta_id}, {"nRegistro": 1})
+    return documento["nRegistro"] if documento else None
+
+
+def sincronizar_cambios_drive(servicio, db, http=None):
+    """
+    Aplica al índice `archivos` los cambios de Drive (`changes.list`) desde el último
+    page token guardado en la colección `estado_sincronizacion`.
+
+    Returns:
+        int: Número de cambios procesados.
+    """
+    estado = db.estado_sincronizacion.find_one({"_id": "drive_changes"})
+    if not estado:
+        # Primera ejecución: se empieza a seguir los cambios desde ahora
+        token = ejecutar_drive(servicio.changes().getStartPageToken(), http=http)["startPageToken"]
+        db.estado_sincronizacion.update_one({"_id": "drive_changes"}, {"$set": {"page_token": token}}, upsert=True)
+        return 0
+
+    token = estado["page_token"]
+    carpetas = {}
+    procesados = 0
+    while token:
+        respuesta = ejecutar_drive(servicio.changes().list(
+            pageToken=token,
+            pageSize=1000,
+            includeRemoved=True,
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({CAMPOS_ARCHIVO_DRIVE}, parents, trashed))"
+        ), http=http)
+
+        operaciones = []
+        for cambio in respuesta.get("changes", []):
+            archivo = cambio.get("file") or {}
+            if cambio.get("removed") or archivo.get("trashed"):
+                operaciones.append(UpdateOne({"_id": cambio["fileId"]}, {"$set": {"eliminado": True}}))
+                continue
+            if archivo.get("mimeType") == "application/vnd.google-apps.folder":
+                continue
+            for padre_id in archivo.get("parents", []):
+                if padre_id not in carpetas:
+                    carpetas[padre_id] = buscar_carpeta_por_id(db, padre_id)
+                if carpetas[padre_id]:
+                    resultado = archivo_drive_a_resultado(archivo)
+                    operaciones.append(UpdateOne(
+                        {"_id": archivo["id"]},
+                        {
+                            "$set": {
+                                "nRegistro": carpetas[padre_id],
+                                "carpeta_id": padre_id,
+                                "nombre": resultado["nombre"],
+                                "tipo": resultado["tipo"],
+                                "link_visualizacion": resultado["link_visualizacion"],
+                                "link_descarga": resultado["link_descarga"],
+                                "eliminado": False,
+                                "updated_at": datetime.now(spain_timezone)
+                            },
+                            "$setOnInsert": {"created_at": datetime.now(spain_timezone)}
+                        },
+                        upsert=True
+                    ))
+                    break
+            else:
+                # Movido fuera de las carpetas de la app: deja de listarse, como si se hubiera borrado
+                operaciones.append(UpdateOne({"_id": archivo.get("id", cambio["fileId"])}, {"$set": {"eliminado": True}}))
+        if operaciones:
+            db.archivos.bulk_write(operaciones, ordered=False)
+        procesados += len(respuesta.get("changes", []))
+
+        # Guardar el token tras cada página para no repetir trabajo si se interrumpe
+        token = respuesta.get("nextPageToken")
+        nuevo_token = token or respuesta.get("newStartPageToken")
+        db.estado_sincronizacion.update_one({"_id": "drive_changes"}, {"$set": {"page_token": nuevo_token}})
+
+    return procesados
+
+
+def reconciliador_drive():
+    """
+    Bucle del hilo en segundo plano que mantiene el índice `archivos` sincronizado con Drive.
+    """
+    while True:
+        try:
+            if db is not None:
+                procesados = sincronizar_cambios_drive(obtener_servicio_drive(), db)
+                if procesados:
+                    print(f"Reconciliador de Drive: {procesados} cambios aplicados")
+        except Exception as e:
+            print(f"Error en el reconciliador de Drive: {e}")
+        time.sleep(DRIVE_RECONCILIAR_SEGUNDOS)
+
+
+def iniciar_reconciliador():
+    """
+    Arranca el reconciliador de cambios de Drive en un hilo daemon, si está activado.
+    """
+    if DRIVE_RECONCILIAR_SEGUNDOS <= 0:
+        return None
+    hilo = threading.Thread(target=reconciliador_drive, name="reconciliador_drive", daemon=True)
+    hilo.start()
+    return hilo
+
+
+# Procesar por defecto /subir_archivos como trabajo en segundo plano
+SUBIDA_ASINCRONA = leer_booleano(os.getenv("SUBIDA_ASINCRONA", "false"))
+
+# Hilos que procesan trabajos de subida (0 = no procesar trabajos en esta instancia)
+TRABAJOS_HILOS = int(os.getenv("TRABAJOS_HILOS", "2"))
+
+# Tiempo que un hilo tiene reservado un trabajo antes de que otro pueda reintentarlo
+TRABAJOS_LEASE_SEGUNDOS = int(os.getenv("TRABAJOS_LEASE_SEGUNDOS", "600"))
+
+# Intentos máximos de un trabajo antes de marcarlo como error
+TRABAJOS_MAX_INTENTOS = int(os.getenv("TRABAJOS_MAX_INTENTOS", "3"))
+
+# Espera entre consultas cuando no hay trabajos pendientes
+TRABAJOS_ESPERA_SEGUNDOS = float(os.getenv("TRABAJOS_ESPERA_SEGUNDOS", "2"))
+
 
-    Args:
-        servicio: Objeto de servicio de Google Drive autenticado.
-        archivo: Archivo recibido en la solicitud.
-        subcarpeta_id: ID de la subcarpeta de destino.
-        nRegistro: Identificador único de la estructura.
+def crear_trabajo_subida(db, nRegistro, archivos):
+    """
+    Guarda los archivos en GridFS y crea un trabajo de subida pendiente en la colección `trabajos`,
+    de modo que cualquier instancia pueda procesarlo aunque esta se detenga.
 
     Returns:
-        dict: Datos del archivo subido (ID y nombre).
+        str: ID del trabajo.
     """
-    contador = 1
-    try:
-        # Extraer información del archivo recibido
-        nombre_archivo = archivo.filename
-        contenido_archivo = archivo.read()
-        mime_type = archivo.content_type  # Tipo MIME del archivo
+    bucket = gridfs.GridFSBucket(db, bucket_name="trabajos_archivos")
+    ahora = datetime.now(spain_timezone)
+    archivos_trabajo = []
+    for archivo in archivos:
+        gridfs_id = bucket.upload_from_stream(archivo.filename or "archivo", abrir_lector(archivo))
+        archivos_trabajo.append({
+            "nombre_original": archivo.filename,
+            "content_type": archivo.content_type,
+            "gridfs_id": gridfs_id,
+            "estado": "pendiente"
+        })
+
+    trabajo = {
+        "_id": uuid.uuid4().hex,
+        "tipo": "subir_archivos",
+        "nRegistro": nRegistro,
+        "estado": "pendiente",
+        "archivos": archivos_trabajo,
+        "intentos": 0,
+        "lease_hasta": None,
+        "created_at": ahora,
+        "updated_at": ahora
+    }
+    db.trabajos.insert_one(trabajo)
+    print(f"Trabajo de subida {trabajo['_id']} creado con {len(archivos_trabajo)} archivos")
+    return trabajo["_id"]
 
-        # Generar nombre único para el archivo
-        nombre_archivo = f"{nRegistro}-F-{contador:03}"
 
-        # Preparar el archivo para subirlo a Google Drive
-        media = MediaIoBaseUpload(io.BytesIO(contenido_archivo), mimetype=mime_type)
-        metadatos_archivo = {
-            'name': nombre_archivo,
-            'parents': [subcarpeta_id]
-        }
+def eliminar_archivos_trabajo(db, trabajo):
+    """
+    Borra de GridFS los archivos de un trabajo que ha terminado (bien o con error definitivo).
+    """
+    bucket = gridfs.GridFSBucket(db, bucket_name="trabajos_archivos")
+    for archivo in trabajo["archivos"]:
+        try:
+            bucket.delete(archivo["gridfs_id"])
+        except gridfs.errors.NoFile:
+            pass
 
-        # Subir el archivo a Google Drive
-        archivo_subido = servicio.files().create(body=metadatos_archivo, media_body=media, fields='id').execute()
-        archivo_id = archivo_subido.get('id')
-        print(f"Archivo subido: {nombre_archivo} (ID: {archivo_id})")
 
-        try:
-            pdf_con_timestamp = {
-                "id_pdf": archivo_id,
-                "created_at": datetime.now(spain_timezone)  # Usar timezone si es necesario, como spain_timezone
-            }
+def reclamar_trabajo(db):
+    """
+    Reserva de forma atómica el trabajo pendiente más antiguo (o uno cuyo lease haya caducado)
+    durante TRABAJOS_LEASE_SEGUNDOS. El trabajo reservado lleva un `propietario` nuevo: solo quien
+    lo reservó puede renovar su lease y actualizarlo.
 
-            # Actualizar en la colección "subcarpetainternas"
-            resultado = db['subcarpetas'].update_one(
-                {"nRegistro": nRegistro},  # Filtrar por nRegistro
-                {"$set": {"pdf": pdf_con_timestamp}}  # Actualizar o insertar el PDF
-            )
+    Returns:
+        dict: El trabajo reservado, o None si no hay ninguno.
+    """
+    ahora = datetime.now(spain_timezone)
+    # Los trabajos abandonados que ya agotaron sus intentos se dan por fallidos y se borran sus archivos
+    while True:
+        abandonado = db.trabajos.find_one_and_update(
+            {"estado": "en_proceso", "lease_hasta": {"$lt": ahora}, "intentos": {"$gte": TRABAJOS_MAX_INTENTOS}},
+            {"$set": {
+                "estado": "error",
+                "ultimo_error": "Lease caducado tras agotar los intentos",
+                "lease_hasta": None,
+                "updated_at": ahora
+            }}
+        )
+        if abandonado is None:
+            break
+        eliminar_archivos_trabajo(db, abandonado)
+
+    return db.trabajos.find_one_and_update(
+        {
+            "$or": [
+                {"estado": "pendiente"},
+                {"estado": "en_proceso", "lease_hasta": {"$lt": ahora}}
+            ],
+            "intentos": {"$lt": TRABAJOS_MAX_INTENTOS}
+        },
+        {
+            "$set": {
+                "estado": "en_proceso",
+                "propietario": uuid.uuid4().hex,
+                "lease_hasta": ahora + timedelta(seconds=TRABAJOS_LEASE_SEGUNDOS),
+                "updated_at": ahora
+            },
+            "$inc": {"intentos": 1}
+        },
+        sort=[("created_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
 
-            # Verificar resultado de la operación en MongoDB
+
+def mantener_lease(db, trabajo, terminado):
+    """
+    Renueva el lease de un trabajo cada tercio de TRABAJOS_LEASE_SEGUNDOS hasta que se activa
+    `terminado`, para que otro hilo no lo reclame mientras sigue en proceso (p. ej. durante una
+    clasificación larga). Se ejecuta en un hilo aparte.
+    """
+    while not terminado.wait(TRABAJOS_LEASE_SEGUNDOS / 3):
+        try:
+            ahora = datetime.now(spain_timezone)
+            resultado = db.trabajos.update_one(
+                {"_id": trabajo["_id"], "propietario": trabajo["propietario"], "estado": "en_proceso"},
+                {"$set": {"lease_hasta": ahora + timedelta(seconds=TRABAJOS_LEASE_SEGUNDOS)}}
+            )
             if resultado.matched_count == 0:
-                print(f"[ERROR] No se encontró la carpeta para nRegistro: {nRegistro}")
-            elif resultado.modified_count > 0:
-                print(f"[SUCCESS] PDF actualizado en MongoDB para nRegistro: {nRegistro}")
-            else:
-                print(f"[INFO] No se modificó el documento para nRegistro: {nRegistro}")
+                print(f"El trabajo {trabajo['_id']} ya no pertenece a este hilo: se deja de renovar su lease")
+                return
         except Exception as e:
-            print(f"Error al actualizar MongoDB: {e}")
-            return None
-
-        return {
-            'id': archivo_id,
-            'nombre': nombre_archivo
-        }
-
-    except Exception as e:
-        print(f"Error al subir el archivo '{archivo.filename}': {e}")
-        return None
+            print(f"Error al renovar el lease del trabajo {trabajo['_id']}: {e}")
 
 
-# Función para subir múltiples archivos
-def subir_multiples_archivos(servicio, archivos, subcarpetas_internas_id, nRegistro):
+def procesar_trabajo(servicio, db, trabajo):
     """
-    Sube múltiples archivos a una carpeta específica en Google Drive.
+    Procesa un trabajo de subida reservado. Solo se procesan los archivos que no se subieron
+    en un intento anterior; el progreso de cada archivo se va guardando en el trabajo.
+    Mientras se procesa, un hilo renueva su lease (`mantener_lease`). Cuando el trabajo termina,
+    bien o con un error definitivo, se borran sus archivos de GridFS.
+    """
+    bucket = gridfs.GridFSBucket(db, bucket_name="trabajos_archivos")
+    nRegistro = trabajo["nRegistro"]
+    pendientes = [(indice, archivo) for indice, archivo in enumerate(trabajo["archivos"]) if archivo["estado"] != "subido"]
+
+    def actualizar(cambios):
+        cambios["updated_at"] = datetime.now(spain_timezone)
+        db.trabajos.update_one({"_id": trabajo["_id"], "propietario": trabajo["propietario"]}, {"$set": cambios})
+
+    def terminar(estado, **cambios):
+        # Estado final y fin del lease en una sola escritura
+        actualizar(dict(cambios, estado=estado, lease_hasta=None))
+        if estado != "pendiente":
+            eliminar_archivos_trabajo(db, trabajo)
+
+    def progreso(etapa, datos):
+        cambios = {}
+        if etapa == "clasificado":
+            for (indice, _), classification in zip(pendientes, datos):
+                cambios[f"archivos.{indice}.estado"] = "clasificado"
+                cambios[f"archivos.{indice}.classification"] = classification
+        elif etapa == "subido":
+            for (indice, _), subido, nombre in zip(pendientes, datos["archivos_subidos"], datos["nombres"]):
+                if "id" in subido:
+                    cambios[f"archivos.{indice}.estado"] = "subido"
+                    cambios[f"archivos.{indice}.id"] = subido["id"]
+                    cambios[f"archivos.{indice}.nombre"] = nombre
+                else:
+                    cambios[f"archivos.{indice}.estado"] = "error"
+                    cambios[f"archivos.{indice}.error"] = subido.get("error")
+        actualizar(cambios)
 
-    Args:
-        servicio: Objeto de servicio de Google Drive autenticado.
-        archivos: Lista de archivos a subir.
-        subcarpetas_internas_id: ID de la carpeta de destino.
-        nRegistro: Nombre base proporcionado por el usuario.
+    terminado = threading.Event()
+    threading.Thread(target=mantener_lease, args=(db, trabajo, terminado), name=f"lease_{trabajo['_id']}", daemon=True).start()
+    try:
+        subcarpetas_internas_id = obtener_id_subcarpeta(db, nRegistro)
+        if not subcarpetas_internas_id:
+            # No tiene sentido reintentar: la carpeta no existe
+            terminar("error", ultimo_error=f"No se encontró la carpeta para nRegistro: {nRegistro}")
+            return
+
+        archivos = [
+            FileStorage(
+                stream=bucket.open_download_stream(archivo["gridfs_id"]),
+                filename=archivo["nombre_original"],
+                content_type=archivo["content_type"]
+            )
+            for _, archivo in pendientes
+        ]
+        _, archivos_con_error = procesar_subida(servicio, nRegistro, subcarpetas_internas_id, archivos, progreso)
 
-    Returns:
-        list: Lista de IDs de los archivos subidos.
-    """
-    resultados = []
-    # contador = 1
+        terminar("completado_con_errores" if archivos_con_error else "completado")
+        print(f"Trabajo {trabajo['_id']} terminado: {len(archivos) - len(archivos_con_error)} archivos subidos")
 
-    for archivo in archivos:
+    except Exception as e:
+        print(f"Error al procesar el trabajo {trabajo['_id']}: {e}")
         try:
-            # Extraer información del archivo recibido
-            nombre_archivo = archivo.filename
-            contenido_archivo = archivo.read()
-            mime_type = archivo.content_type  # Tipo MIME del archivo (por ejemplo, 'image/jpeg')
-
-            # Preparar el archivo para subirlo a Google Drive
-            media = MediaIoBaseUpload(io.BytesIO(contenido_archivo), mimetype=mime_type)
-            metadatos_archivo = {
-                'name': nombre_archivo,
-                'parents': [subcarpetas_internas_id]
-            }
+            terminar("pendiente" if trabajo["intentos"] < TRABAJOS_MAX_INTENTOS else "error", ultimo_error=str(e))
+        except Exception as error_estado:
+            print(f"Error al guardar el estado del trabajo {trabajo['_id']}: {error_estado}")
+    finally:
+        terminado.set()
 
-            # Subir el archivo a Google Drive
-            archivo_subido = servicio.files().create(body=metadatos_archivo, media_body=media, fields='id').execute()
-            archivo_id = archivo_subido.get('id')
-            # Guardar el resultado de la subida
-            resultados.append({
-                'id': archivo_id,
-                'nombre': nombre_archivo
-            })
-            contador += 1
 
+def trabajador_subidas():
+    """
+    Bucle de un hilo trabajador: reserva trabajos pendientes y los procesa.
+    """
+    while True:
+        try:
+            trabajo = reclamar_trabajo(db) if db is not None else None
+            if trabajo is None:
+                time.sleep(TRABAJOS_ESPERA_SEGUNDOS)
+                continue
+            procesar_trabajo(obtener_servicio_drive(), db, trabajo)
         except Exception as e:
-            print(f"Error al subir el archivo '{archivo.filename}': {e}")
-    
-    print("Subida de multiples archivos exitosa")
-    return resultados
+            print(f"Error en el trabajador de subidas: {e}")
+            time.sleep(TRABAJOS_ESPERA_SEGUNDOS)
 
 
-# Funcion de clasificador
-def classification_llava(img_bytes):
+def iniciar_trabajadores():
     """
-    Clasifica una imagen a partir de un objeto en memoria (BytesIO o bytes).
-
-    :param img_bytes: Contenido de la imagen en formato bytes o BytesIO.
-    :return: Resultado de la clasificación.
+    Arranca TRABAJOS_HILOS hilos daemon que procesan los trabajos de subida.
     """
-    # Si el input es bytes, conviértelo en BytesIO
-    if isinstance(img_bytes, bytes):
-        img_stream = BytesIO(img_bytes)
-    elif hasattr(img_bytes, "read"):
-        img_stream = img_bytes
-    else:
-        raise ValueError("El argumento img_bytes debe ser bytes o un objeto similar a BytesIO.")
+    hilos = []
+    for numero in range(TRABAJOS_HILOS):
+        hilo = threading.Thread(target=trabajador_subidas, name=f"trabajador_subidas_{numero}", daemon=True)
+        hilo.start()
+        hilos.append(hilo)
+    return hilos
 
-    # Crear el diccionario de entrada
-    input_data = {
-        "image": img_stream,
-        "prompt": prompt
-    }
 
-    events = []
-    # Realizar la clasificación con replicate
-    try:
-        for event in replicate.stream(
-            "yorickvp/llava-v1.6-mistral-7b:19be067b589d0c46689ffa7cc3ff321447a441986a7694c01225973c2eafc874",
-            input=input_data
-        ):
-            events.append(event.data)
-
-        output =  " ".join(events)
-        output = output.replace("{}","")
-        output = output.replace(" ","")
-
-        # Reemplazar 0 por "IA" y 1 por "PS"
-        if output == "0":
-            return "IA"
-        elif output == "1":
-            return "PS"
-        else:
-            raise ValueError(f"Valor inesperado en la salida: {output}")
-    
-    except Exception as e:
-        print(f"Error al procesar la imagen: {e}")
-        return {"error": str(e)}
+# Con gunicorn (gunicorn.conf.py) el arranque no se hace al importar, sino en cada worker tras el fork:
+# MongoClient y los hilos en segundo plano no sobreviven a un fork
+ARRANQUE_DIFERIDO = leer_booleano(os.getenv("ARRANQUE_DIFERIDO", "false"))
 
+# PID del proceso que ya ha hecho el arranque
+proceso_iniciado = None
 
-# Funcion de Clasificacion
-def clasificacion(archivos):
-    classifications = []
+# Precalentar credenciales y clientes en segundo plano al arrancar, para que la primera petición no los cree
+PRECALENTAR = leer_booleano(os.getenv("PRECALENTAR", "true"))
 
-    for archivo in archivos:
+# Se activa cuando termina el precalentamiento (lo usa medir_arranque.py)
+precalentamiento_terminado = threading.Event()
+
+# Duración (segundos) de cada paso del precalentamiento
+tiempos_precalentamiento = {}
+
+
+def precalentar():
+    """
+    Carga las librerías y crea los clientes que necesitará la primera petición: credenciales
+    y token de Drive, el servicio de Drive y un objeto HTTP del pool, el cliente de Replicate
+    y el clasificador.
+    Los errores solo se registran; la petición que los necesite volverá a intentarlo.
+    """
+    def medir(nombre, funcion):
+        inicio = time.monotonic()
         try:
-            # Extraer información del archivo recibido
-            nombre_archivo = archivo.filename
-            contenido_archivo = archivo.read()
-
-            # Validar si el archivo tiene contenido
-            if not contenido_archivo:
-                print(f"El archivo '{nombre_archivo}' está vacío. Saltando clasificación.")
-                classifications.append("Archivo vacío")
-                continue
+            funcion()
+        except Exception as e:
+            print(f"Precalentamiento: error en '{nombre}': {e}")
+        tiempos_precalentamiento[nombre] = time.monotonic() - inicio
 
-            # Usar una copia del archivo para clasificar
-            archivo_memoria = BytesIO(contenido_archivo)
+    def renovar_token():
+        from google_auth_httplib2 import Request as RequestHttplib2
+        import httplib2
 
-            # Clasificar la imagen utilizando el objeto en memoria
-            try:
-                classification_result = classification_llava(archivo_memoria)
-                if classification_result:
-                    classifications.append(classification_result)
+        obtener_credenciales_drive().refresh(RequestHttplib2(httplib2.Http()))
 
-                else:
-                    classifications.append("Clasificación no realizada")
+    def crear_servicio_drive():
+        obtener_servicio_drive()
+        with pool_drive.prestar():
+            pass
 
-            except Exception as e:
-                print(f"Error durante la clasificación de {nombre_archivo}: {e}")
-                classifications.append("Error durante clasificación")
-            
-            # Volver a colocar el puntero al inicio para que esté listo para la subida
-            archivo.stream.seek(0)
+    def importar_replicate():
+        obtener_cliente_replicate()
 
-        except Exception as e:
-            print(f"Error al procesar el archivo '{archivo.filename}': {e}")
-            classifications.append("Error general")
+    medir("token_drive", renovar_token)
+    medir("servicio_drive", crear_servicio_drive)
+    if CLASIFICADOR_BACKEND == "llava":
+        medir("replicate", importar_replicate)
+    medir("clasificador", obtener_clasificador)
+    if db is not None:
+        medir("mongodb", lambda: db.client.admin.command("ping"))
 
-    return classifications
+    precalentamiento_terminado.set()
+    print(f"Precalentamiento terminado: { {nombre: round(segundos, 3) for nombre, segundos in tiempos_precalentamiento.items()} }")
 
 
-# Actualizar la colección subcarpetainternas en MongoDB
-def actualizar_imagenes_en_mongo(db, nRegistro, ids_imagenes, classifications=None):
+def iniciar_proceso():
     """
-    Actualiza la colección "subcarpetainternas"  o las carpetas F/R en MongoDB con los IDs de las imágenes subidas.
-
-    Args:
-        db: Objeto de conexión a la base de datos MongoDB.
-        nRegistro: Identificador único de la estructura.
-        ids_imagenes: Lista de IDs de las imágenes subidas.
+    Conecta con MongoDB y arranca los hilos en segundo plano, una sola vez por proceso.
     """
-    try:
-         # Crear una lista de objetos con id_imagen y created_at
-        imagenes_con_timestamp = []  # Lista vacía para almacenar los resultados
-        if nRegistro.split("-")[2] == "S":
-            for indice, id_imagen in enumerate(ids_imagenes):
-                imagen_con_datos = {
-                    "id_imagen": id_imagen,
-                    "created_at": datetime.now(spain_timezone),
-                    "classification": classifications[indice]
-                }
-                imagenes_con_timestamp.append(imagen_con_datos)
-        else:
-            for id_imagen in ids_imagenes:
-                imagen_con_datos = {
-                    "id_imagen": id_imagen,
-                    "created_at": datetime.now(spain_timezone)
-                }
-                imagenes_con_timestamp.append(imagen_con_datos)
+    global proceso_iniciado
+    if proceso_iniciado == os.getpid():
+        return
+    proceso_iniciado = os.getpid()
+    # Se fija aquí y no al crear el pool: en gunicorn, los valores escritos en el proceso maestro se descartan
+    registro_metricas.pool_drive_tamano.set(pool_drive.tamano)
+    init_db()
+    iniciar_reconciliador()
+    iniciar_trabajadores()
+    if PRECALENTAR:
+        threading.Thread(target=precalentar, name="precalentamiento", daemon=True).start()
 
-        resultado = db['subcarpetainternas'].update_one(
-            {"nRegistro": nRegistro}, # Filtrar por el nombre único de la carpeta
-            {"$push": {"imagenes": {"$each": imagenes_con_timestamp}}} # Agregar imágenes a la lista
-        )
 
-        if nRegistro.split("-")[2] == "F":
-            resultado = db['subcarpetas'].update_one(
-            {"nRegistro": nRegistro}, # Filtrar por el nombre único de la carpeta
-            {"$push": {"imagenes": {"$each": imagenes_con_timestamp}}} # Agregar imágenes a la lista
-        )
+# Con `python app.py`, los procesos del pool de imágenes importan este módulo como `__mp_main__`:
+# no deben conectar con MongoDB ni arrancar hilos
+if not ARRANQUE_DIFERIDO and __name__ != "__mp_main__":
+    iniciar_proceso()
 
-        # Verificar el resultado
-        if resultado.matched_count == 0:
-            print(f"[ERROR] No se encontró la carpeta para nRegistro: {nRegistro}")
-        elif resultado.modified_count > 0:
-            print(f"[SUCCESS] Imágenes actualizadas en MongoDB para nRegistro: {nRegistro}")
-        else:
-            print(f"[INFO] No se modificó el documento para nRegistro: {nRegistro}")
+@app.errorhandler(413)
+def peticion_demasiado_grande(error):
+    return jsonify({"error": f"La petición supera el tamaño máximo permitido ({SUBIDA_MAX_BYTES} bytes)"}), 413
 
-    except Exception as e:
-        print(f"Error al actualizar imágenes en MongoDB: {e}")
 
+@app.route('/', methods=['GET'])
+def home():
+    return jsonify({"mensaje": "API activa y funcionando"}), 200
 
 
-def renombrar_archivo_drive(servicio, file_id, new_name):
-    """
-    Renombra un archivo en Google Drive utilizando su ID.
+# Segundos máximos que espera /ready la respuesta de MongoDB
+READY_PLAZO_SEGUNDOS = float(os.getenv("READY_PLAZO_SEGUNDOS", "2"))
 
-    Args:
-        servicio: Objeto autenticado del servicio de Google Drive.
-        file_id: ID del archivo que se desea renombrar.
-        new_name: Nuevo nombre que se le asignará al archivo.
 
-    Returns:
-        dict: Información del archivo renombrado (id y nombre actualizado), o None si falla.
+@app.route('/ready', methods=['GET'])
+def ready():
     """
+    Comprobación de disponibilidad: el worker solo recibe tráfico cuando MongoDB responde y tiene
+    cargadas las credenciales de Drive. `/` sigue siendo la comprobación de que el proceso está vivo.
+
+    Nunca espera por el pool de Drive: si están todos los objetos HTTP prestados, la instancia
+    está ocupada pero sana, y sigue lista.
+    """
+    comprobaciones = {"mongodb": False, "drive": False}
     try:
-        # Metadatos para actualizar el nombre del archivo
-        file_metadata = {
-            "name": new_name
-        }
+        if db is not None:
+            with plazo_mongo(READY_PLAZO_SEGUNDOS):
+                db.client.admin.command("ping")
+            comprobaciones["mongodb"] = True
+    except Exception as e:
+        print(f"Readiness: MongoDB no disponible: {e}")
+    try:
+        obtener_credenciales_drive()
+        # Con un objeto HTTP libre (o que se pueda crear) se comprueba que se crea bien
+        http = pool_drive.intentar_tomar()
+        if http is not None:
+            pool_drive.devolver(http)
+        comprobaciones["drive"] = True
+    except Exception as e:
+        print(f"Readiness: Drive no disponible: {e}")
 
-        # Llamada a la API de Google Drive para actualizar el nombre
-        archivo_renombrado = servicio.files().update(
-            fileId=file_id,
-            body=file_metadata,
-            fields="id, name"
-        ).execute()
+    listo = all(comprobaciones.values())
+    return jsonify({"listo": listo, "comprobaciones": comprobaciones}), 200 if listo else 503
 
-        print(f"Archivo renombrado: {archivo_renombrado['name']} (ID: {archivo_renombrado['id']})")
-        return {
-            "id": archivo_renombrado["id"],
-            "nombre": archivo_renombrado["name"]
-        }
 
-    except Exception as e:
-        print(f"Error al renombrar el archivo con ID {file_id}: {e}")
-        return None
 
+# Escribir en el log una línea JSON por petición con su desglose de latencia por etapas
+METRICAS_LOG_PETICIONES = leer_booleano(os.getenv("METRICAS_LOG_PETICIONES", "true"))
 
-def configurar_permisos(servicio, archivo_id):
+
+@app.before_request
+def iniciar_metricas_peticion():
     """
-    Configura los permisos para permitir que cualquier persona con el enlace tenga acceso de lectura.
+    Empieza a medir la petición; las etapas se agrupan por la ruta (`/jobs/<trabajo_id>`, no la URL).
+    """
+    g.metricas = iniciar_peticion(request.url_rule.rule if request.url_rule else "desconocido")
 
-    :param servicio: Objeto autenticado de la API de Google Drive.
-    :param archivo_id: ID del archivo o carpeta en Google Drive.
+
+def registrar_metricas_peticion(codigo):
+    contexto = g.pop("metricas", None)
+    if contexto is None:
+        return
+    desglose = terminar_peticion(contexto, request.method, codigo)
+    if METRICAS_LOG_PETICIONES and desglose["endpoint"] != "/metrics":
+        log_estructurado("peticion", **desglose)
+
+
+@app.after_request
+def terminar_metricas_peticion(response):
+    registrar_metricas_peticion(response.status_code)
+    return response
+
+
+@app.teardown_request
+def terminar_metricas_peticion_con_error(error=None):
+    # Solo llega aquí con las métricas pendientes si la vista lanzó una excepción sin respuesta
+    registrar_metricas_peticion(500)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
     """
-    try:
-        permiso = {
-            'type': 'anyone',  # Cualquiera con el enlace
-            'role': 'reader'   # Permisos de lectura
-        }
-        servicio.permissions().create(fileId=archivo_id, body=permiso).execute()
-        print(f"Permisos configurados para el archivo/carpeta: {archivo_id}")
-    except Exception as e:
-        print(f"Error al configurar permisos: {e}")
-        raise
+    Métricas en formato Prometheus: latencia, llamadas y errores por etapa y endpoint,
+    peticiones por código de respuesta y estado del pool y del limitador de Drive.
+    Con gunicorn, son la suma de todos los workers (ver gunicorn.conf.py).
+    """
+    return registro_metricas.exportar_prometheus(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
 
 
-init_db()
+@app.route('/estado_drive', methods=['GET'])
+def estado_drive():
+    """
+    Devuelve las métricas de uso del pool de objetos HTTP de Drive y del limitador de llamadas.
+    """
+    return jsonify({"pool_drive": pool_drive.estadisticas(), "limitador_drive": limitador_drive.estadisticas()}), 200
 
-@app.route('/', methods=['GET'])
-def home():
-    return jsonify({"mensaje": "API activa y funcionando"}), 200
 
+@app.route('/estado_cache', methods=['GET'])
+def estado_cache():
+    """
+    Devuelve los contadores de la caché de IDs de carpeta.
+    """
+    return jsonify({"cache_carpetas": cache_carpetas.estadisticas()}), 200
 
 
 @app.route('/crear_estructura_completa', methods=['POST'])
@@ -787,9 +2987,16 @@ def crear_estructura_endpoint():
         if not nombre_principal:
             return jsonify({"error": "Faltan parámetros requeridos o valores no válidos"}), 400
 
+        # Con IDs preasignados, Drive y MongoDB se escriben a la vez
+        ids_preasignados = request.args.get('ids_preasignados', default=DRIVE_IDS_PREASIGNADOS, type=leer_booleano)
+
         servicio = obtener_servicio_drive()
 
-        estructura_creada = crear_estructura_completa(servicio, nombre_principal, cantidad_albumes, cantidad_marcos, cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas)
+        guardado_en_mongo = None
+        if ids_preasignados:
+            estructura_creada, guardado_en_mongo = crear_estructura_concurrente(servicio, db, nombre_principal, cantidad_albumes, cantidad_marcos, cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas)
+        else:
+            estructura_creada = crear_estructura_completa(servicio, nombre_principal, cantidad_albumes, cantidad_marcos, cantidad_negativos, cantidad_diapositivas, cantidad_fotos_sueltas)
         print("Estructura creada para MongoDB:", estructura_creada)
 
         # Obtener la subcarpeta con el nombre `nRegistro + "-F"`
@@ -810,7 +3017,10 @@ def crear_estructura_endpoint():
         else:
             return jsonify({"error": "No se proporcionó un archivo para subir"}), 400
 
-        if crear_estructura_en_mongodb(db, estructura_creada):
+        if guardado_en_mongo is None:
+            guardado_en_mongo = crear_estructura_en_mongodb(db, estructura_creada)
+
+        if guardado_en_mongo:
             print("Estructura creada en MongoDB. Ahora actualizando imágenes...")
             
             # Actualizar imágenes en MongoDB
@@ -828,6 +3038,8 @@ def crear_estructura_endpoint():
                 "estructura_creada": estructura_creada
             }), 500
 
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         print(f"Error en el endpoint: {e}")
         return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
@@ -849,123 +3061,120 @@ def subir_archivos():
         if not nRegistro:
             return jsonify({"error": "Se requiere el ID de la carpeta destino"}), 400
         
-        # Iterar sobre los archivos y extraer el nombre original
-        contador = 1
-        for archivo in archivos:
-            # Cambio de nombre
-            nuevo_nombre = f"{nRegistro}-{contador:03}"
-            print(f"Nuevo nombre del archivo: {nuevo_nombre}")
-            contador += 1
-
-
-        # Inicializar classifications para evitar errores
-        classifications = []
-            # Clasificación de imágenes
-        if nRegistro.split("-")[2] == "S":
-            classifications = clasificacion(archivos)  
-
         # Obtener el ID de dicha carpeta
         subcarpetas_internas_id = obtener_id_subcarpeta(db, nRegistro)
         if not subcarpetas_internas_id:
             return jsonify({"error": f"No se encontró subcarpetas_internas_id para nRegistro: {nRegistro}"}), 404
-        
+
+        # En modo asíncrono se guardan los archivos y se procesan en segundo plano
+        asincrono = request.values.get('asincrono', default=SUBIDA_ASINCRONA, type=leer_booleano)
+        if asincrono:
+            trabajo_id = crear_trabajo_subida(db, nRegistro, archivos)
+            return jsonify({
+                "mensaje": "Archivos recibidos, la subida se procesa en segundo plano",
+                "job_id": trabajo_id,
+                "estado_url": f"/jobs/{trabajo_id}"
+            }), 202
+
         # Autenticar en Google Drive
         servicio = obtener_servicio_drive()
 
-        # Subir los archivos
-        archivos_subidos = subir_multiples_archivos(servicio, archivos, subcarpetas_internas_id, nRegistro)
-
-        # Extraer IDs y nombres de los archivos subidos para la respuesta
-        # Manejar los IDs y nombres
-        ids_y_nombres = []
-        if nRegistro.split("-")[2] == "S":
-            for indice, archivo in enumerate(archivos_subidos):
-                if isinstance(archivo, dict) and "id" in archivo and "nombre" in archivo:
-                    ids_y_nombres.append({
-                        "id": archivo["id"],
-                        "nombre": nuevo_nombre + "-" + classifications[indice]
-                    })
-                else:
-                    print(f"Archivo con formato inesperado: {archivo}")
-        else:
-            for archivo in archivos_subidos:
-                    ids_y_nombres.append({
-                        "id": archivo["id"],
-                        "nombre": nuevo_nombre
-                    })
-        
-        # Actualizar la colección subcarpetainternas en MongoDB
-        actualizar_imagenes_en_mongo(db, nRegistro, ids_y_nombres)
-
-        # Iterar sobre los archivos para renombrarlos
-        for archivo in ids_y_nombres:
-            if "id" in archivo and "nombre" in archivo:
-                try:
-                    renombrado = renombrar_archivo_drive(servicio, archivo["id"], archivo["nombre"])
-                    if renombrado:
-                        print(f"Archivo renombrado con éxito: {renombrado}")
-                    else:
-                        print(f"No se pudo renombrar el archivo con ID {archivo['id']}")
-                except Exception as e:
-                    print(f"Error al renombrar el archivo con ID {archivo['id']}: {e}")
-            else:
-                print(f"Archivo con datos incompletos: {archivo}")
+        ids_y_nombres, archivos_con_error = procesar_subida(servicio, nRegistro, subcarpetas_internas_id, archivos)
 
         return jsonify({
             "mensaje": "Archivos subidos con éxito",
-            "archivos_subidos": ids_y_nombres
+            "archivos_subidos": ids_y_nombres,
+            "archivos_con_error": archivos_con_error
 
         }), 200
         
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         print(f"Error en el endpoint: {e}")
         return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
 
 
 
+@app.route('/jobs/<trabajo_id>', methods=['GET'])
+def estado_trabajo(trabajo_id):
+    """
+    Devuelve el estado de un trabajo de subida y el progreso y la clasificación de cada archivo.
+    """
+    try:
+        if db is None:
+            return jsonify({"error": "La conexión con la base de datos no está inicializada"}), 500
+
+        trabajo = db.trabajos.find_one({"_id": trabajo_id}, {"archivos.gridfs_id": 0})
+        if not trabajo:
+            return jsonify({"error": f"No se encontró el trabajo: {trabajo_id}"}), 404
+
+        return jsonify({
+            "job_id": trabajo["_id"],
+            "nRegistro": trabajo["nRegistro"],
+            "estado": trabajo["estado"],
+            "intentos": trabajo["intentos"],
+            "ultimo_error": trabajo.get("ultimo_error"),
+            "archivos": trabajo["archivos"],
+            "created_at": trabajo["created_at"],
+            "updated_at": trabajo["updated_at"]
+        }), 200
+
+    except Exception as e:
+        print(f"Error al consultar el trabajo: {e}")
+        return jsonify({"error": f"Error interno del servidor: {str(e)}"}), 500
+
+
 @app.route('/listar_archivos', methods=['GET'])
 def listar_archivos():
     """
-    Lista los archivos de una carpeta específica en Google Drive.
+    Lista los archivos de una carpeta específica en Google Drive, por páginas.
+    Con LISTADO_DESDE_MONGO activo se responde desde el índice `archivos` de MongoDB.
+
+    Parámetros: `nRegistro`, `page_size` (por defecto LISTADO_TAMANO_PAGINA), `cursor`
+    (el `siguiente_cursor` de la respuesta anterior) y `todos` para recorrer todas las páginas.
     """
     try:
         # Obtener el ID de la carpeta desde los parámetros de la solicitud
         nRegistro = request.args.get('nRegistro')
         if not nRegistro:
             return jsonify({"error": "Se requiere el ID de la carpeta (nRegistro)"}), 400
+
+        page_size = request.args.get('page_size', default=LISTADO_TAMANO_PAGINA, type=int)
+        page_size = max(1, min(page_size, 1000))  # Máximo que admite files().list
+        cursor = request.args.get('cursor')
+        todos = request.args.get('todos', default=False, type=leer_booleano)
         
         # Obtener el ID Drive de dicha carpeta nRegistro
         subcarpetas_internas_id = obtener_id_subcarpeta(db, nRegistro)
         if not subcarpetas_internas_id:
             return jsonify({"error": f"No se encontró subcarpetas_internas_id para nRegistro: {nRegistro}"}), 404
 
-        # Obtener el servicio autenticado de Google Drive
-        servicio = obtener_servicio_drive()
+        if LISTADO_DESDE_MONGO and db is not None:
+            # Drive solo hace falta la primera vez, para compartir la carpeta y copiar su contenido al índice
+            if not carpeta_compartida(db, nRegistro):
+                asegurar_carpeta_compartida(obtener_servicio_drive(), db, nRegistro, subcarpetas_internas_id)
+            if not carpeta_indexada(db, nRegistro):
+                indexar_carpeta_desde_drive(obtener_servicio_drive(), db, nRegistro, subcarpetas_internas_id)
+            try:
+                respuesta, cursor = listar_archivos_desde_indice(db, subcarpetas_internas_id, page_size, cursor, todos)
+            except CursorNoValido as e:
+                return jsonify({"error": str(e)}), 400
+        else:
+            # Obtener el servicio autenticado de Google Drive
+            servicio = obtener_servicio_drive()
+
+            # Los archivos heredan el permiso de lectura de la carpeta: se comparte una sola vez
+            asegurar_carpeta_compartida(servicio, db, nRegistro, subcarpetas_internas_id)
 
-        # Listar los archivos dentro de la carpeta
-        resultados = servicio.files().list(
-            q=f"'{subcarpetas_internas_id}' in parents and trashed = false",
-            fields="files(id, name, mimeType, webViewLink, webContentLink)"
-        ).execute()
-
-        archivados = resultados.get('files', [])
-
-        # Estructurar la respuesta en un formato amigable para React
-        respuesta = []
-        for archivo in archivados:
-            # Configurar permisos de lectura para "anyone with the link"
-            configurar_permisos(servicio, archivo.get('id'))
-            respuesta.append({
-                "id": archivo.get('id'),
-                "nombre": archivo.get('name'),
-                "tipo": archivo.get('mimeType'),
-                "link_visualizacion": archivo.get('webViewLink'),  # Para vista previa
-                "link_descarga": archivo.get('webContentLink')  # Para descargar
-            })
+            archivados, cursor = listar_archivos_drive(servicio, subcarpetas_internas_id, page_size, cursor, todos)
+            # Estructurar la respuesta en un formato amigable para React
+            respuesta = [archivo_drive_a_resultado(archivo) for archivo in archivados]
 
         return jsonify({
             "mensaje": "Archivos listados con éxito",
             "archivos": respuesta, 
+            "siguiente_cursor": cursor,
             "success" : True
         }), 200
 
@@ -0,0 +1,501 @@
+"""
+Benchmark offline de la API: ejecuta `/crear_estructura_completa`, `/subir_archivos` y
+`/listar_archivos` con clientes concurrentes contra dobles locales, sin red ni credenciales:
+
+- Drive falso en memoria, con latencia configurable, cuota por segundo y errores de cuota
+  (403 userRateLimitExceeded / 429) inyectados con una probabilidad dada.
+- MongoDB: mongomock en memoria, o un mongod local con --mongo-uri.
+- Replicate falso: predicciones en streaming con latencia de arranque y por token configurables.
+
+Las peticiones se hacen en proceso con el cliente de pruebas de Flask, así que se mide el
+servidor sin la red. El resultado (rendimiento y latencias p50/p95/p99 por endpoint) se
+escribe como JSON.
+
+Uso:
+    python benchmark_offline.py [--clientes 8] [--lotes 10] [--subidas 30] [--fotos-por-subida 12]
+        [--listados 60] [--drive-latencia-ms 80] [--drive-cuota-por-segundo 0] [--drive-prob-cuota 0.01]
+        [--replicate-latencia-arranque-ms 800] [--replicate-latencia-token-ms 40]
+        [--mongo-uri mongodb://localhost:27017] [--salida benchmark.json] [--detalle]
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DriveFalso:
+    """
+    Doble en memoria del servicio de Drive v3 con las llamadas que usa la API.
+    Es thread-safe: un mismo objeto se comparte entre todos los servicios del pool.
+    """
+
+    def __init__(self, latencia_ms=80, cuota_por_segundo=0, prob_cuota=0.0, mbps=100):
+        self.latencia = latencia_ms / 1000
+        self.cuota_por_segundo = cuota_por_segundo
+        self.prob_cuota = prob_cuota
+        self.bytes_por_segundo = mbps * 1e6 / 8
+        self.archivos = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.ventana = (0, 0)
+        self.estadisticas = {"llamadas": {}, "lotes": 0, "errores_cuota": 0, "bytes_subidos": 0}
+
+    # --- Simulación de la red y de la cuota ---
+
+    def esperar(self, bytes_subidos=0):
+        time.sleep(self.latencia * random.uniform(0.5, 1.5) + bytes_subidos / self.bytes_por_segundo)
+
+    def comprobar_cuota(self, metodo):
+        with self.lock:
+            self.estadisticas["llamadas"][metodo] = self.estadisticas["llamadas"].get(metodo, 0) + 1
+            segundo, llamadas = self.ventana
+            ahora = int(time.monotonic())
+            llamadas = llamadas + 1 if ahora == segundo else 1
+            self.ventana = (ahora, llamadas)
+            superada = (self.cuota_por_segundo and llamadas > self.cuota_por_segundo) or random.random() < self.prob_cuota
+            if superada:
+                self.estadisticas["errores_cuota"] += 1
+        if superada:
+            raise error_cuota(random.choice([403, 429]))
+
+    # --- Recursos de la API ---
+
+    def files(self):
+        return types.SimpleNamespace(
+            create=self._crear,
+            update=self._actualizar,
+            list=self._listar,
+            generateIds=self._generar_ids,
+        )
+
+    def permissions(self):
+        return types.SimpleNamespace(create=lambda fileId, body, **_: PeticionFalsa(self, "drive.permissions.create", lambda: {"id": "anyoneWithLink"}))
+
+    def changes(self):
+        return types.SimpleNamespace(
+            getStartPageToken=lambda **_: PeticionFalsa(self, "drive.changes.getStartPageToken", lambda: {"startPageToken": "1"}),
+            list=lambda pageToken, **_: PeticionFalsa(self, "drive.changes.list", lambda: {"changes": [], "newStartPageToken": pageToken}),
+        )
+
+    def new_batch_http_request(self, callback=None):
+        return LoteFalso(self, callback)
+
+    def _nuevo_id(self):
+        return f"falso{next(self.ids)}"
+
+    def _crear(self, body, fields=None, media_body=None, **_):
+        tamano = media_body.size() if media_body is not None else 0
+
+        def crear():
+            if media_body is not None:
+                # Leer el contenido como lo haría la subida reanudable
+                media_body.getbytes(0, tamano)
+            archivo_id = body.get("id") or self._nuevo_id()
+            archivo = {
+                "id": archivo_id,
+                "name": body.get("name"),
+                "mimeType": body.get("mimeType", getattr(media_body, "mimetype", lambda: None)()),
+                "parents": body.get("parents", []),
+                "webViewLink": f"https://drive.falso/{archivo_id}/view",
+                "webContentLink": f"https://drive.falso/{archivo_id}/download",
+            }
+            with self.lock:
+                self.archivos[archivo_id] = archivo
+                self.estadisticas["bytes_subidos"] += tamano
+            return dict(archivo)
+
+        return PeticionFalsa(self, "drive.files.create", crear, tamano)
+
+    def _actualizar(self, fileId, body, **_):
+        def actualizar():
+            with self.lock:
+                archivo = self.archivos[fileId]
+                archivo.update({clave: valor for clave, valor in body.items() if clave == "name"})
+                return dict(archivo)
+
+        return PeticionFalsa(self, "drive.files.update", actualizar)
+
+    def _listar(self, q, pageSize=100, pageToken=None, **_):
+        carpeta_id = q.split("'")[1]
+
+        def listar():
+            with self.lock:
+                hijos = sorted(
+                    (dict(archivo) for archivo in self.archivos.values() if carpeta_id in archivo["parents"]),
+                    key=lambda archivo: archivo["name"] or ""
+                )
+            inicio = int(pageToken or 0)
+            respuesta = {"files": hijos[inicio:inicio + pageSize]}
+            if inicio + pageSize < len(hijos):
+                respuesta["nextPageToken"] = str(inicio + pageSize)
+            return respuesta
+
+        return PeticionFalsa(self, "drive.files.list", listar)
+
+    def _generar_ids(self, count, **_):
+        return PeticionFalsa(self, "drive.files.generateIds", lambda: {"ids": [self._nuevo_id() for _ in range(count)]})
+
+
+class PeticionFalsa:
+    """
+    Petición del Drive falso: al ejecutarse espera la latencia simulada y puede fallar por cuota.
+    """
+
+    def __init__(self, drive, metodo, funcion, bytes_subidos=0):
+        self.drive = drive
+        self.methodId = metodo
+        self.funcion = funcion
+        self.bytes_subidos = bytes_subidos
+
+    def execute(self, http=None, num_retries=0):
+        self.drive.esperar(self.bytes_subidos)
+        self.drive.comprobar_cuota(self.methodId)
+        return self.funcion()
+
+
+class LoteFalso:
+    """
+    Petición batch del Drive falso: una sola espera de red; cada petición puede fallar por cuota.
+    """
+
+    def __init__(self, drive, callback):
+        self.drive = drive
+        self.callback = callback
+        self.peticiones = []
+
+    def add(self, peticion, callback=None, request_id=None):
+        self.peticiones.append((peticion, callback or self.callback, request_id))
+
+    def execute(self, http=None):
+        self.drive.esperar()
+        with self.drive.lock:
+            self.drive.estadisticas["lotes"] += 1
+        for peticion, callback, request_id in self.peticiones:
+            try:
+                self.drive.comprobar_cuota(peticion.methodId)
+                respuesta, excepcion = peticion.funcion(), None
+            except Exception as e:
+                respuesta, excepcion = None, e
+            callback(request_id, respuesta, excepcion)
+
+
+def error_cuota(estado):
+    """
+    Crea el HttpError que devuelve Drive cuando se supera la cuota.
+    """
+    import httplib2
+    from googleapiclient.errors import HttpError
+
+    motivo = "userRateLimitExceeded" if estado == 403 else "rateLimitExceeded"
+    contenido = json.dumps({"error": {"code": estado, "errors": [{"reason": motivo}]}}).encode()
+    return HttpError(httplib2.Response({"status": estado}), contenido)
+
+
+class PrediccionFalsa:
+    """
+    Predicción de Replicate falsa: tras la latencia de arranque emite la respuesta token a token.
+    """
+
+    def __init__(self, latencia_arranque, latencia_token):
+        self.id = uuid.uuid4().hex
+        self.latencia_arranque = latencia_arranque
+        self.latencia_token = latencia_token
+        self.cancelada = threading.Event()
+        self.tokens = [" ", random.choice(["0", "1"]), "\n", "Explanation", ":", " the", " image"]
+
+    def cancel(self):
+        self.cancelada.set()
+
+    def stream(self, use_file_output=None):
+        if self.cancelada.wait(self.latencia_arranque * random.uniform(0.5, 1.5)):
+            yield evento_replicate("error", "canceled")
+            return
+        for token in self.tokens:
+            if self.cancelada.wait(self.latencia_token):
+                yield evento_replicate("error", "canceled")
+                return
+            yield evento_replicate("output", token)
+        yield evento_replicate("done", "{}")
+
+
+def evento_replicate(tipo, datos):
+    """
+    Crea un evento del stream como los del SDK de Replicate (el tipo es un enum, no un texto).
+    """
+    from replicate.stream import ServerSentEvent
+
+    return ServerSentEvent(event=ServerSentEvent.EventType(tipo), data=datos, id=uuid.uuid4().hex, retry=None)
+
+
+def crear_replicate_falso(latencia_arranque_ms, latencia_token_ms):
+    """
+    Módulo `replicate` falso con `Client(...).predictions.create`, lo que usa la API. Los eventos del stream
+    son `ServerSentEvent` reales del SDK.
+    """
+    modulo = types.ModuleType("replicate")
+    estadisticas = {"predicciones": 0, "canceladas": 0}
+
+    def crear(version=None, input=None, stream=False, **_):
+        estadisticas["predicciones"] += 1
+        if input and hasattr(input.get("image"), "read"):
+            input["image"].read()
+        prediccion = PrediccionFalsa(latencia_arranque_ms / 1000, latencia_token_ms / 1000)
+        cancelar = prediccion.cancel
+
+        def cancel():
+            estadisticas["canceladas"] += 1
+            cancelar()
+
+        prediccion.cancel = cancel
+        return prediccion
+
+    modulo.predictions = types.SimpleNamespace(create=crear)
+
+    class Cliente:
+        def __init__(self, api_token=None, timeout=None, **_):
+            self.timeout = timeout
+
+        @property
+        def predictions(self):
+            return modulo.predictions
+
+    modulo.Client = Cliente
+    modulo.estadisticas = estadisticas
+    return modulo
+
+
+def crear_imagen_base(ancho, alto):
+    """
+    Genera una foto JPEG de prueba con ruido (se comprime como una foto real, no como un color liso).
+    """
+    import numpy as np
+    from PIL import Image
+
+    generador = np.random.default_rng(0)
+    pixeles = (generador.random((alto // 8, ancho // 8, 3)) * 255).astype("uint8")
+    imagen = Image.fromarray(pixeles).resize((ancho, alto), Image.BICUBIC)
+    salida = io.BytesIO()
+    imagen.save(salida, format="JPEG", quality=90)
+    return salida.getvalue()
+
+
+def foto_unica(imagen_base):
+    """
+    Devuelve la foto base con bytes únicos tras el final del JPEG (los decodificadores los ignoran),
+    para que cada foto tenga un hash distinto y no acierte en la caché de clasificaciones.
+    """
+    return imagen_base + uuid.uuid4().bytes
+
+
+def percentil(valores_ordenados, p):
+    # Método del rango más cercano
+    indice = max(0, min(len(valores_ordenados) - 1, math.ceil(p / 100 * len(valores_ordenados)) - 1))
+    return valores_ordenados[indice]
+
+
+def resumir_fase(resultados, duracion, elementos_por_peticion=1):
+    """
+    Calcula rendimiento y latencias de una fase a partir de (latencia, código) por petición.
+    """
+    latencias = sorted(latencia for latencia, _ in resultados)
+    codigos = {}
+    for _, codigo in resultados:
+        codigos[str(codigo)] = codigos.get(str(codigo), 0) + 1
+    errores = sum(1 for _, codigo in resultados if codigo >= 400)
+    resumen = {
+        "peticiones": len(resultados),
+        "errores": errores,
+        "codigos": codigos,
+        "duracion_segundos": duracion,
+        "peticiones_por_segundo": len(resultados) / duracion if duracion else 0.0,
+        "elementos_por_segundo": len(resultados) * elementos_por_peticion / duracion if duracion else 0.0,
+    }
+    if latencias:
+        resumen["latencia_ms"] = {
+            "p50": percentil(latencias, 50) * 1000,
+            "p95": percentil(latencias, 95) * 1000,
+            "p99": percentil(latencias, 99) * 1000,
+            "media": statistics.mean(latencias) * 1000,
+            "max": latencias[-1] * 1000,
+        }
+    return resumen
+
+
+def ejecutar_fase(app, peticiones, clientes):
+    """
+    Lanza las peticiones con `clientes` hilos concurrentes.
+
+    Args:
+        peticiones: Lista de funciones que reciben un cliente de pruebas y devuelven la respuesta.
+
+    Returns:
+        tuple: (lista de (latencia, código, respuesta), duración total en segundos).
+    """
+    def ejecutar(peticion):
+        cliente = app.app.test_client()
+        inicio = time.perf_counter()
+        respuesta = peticion(cliente)
+        return time.perf_counter() - inicio, respuesta.status_code, respuesta
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clientes) as executor:
+        resultados = list(executor.map(ejecutar, peticiones))
+    return resultados, time.perf_counter() - inicio
+
+
+def preparar_entorno(args):
+    """
+    Configura la API para el benchmark antes de importarla y sustituye Drive, MongoDB y Replicate.
+    """
+    os.environ.setdefault("REPLICATE_API_TOKEN", "benchmark")
+    os.environ["ARRANQUE_DIFERIDO"] = "true"
+    os.environ["PRECALENTAR"] = "false"
+    os.environ["DRIVE_RECONCILIAR_SEGUNDOS"] = "0"
+    os.environ["TRABAJOS_HILOS"] = "0"
+    os.environ.setdefault("METRICAS_LOG_PETICIONES", "false")
+
+    replicate_falso = crear_replicate_falso(args.replicate_latencia_arranque_ms, args.replicate_latencia_token_ms)
+    # replicate.stream (ServerSentEvent) sigue siendo el del SDK: se importa antes de sustituir el paquete
+    import replicate.stream  # noqa: F401
+    sys.modules["replicate"] = replicate_falso
+
+    import app
+
+    drive = DriveFalso(args.drive_latencia_ms, args.drive_cuota_por_segundo, args.drive_prob_cuota, args.drive_mbps)
+    app.autenticar_drive = lambda: drive
+    app.crear_http_drive = lambda: object()
+
+    if args.mongo_uri:
+        from pymongo import MongoClient
+
+        nombre_bd = f"benchmark_{uuid.uuid4().hex[:8]}"
+        app.db = MongoClient(args.mongo_uri, event_listeners=[app.MonitorMongo()])[nombre_bd]
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("Instala mongomock (pip install mongomock) o indica un mongod local con --mongo-uri")
+        app.db = mongomock.MongoClient()["ProyectoUPV"]
+    try:
+        app.crear_indices(app.db)
+    except Exception as e:
+        print(f"No se pudieron crear los índices: {e}", file=sys.stderr)
+
+    return app, drive, replicate_falso
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline de la API con Drive, MongoDB y Replicate falsos.")
+    parser.add_argument("--clientes", type=int, default=8, help="Clientes concurrentes")
+    parser.add_argument("--lotes", type=int, default=10, help="Peticiones a /crear_estructura_completa")
+    parser.add_argument("--albumes", type=int, default=4)
+    parser.add_argument("--marcos", type=int, default=2)
+    parser.add_argument("--negativos", type=int, default=2)
+    parser.add_argument("--diapositivas", type=int, default=1)
+    parser.add_argument("--fotos-sueltas", type=int, default=3)
+    parser.add_argument("--subidas", type=int, default=30, help="Peticiones a /subir_archivos")
+    parser.add_argument("--fotos-por-subida", type=int, default=12)
+    parser.add_argument("--ancho-foto", type=int, default=2400)
+    parser.add_argument("--alto-foto", type=int, default=1800)
+    parser.add_argument("--listados", type=int, default=60, help="Peticiones a /listar_archivos")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--drive-latencia-ms", type=float, default=80)
+    parser.add_argument("--drive-cuota-por-segundo", type=int, default=0, help="Llamadas por segundo antes de devolver errores de cuota (0 = sin límite)")
+    parser.add_argument("--drive-prob-cuota", type=float, default=0.01, help="Probabilidad de error de cuota en cada llamada")
+    parser.add_argument("--drive-mbps", type=float, default=100, help="Ancho de banda simulado de subida a Drive")
+    parser.add_argument("--replicate-latencia-arranque-ms", type=float, default=800)
+    parser.add_argument("--replicate-latencia-token-ms", type=float, default=40)
+    parser.add_argument("--mongo-uri", help="mongod local (por defecto mongomock en memoria)")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--salida", help="Fichero JSON donde guardar los resultados")
+    parser.add_argument("--detalle", action="store_true", help="Mostrar los mensajes de la API durante el benchmark")
+    args = parser.parse_args()
+
+    random.seed(args.semilla)
+    salida_api = sys.stderr if args.detalle else io.StringIO()
+    with contextlib.redirect_stdout(salida_api):
+        app, drive, replicate_falso = preparar_entorno(args)
+        imagen_base = crear_imagen_base(args.ancho_foto, args.alto_foto)
+        pdf = b"%PDF-1.4\n" + os.urandom(200_000)
+        fases = {}
+
+        # 1. Creación de estructuras de lote
+        nombres = [f"2099-{numero:04d}" for numero in range(1, args.lotes + 1)]
+        consulta = (
+            f"cantidad_albumes={args.albumes}&cantidad_marcos={args.marcos}&cantidad_negativos={args.negativos}"
+            f"&cantidad_diapositivas={args.diapositivas}&cantidad_fotos_sueltas={args.fotos_sueltas}"
+        )
+        peticiones = [
+            (lambda nombre: lambda cliente: cliente.post(
+                f"/crear_estructura_completa?nombre_principal={nombre}&{consulta}",
+                data={"archivo": (io.BytesIO(pdf), "registro.pdf", "application/pdf")},
+                content_type="multipart/form-data",
+            ))(nombre)
+            for nombre in nombres
+        ]
+        resultados, duracion = ejecutar_fase(app, peticiones, args.clientes)
+        fases["crear_estructura_completa"] = resumir_fase([(latencia, codigo) for latencia, codigo, _ in resultados], duracion)
+
+        # 2. Subida de fotos a las subcarpetas internas S de los lotes creados
+        destinos = [
+            n_registro
+            for nombre, (_, codigo, _) in zip(nombres, resultados) if codigo < 400
+            for n_registro, _ in app.planificar_subcarpetas_internas(
+                f"{nombre}-S", "S", args.albumes, args.marcos, args.negativos, args.diapositivas, args.fotos_sueltas
+            )
+        ]
+        if not destinos:
+            sys.exit("No se creó ninguna estructura: no se pueden medir las subidas")
+        destinos_subidas = [random.choice(destinos) for _ in range(args.subidas)]
+        peticiones = [
+            (lambda destino: lambda cliente: cliente.post(
+                "/subir_archivos",
+                data={
+                    "nRegistro": destino,
+                    "archivo": [(io.BytesIO(foto_unica(imagen_base)), f"foto{indice}.jpg", "image/jpeg") for indice in range(args.fotos_por_subida)],
+                },
+                content_type="multipart/form-data",
+            ))(destino)
+            for destino in destinos_subidas
+        ]
+        resultados, duracion = ejecutar_fase(app, peticiones, args.clientes)
+        fases["subir_archivos"] = resumir_fase([(latencia, codigo) for latencia, codigo, _ in resultados], duracion, args.fotos_por_subida)
+        fotos_con_error = sum(len(respuesta.get_json().get("archivos_con_error", [])) for _, codigo, respuesta in resultados if codigo < 400)
+        fases["subir_archivos"]["fotos_con_error"] = fotos_con_error
+
+        # 3. Listado de las carpetas con fotos
+        carpetas_con_fotos = sorted(set(destinos_subidas))
+        peticiones = [
+            (lambda destino: lambda cliente: cliente.get(f"/listar_archivos?nRegistro={destino}&page_size={args.page_size}"))(random.choice(carpetas_con_fotos))
+            for _ in range(args.listados)
+        ]
+        resultados, duracion = ejecutar_fase(app, peticiones, args.clientes)
+        fases["listar_archivos"] = resumir_fase([(latencia, codigo) for latencia, codigo, _ in resultados], duracion)
+
+    informe = {
+        "configuracion": vars(args),
+        "fases": fases,
+        "drive_falso": drive.estadisticas,
+        "replicate_falso": replicate_falso.estadisticas,
+        "limitador_drive": app.limitador_drive.estadisticas(),
+        "pool_drive": app.pool_drive.estadisticas(),
+    }
+    print(json.dumps(informe, indent=2, ensure_ascii=False))
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(informe, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import hashlib
+import os
+import queue
+import threading
+
+# NumPy y Pillow se importan dentro de las funciones que los usan, como en preclasificador.py,
+# para no alargar el arranque de la API cuando se usa el clasificador de Replicate
+
+
+# Ruta del modelo ONNX (CNN que recibe imágenes NCHW y devuelve logits [N, 2] o una probabilidad [N, 1] de "PS")
+CLASIFICADOR_ONNX_MODELO = os.getenv("CLASIFICADOR_ONNX_MODELO", "modelos/clasificador.onnx")
+
+# Lado de la imagen cuadrada que espera el modelo
+CLASIFICADOR_ONNX_LADO = int(os.getenv("CLASIFICADOR_ONNX_LADO", "224"))
+
+# Imágenes por llamada al modelo y tiempo máximo (segundos) esperando a completar un lote
+CLASIFICADOR_ONNX_LOTE = int(os.getenv("CLASIFICADOR_ONNX_LOTE", "16"))
+CLASIFICADOR_ONNX_ESPERA_LOTE = float(os.getenv("CLASIFICADOR_ONNX_ESPERA_LOTE", "0.02"))
+
+# Hilos de CPU de ONNX Runtime por llamada (0 = los que decida ONNX Runtime)
+CLASIFICADOR_ONNX_HILOS = int(os.getenv("CLASIFICADOR_ONNX_HILOS", "0"))
+
+# Normalización de ImageNet, la habitual en CNN preentrenadas
+MEDIA_IMAGENET = (0.485, 0.456, 0.406)
+DESVIACION_IMAGENET = (0.229, 0.224, 0.225)
+
+# Etiqueta de cada salida del modelo
+ETIQUETAS_ONNX = ("IA", "PS")
+
+
+def preparar_entrada(imagen, lado=None):
+    """
+    Decodifica una imagen (ruta o archivo) y la convierte en la entrada del modelo:
+    matriz float32 (3, lado, lado) normalizada.
+    """
+    import numpy as np
+    from PIL import Image
+
+    lado = lado or CLASIFICADOR_ONNX_LADO
+    if hasattr(imagen, "seek"):
+        imagen.seek(0)
+    with Image.open(imagen) as img:
+        img.draft("RGB", (lado, lado))
+        img = img.convert("RGB").resize((lado, lado), Image.BILINEAR)
+        rgb = np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255.0
+    media = np.array(MEDIA_IMAGENET, dtype=np.float32).reshape(3, 1, 1)
+    desviacion = np.array(DESVIACION_IMAGENET, dtype=np.float32).reshape(3, 1, 1)
+    return (rgb - media) / desviacion
+
+
+class ClasificadorOnnx:
+    """
+    Clasificador local en CPU con ONNX Runtime. Las llamadas a `clasificar` de distintos hilos
+    se agrupan en lotes de hasta CLASIFICADOR_ONNX_LOTE imágenes, que se pasan al modelo de una vez.
+    """
+
+    def __init__(self, ruta_modelo=None, tamano_lote=None, espera_lote=None):
+        # Dependencia opcional: solo hace falta si se usa este clasificador
+        import onnxruntime
+
+        self.ruta_modelo = ruta_modelo or CLASIFICADOR_ONNX_MODELO
+        self.tamano_lote = tamano_lote or CLASIFICADOR_ONNX_LOTE
+        self.espera_lote = CLASIFICADOR_ONNX_ESPERA_LOTE if espera_lote is None else espera_lote
+        # Con tantas clasificaciones en paralelo como imágenes por lote se llenan los lotes
+        self.concurrencia = self.tamano_lote
+
+        opciones = onnxruntime.SessionOptions()
+        if CLASIFICADOR_ONNX_HILOS > 0:
+            opciones.intra_op_num_threads = CLASIFICADOR_ONNX_HILOS
+        self.sesion = onnxruntime.InferenceSession(self.ruta_modelo, opciones, providers=["CPUExecutionProvider"])
+        self.nombre_entrada = self.sesion.get_inputs()[0].name
+
+        with open(self.ruta_modelo, "rb") as f:
+            self.version = f"onnx:{hashlib.sha256(f.read()).hexdigest()}"
+
+        self.pendientes = queue.Queue()
+        threading.Thread(target=self._agrupar_lotes, daemon=True).start()
+        print(f"Clasificador ONNX cargado desde {self.ruta_modelo} (lote {self.tamano_lote})")
+
+    def clasificar_lote(self, imagenes):
+        """
+        Clasifica varias imágenes con una sola llamada al modelo.
+
+        Args:
+            imagenes: Lista de rutas o archivos con las imágenes.
+
+        Returns:
+            list: "IA" o "PS" por imagen, en el mismo orden.
+        """
+        import numpy as np
+
+        if not imagenes:
+            return []
+        entrada = np.stack([preparar_entrada(imagen) for imagen in imagenes])
+        salida = self.sesion.run(None, {self.nombre_entrada: entrada})[0]
+        salida = np.asarray(salida, dtype=np.float32).reshape(len(imagenes), -1)
+        if salida.shape[1] == 1:
+            indices = (salida[:, 0] >= 0.5).astype(int)
+        else:
+            indices = salida.argmax(axis=1)
+        return [ETIQUETAS_ONNX[indice] for indice in indices]
+
+    def clasificar(self, imagen, nombre_archivo=""):
+        """
+        Clasifica una imagen. La petición se une al siguiente lote y espera su resultado.
+        """
+        pendiente = {"imagen": imagen, "hecho": threading.Event()}
+        self.pendientes.put(pendiente)
+        pendiente["hecho"].wait()
+        if "error" in pendiente:
+            raise pendiente["error"]
+        return pendiente["resultado"]
+
+    def _agrupar_lotes(self):
+        """
+        Hilo que recoge las imágenes pendientes en lotes y las clasifica.
+        """
+        while True:
+            lote = [self.pendientes.get()]
+            try:
+                while len(lote) < self.tamano_lote:
+                    lote.append(self.pendientes.get(timeout=self.espera_lote))
+            except queue.Empty:
+                pass
+
+            try:
+                resultados = self.clasificar_lote([pendiente["imagen"] for pendiente in lote])
+                for pendiente, resultado in zip(lote, resultados):
+                    pendiente["resultado"] = resultado
+            except Exception as e:
+                # Una imagen que no se puede decodificar no debe hacer fallar al resto del lote
+                print(f"Error al clasificar un lote de {len(lote)} imágenes con ONNX, se reintentan una a una: {e}")
+                for pendiente in lote:
+                    try:
+                        pendiente["resultado"] = self.clasificar_lote([pendiente["imagen"]])[0]
+                    except Exception as error_imagen:
+                        pendiente["error"] = error_imagen
+            finally:
+                for pendiente in lote:
+                    pendiente["hecho"].set()
@@ -0,0 +1,154 @@
+"""
+Evalúa el preclasificador local contra las clasificaciones de LLaVA de un conjunto etiquetado.
+
+El conjunto se describe con un CSV con columnas `archivo,etiqueta`, donde `etiqueta` es la
+clasificación de LLaVA ("IA" o "PS") y `archivo` es la ruta de la imagen (relativa a --directorio).
+
+A cada foto limpia ("IA") se le añaden copias con margen (blanco, crema y negro, como las copias
+en papel con borde), que tienen que seguir sin clasificarse como "PS"; se evalúan también por separado.
+
+Uso:
+    python evaluar_preclasificador.py --etiquetas etiquetas.csv --directorio fotos/ [--umbral-ia 0.02]
+        [--umbral-ps 0.35] [--barrido] [--sin-margenes] [--salida resultados.json]
+"""
+import argparse
+import csv
+import json
+import os
+
+from preclasificador import (
+    PRECLASIFICADOR_UMBRAL_IA,
+    PRECLASIFICADOR_UMBRAL_PS,
+    calcular_rasgos,
+    cargar_reducida,
+    decidir,
+    puntuacion_dano,
+)
+
+
+# Márgenes que se añaden a las fotos limpias: fracción de cada lado y color RGB
+MARGENES = {
+    "blanco": (0.06, (1.0, 1.0, 1.0)),
+    "crema": (0.10, (0.95, 0.93, 0.88)),
+    "negro": (0.04, (0.05, 0.05, 0.05)),
+}
+
+
+def con_margen(rgb, fraccion, color):
+    """
+    Devuelve la imagen con un margen liso de `color` que ocupa `fraccion` de cada lado.
+    """
+    import numpy as np
+
+    alto, ancho = rgb.shape[:2]
+    margen_y, margen_x = int(alto * fraccion), int(ancho * fraccion)
+    copia = np.empty((alto + 2 * margen_y, ancho + 2 * margen_x, 3), dtype=rgb.dtype)
+    copia[:] = color
+    copia[margen_y:margen_y + alto, margen_x:margen_x + ancho] = rgb
+    return copia
+
+
+def crear_muestra(archivo, etiqueta, rasgos, margen=None):
+    return {
+        "archivo": archivo,
+        "etiqueta": etiqueta,
+        "margen": margen,
+        "puntuacion": puntuacion_dano(rasgos),
+        "rasgos": rasgos,
+    }
+
+
+def cargar_conjunto(ruta_etiquetas, directorio, margenes=True):
+    """
+    Lee el CSV de etiquetas y calcula la puntuación de daño de cada imagen. Con `margenes`,
+    añade además una copia de cada foto limpia con cada uno de los MARGENES.
+
+    Returns:
+        list: Diccionarios con archivo, etiqueta, margen (None en las originales), puntuación y rasgos.
+    """
+    muestras = []
+    with open(ruta_etiquetas, newline="", encoding="utf-8") as f:
+        for fila in csv.DictReader(f):
+            ruta = os.path.join(directorio, fila["archivo"])
+            etiqueta = fila["etiqueta"].strip().upper()
+            try:
+                rgb = cargar_reducida(ruta)
+            except Exception as e:
+                print(f"No se pudo procesar {ruta}: {e}")
+                continue
+            muestras.append(crear_muestra(fila["archivo"], etiqueta, calcular_rasgos(rgb)))
+            if margenes and etiqueta == "IA":
+                for nombre, (fraccion, color) in MARGENES.items():
+                    rasgos = calcular_rasgos(con_margen(rgb, fraccion, color))
+                    muestras.append(crear_muestra(f"{fila['archivo']} [margen {nombre}]", etiqueta, rasgos, nombre))
+    return muestras
+
+
+def evaluar(muestras, umbral_ia, umbral_ps):
+    """
+    Calcula la cobertura (fotos decididas sin LLaVA) y el acuerdo con LLaVA para unos umbrales.
+
+    Returns:
+        dict: Métricas de la evaluación.
+    """
+    confusion = {"IA": {"IA": 0, "PS": 0}, "PS": {"IA": 0, "PS": 0}}
+    decididas = 0
+    for muestra in muestras:
+        local, _ = decidir(muestra["rasgos"], umbral_ia, umbral_ps)
+        if local is None:
+            continue
+        decididas += 1
+        if muestra["etiqueta"] in confusion:
+            confusion[local][muestra["etiqueta"]] += 1
+
+    aciertos = confusion["IA"]["IA"] + confusion["PS"]["PS"]
+    return {
+        "umbral_ia": umbral_ia,
+        "umbral_ps": umbral_ps,
+        "total": len(muestras),
+        "decididas_localmente": decididas,
+        "cobertura": decididas / len(muestras) if muestras else 0.0,
+        "acuerdo_con_llava": aciertos / decididas if decididas else None,
+        "confusion_local_vs_llava": confusion,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evalúa el preclasificador local frente a LLaVA.")
+    parser.add_argument("--etiquetas", required=True, help="CSV con columnas archivo,etiqueta")
+    parser.add_argument("--directorio", default=".", help="Directorio base de las imágenes")
+    parser.add_argument("--umbral-ia", type=float, default=PRECLASIFICADOR_UMBRAL_IA)
+    parser.add_argument("--umbral-ps", type=float, default=PRECLASIFICADOR_UMBRAL_PS)
+    parser.add_argument("--barrido", action="store_true", help="Evaluar también una rejilla de umbrales")
+    parser.add_argument("--sin-margenes", action="store_true", help="No añadir copias con margen de las fotos limpias")
+    parser.add_argument("--salida", help="Fichero JSON donde guardar los resultados")
+    args = parser.parse_args()
+
+    muestras = cargar_conjunto(args.etiquetas, args.directorio, margenes=not args.sin_margenes)
+    resultados = {"evaluacion": evaluar(muestras, args.umbral_ia, args.umbral_ps)}
+    con_margenes = [muestra for muestra in muestras if muestra["margen"]]
+    if con_margenes:
+        # Solo las copias limpias con margen: ninguna debería acabar en "PS"
+        resultados["evaluacion_margenes"] = evaluar(con_margenes, args.umbral_ia, args.umbral_ps)
+
+    if args.barrido and muestras:
+        # Umbrales candidatos: cuantiles de las puntuaciones observadas
+        puntuaciones = sorted(muestra["puntuacion"] for muestra in muestras)
+        cuantiles = [puntuaciones[int(q * (len(puntuaciones) - 1))] for q in (0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.8, 0.9, 0.95)]
+        resultados["barrido"] = [
+            evaluar(muestras, umbral_ia, umbral_ps)
+            for umbral_ia in cuantiles
+            for umbral_ps in cuantiles
+            if umbral_ps > umbral_ia
+        ]
+
+    print(json.dumps({clave: resultados[clave] for clave in ("evaluacion", "evaluacion_margenes") if clave in resultados}, indent=2, ensure_ascii=False))
+    if args.salida:
+        resultados["muestras"] = muestras
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Configuración de gunicorn para producción.
+
+La app se carga una vez en el proceso maestro (preload_app) y cada worker, tras el fork,
+conecta con MongoDB y arranca sus hilos en segundo plano (`iniciar_proceso`). El trabajo
+es de entrada/salida (Drive, MongoDB, Replicate), así que se usan pocos procesos con muchos hilos.
+
+Uso:
+    gunicorn -c gunicorn.conf.py app:app
+"""
+import os
+import shutil
+
+# La app no debe conectar con MongoDB al importarse en el proceso maestro
+os.environ.setdefault("ARRANQUE_DIFERIDO", "true")
+
+# Directorio donde cada worker escribe sus métricas, para que /metrics devuelva las de todos.
+# Tiene que estar definido antes de que la app importe prometheus_client
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/tripulaciones_metricas")
+os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# Puerto que asigna Cloud Run
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# Procesos y hilos por proceso (workers gthread)
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_HILOS", "16"))
+worker_class = "gthread"
+
+# Las subidas de lotes grandes pueden tardar minutos
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "600"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "75"))
+
+preload_app = True
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    """
+    Borra las métricas de una ejecución anterior.
+    """
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def post_fork(server, worker):
+    """
+    Crea en cada worker el cliente de MongoDB y los hilos en segundo plano.
+    """
+    import app
+
+    app.iniciar_proceso()
+    server.log.info(f"Worker {worker.pid} iniciado")
+
+
+def child_exit(server, worker):
+    """
+    Deja de sumar los indicadores (gauges) de un worker que ha terminado; sus contadores se conservan.
+    """
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
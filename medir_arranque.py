@@ -0,0 +1,245 @@
+"""
+Mide el arranque en frío de la API: tiempo de importación de `app`, latencia de la primera
+petición a `/` y a `/ready`, y duración del precalentamiento. Cada repetición se hace en un
+proceso nuevo, como un arranque de una instancia de Cloud Run.
+
+Con `--listado` mide además la primera y la segunda petición a `/listar_archivos`, que necesita
+Drive, usando Drive, MongoDB y Replicate falsos (benchmark_offline.py): no hacen falta credenciales.
+El cliente de Drive conserva su coste de arranque real (importaciones y construcción del servicio)
+y el token se simula con `--drive-latencia-token-ms`. Para comparar el arranque en frío con el
+precalentado:
+
+    python medir_arranque.py --listado --sin-precalentar
+    python medir_arranque.py --listado --esperar-precalentamiento
+
+Uso:
+    python medir_arranque.py [--repeticiones 5] [--sin-precalentar] [--esperar-precalentamiento]
+        [--listado] [--drive-latencia-ms 80] [--drive-latencia-token-ms 150]
+        [--importaciones 15] [--salida arranque.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import types
+
+
+# nRegistro y carpeta que se listan con --listado, y archivos que contiene
+NREGISTRO_LISTADO = "LOTE0001-001-F"
+CARPETA_LISTADO = "carpeta_medicion"
+ARCHIVOS_LISTADO = 50
+
+
+class CredencialesFalsas:
+    """
+    Credenciales de la cuenta de servicio que tardan `latencia` segundos en obtener el token,
+    como la primera petición a oauth2.googleapis.com.
+    """
+
+    def __init__(self, latencia):
+        self.latencia = latencia
+        self.valid = False
+        self.lock = threading.Lock()
+
+    def refresh(self, request):
+        with self.lock:
+            if not self.valid:
+                time.sleep(self.latencia)
+                self.valid = True
+
+
+def preparar_drive_falso(app, latencia_ms, latencia_token_ms):
+    """
+    Sustituye Drive, MongoDB y Replicate por los de benchmark_offline.py, conservando el coste de
+    arranque real del cliente de Drive (importar google-api-python-client y construir el servicio
+    desde el documento de descubrimiento), y crea la carpeta que se lista.
+    """
+    import benchmark_offline
+
+    argumentos = types.SimpleNamespace(
+        replicate_latencia_arranque_ms=0,
+        replicate_latencia_token_ms=0,
+        drive_latencia_ms=latencia_ms,
+        drive_cuota_por_segundo=0,
+        drive_prob_cuota=0.0,
+        drive_mbps=100,
+        mongo_uri=None,
+    )
+    _, drive, _ = benchmark_offline.preparar_entorno(argumentos)
+    credenciales = CredencialesFalsas(latencia_token_ms / 1000)
+
+    def crear_http_drive():
+        from google_auth_httplib2 import AuthorizedHttp
+        import httplib2
+
+        # El token se obtiene con el primer objeto HTTP, que se crea en la primera llamada a Drive
+        credenciales.refresh(None)
+        return AuthorizedHttp(credenciales, http=httplib2.Http())
+
+    def autenticar_drive():
+        from googleapiclient.discovery import build_from_document
+
+        build_from_document(app.obtener_documento_drive(), http=crear_http_drive())
+        return drive
+
+    app.obtener_credenciales_drive = lambda: credenciales
+    app.crear_http_drive = crear_http_drive
+    app.autenticar_drive = autenticar_drive
+
+    app.db.subcarpetainternas.insert_one({
+        "nRegistro": NREGISTRO_LISTADO, "subcarpetas_internas_id": CARPETA_LISTADO, "compartida": True
+    })
+    for numero in range(1, ARCHIVOS_LISTADO + 1):
+        archivo_id = f"{NREGISTRO_LISTADO}-{numero:03}"
+        drive.archivos[archivo_id] = {
+            "id": archivo_id, "name": archivo_id, "mimeType": "image/jpeg", "parents": [CARPETA_LISTADO]
+        }
+    return drive
+
+
+# Código que se ejecuta en cada proceso medido
+MEDICION = r"""
+import json, sys, threading, time
+config = json.loads(CONFIG)
+inicio = time.perf_counter()
+import app
+importacion = time.perf_counter() - inicio
+
+if config["listado"]:
+    import medir_arranque
+    medir_arranque.preparar_drive_falso(app, config["drive_latencia_ms"], config["drive_latencia_token_ms"])
+    # Lo que haría iniciar_proceso, sin init_db: MongoDB es mongomock
+    if app.PRECALENTAR:
+        threading.Thread(target=app.precalentar, name="precalentamiento", daemon=True).start()
+
+if config["esperar_precalentamiento"] and app.PRECALENTAR:
+    app.precalentamiento_terminado.wait(60)
+
+cliente = app.app.test_client()
+inicio = time.perf_counter()
+respuesta_raiz = cliente.get("/")
+primera_peticion = time.perf_counter() - inicio
+
+# Antes que /ready, que ya tomaría un objeto HTTP de Drive
+listado = {}
+for clave in ("primera_listado_segundos", "segunda_listado_segundos") if config["listado"] else ():
+    inicio = time.perf_counter()
+    respuesta_listado = cliente.get("/listar_archivos", query_string={"nRegistro": medir_arranque.NREGISTRO_LISTADO})
+    listado[clave] = time.perf_counter() - inicio
+    listado["estado_listado"] = respuesta_listado.status_code
+
+inicio = time.perf_counter()
+respuesta_ready = cliente.get("/ready")
+primera_ready = time.perf_counter() - inicio
+
+# Una sola escritura, para que no se mezcle con los mensajes de otros hilos
+sys.stdout.write("\nRESULTADO " + json.dumps({
+    "importacion_segundos": importacion,
+    "primera_peticion_segundos": primera_peticion,
+    "primera_ready_segundos": primera_ready,
+    "estado_raiz": respuesta_raiz.status_code,
+    "estado_ready": respuesta_ready.status_code,
+    "precalentamiento": app.tiempos_precalentamiento,
+    **listado,
+}) + "\n")
+"""
+
+
+def medir_una_vez(config, entorno):
+    """
+    Arranca un proceso Python nuevo y devuelve sus mediciones.
+    """
+    codigo = MEDICION.replace("CONFIG", repr(json.dumps(config)))
+    salida = subprocess.run([sys.executable, "-c", codigo], capture_output=True, text=True, env=entorno)
+    for linea in salida.stdout.splitlines():
+        if linea.startswith("RESULTADO "):
+            return json.JSONDecoder().raw_decode(linea[len("RESULTADO "):])[0]
+    raise RuntimeError(f"La medición falló:\n{salida.stdout}\n{salida.stderr}")
+
+
+def importaciones_mas_lentas(cantidad, entorno):
+    """
+    Devuelve los módulos que más tardan en importarse al importar `app` (`python -X importtime`).
+    """
+    salida = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], capture_output=True, text=True, env=entorno)
+    modulos = []
+    for linea in salida.stderr.splitlines():
+        if not linea.startswith("import time:") or "cumulative" in linea:
+            continue
+        _, acumulado, nombre = linea[len("import time:"):].split("|")
+        # Solo `app` y lo que importa directamente (sangría de 1 o 3 espacios): el tiempo acumulado
+        # de cada uno incluye el de sus dependencias
+        sangria = len(nombre) - len(nombre.lstrip(" "))
+        if sangria <= 3:
+            modulos.append({"modulo": nombre.strip(), "acumulado_segundos": int(acumulado) / 1e6})
+    return sorted(modulos, key=lambda modulo: modulo["acumulado_segundos"], reverse=True)[:cantidad]
+
+
+def resumir(valores):
+    return {
+        "mediana": statistics.median(valores),
+        "minimo": min(valores),
+        "maximo": max(valores),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide el arranque en frío de la API.")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--sin-precalentar", action="store_true", help="Desactivar el precalentamiento (PRECALENTAR=false)")
+    parser.add_argument("--esperar-precalentamiento", action="store_true", help="Medir la primera petición cuando ya ha terminado el precalentamiento")
+    parser.add_argument("--listado", action="store_true", help="Medir también /listar_archivos con Drive, MongoDB y Replicate falsos")
+    parser.add_argument("--drive-latencia-ms", type=float, default=80, help="Latencia simulada de cada llamada a Drive (--listado)")
+    parser.add_argument("--drive-latencia-token-ms", type=float, default=150, help="Latencia simulada al obtener el token de Drive (--listado)")
+    parser.add_argument("--importaciones", type=int, default=15, help="Módulos más lentos a mostrar (0 para no medirlos)")
+    parser.add_argument("--salida", help="Fichero JSON donde guardar los resultados")
+    args = parser.parse_args()
+
+    entorno = dict(os.environ)
+    if args.sin_precalentar:
+        entorno["PRECALENTAR"] = "false"
+    if args.listado:
+        # Sin MongoDB ni hilos en segundo plano reales, y listando desde Drive en cada petición
+        entorno.setdefault("REPLICATE_API_TOKEN", "medicion")
+        entorno.update({
+            "ARRANQUE_DIFERIDO": "true",
+            "DRIVE_RECONCILIAR_SEGUNDOS": "0",
+            "TRABAJOS_HILOS": "0",
+            "LISTADO_DESDE_MONGO": "false",
+            "METRICAS_LOG_PETICIONES": "false",
+        })
+
+    config = {
+        "esperar_precalentamiento": args.esperar_precalentamiento,
+        "listado": args.listado,
+        "drive_latencia_ms": args.drive_latencia_ms,
+        "drive_latencia_token_ms": args.drive_latencia_token_ms,
+    }
+    mediciones = [medir_una_vez(config, entorno) for _ in range(args.repeticiones)]
+    resultados = {
+        "repeticiones": args.repeticiones,
+        "precalentamiento": not args.sin_precalentar,
+        "importacion_segundos": resumir([m["importacion_segundos"] for m in mediciones]),
+        "primera_peticion_segundos": resumir([m["primera_peticion_segundos"] for m in mediciones]),
+        "primera_ready_segundos": resumir([m["primera_ready_segundos"] for m in mediciones]),
+        "mediciones": mediciones,
+    }
+    if args.listado:
+        resultados["primera_listado_segundos"] = resumir([m["primera_listado_segundos"] for m in mediciones])
+        resultados["segunda_listado_segundos"] = resumir([m["segunda_listado_segundos"] for m in mediciones])
+    if args.importaciones:
+        resultados["importaciones_mas_lentas"] = importaciones_mas_lentas(args.importaciones, entorno)
+
+    print(json.dumps(resultados, indent=2, ensure_ascii=False))
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+        print(f"Resultados guardados en {args.salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+
+# Límites (segundos) de los buckets de los histogramas de latencia
+BUCKETS_LATENCIA = tuple(
+    float(limite) for limite in os.getenv(
+        "METRICAS_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60"
+    ).split(",")
+)
+
+# Prefijo de los nombres de las métricas exportadas
+PREFIJO_METRICAS = "tripulaciones"
+
+# Endpoint con el que se registran las etapas ejecutadas fuera de una petición (hilos en segundo plano)
+ENDPOINT_SEGUNDO_PLANO = "segundo_plano"
+
+# Petición en curso: endpoint y desglose de etapas. Los hilos auxiliares lo heredan con `en_contexto`
+contexto_peticion = contextvars.ContextVar("contexto_peticion", default=None)
+
+
+class RegistroMetricas:
+    """
+    Latencias, llamadas y errores por etapa (llamada a Drive, MongoDB, Replicate, clasificación...)
+    y por endpoint, latencia y códigos de respuesta de las peticiones, y estado del pool y del
+    limitador de Drive.
+
+    Con PROMETHEUS_MULTIPROC_DIR definida (la define gunicorn.conf.py), cada worker de gunicorn escribe
+    sus valores en ese directorio y `exportar_prometheus` devuelve la suma de todos los workers, sea cual
+    sea el que atiende /metrics. Sin ella, las métricas son las del proceso actual.
+    """
+
+    def __init__(self):
+        self.registro = CollectorRegistry()
+        self.etapas = Histogram(
+            f"{PREFIJO_METRICAS}_etapa_segundos", "Latencia de cada etapa (Drive, MongoDB, Replicate, clasificación)",
+            ("etapa", "endpoint"), buckets=BUCKETS_LATENCIA, registry=self.registro
+        )
+        self.errores_etapas = Counter(
+            f"{PREFIJO_METRICAS}_etapa_errores", "Llamadas con error por etapa",
+            ("etapa", "endpoint"), registry=self.registro
+        )
+        self.peticiones = Histogram(
+            f"{PREFIJO_METRICAS}_peticion_segundos", "Latencia de las peticiones HTTP",
+            ("endpoint", "metodo"), buckets=BUCKETS_LATENCIA, registry=self.registro
+        )
+        self.respuestas = Counter(
+            f"{PREFIJO_METRICAS}_peticiones", "Peticiones HTTP por código de respuesta",
+            ("endpoint", "metodo", "codigo"), registry=self.registro
+        )
+
+        # Drive: contadores y estado actual (suma de los workers vivos)
+        self.drive_reintentos = Counter(
+            f"{PREFIJO_METRICAS}_drive_reintentos", "Llamadas a Drive reintentadas", registry=self.registro
+        )
+        self.drive_limitadas = Counter(
+            f"{PREFIJO_METRICAS}_drive_limitadas", "Errores de cuota devueltos por Drive", registry=self.registro
+        )
+        self.drive_tasa = Gauge(
+            f"{PREFIJO_METRICAS}_drive_tasa_llamadas_por_segundo", "Tasa permitida por el limitador de Drive (0 = sin límite)",
+            registry=self.registro, multiprocess_mode="livesum"
+        )
+        self.pool_drive_esperas = Counter(
+            f"{PREFIJO_METRICAS}_pool_drive_esperas", "Préstamos del pool de Drive que tuvieron que esperar", registry=self.registro
+        )
+        self.pool_drive_en_uso = Gauge(
+            f"{PREFIJO_METRICAS}_pool_drive_en_uso", "Objetos HTTP de Drive prestados",
+            registry=self.registro, multiprocess_mode="livesum"
+        )
+        self.pool_drive_creados = Gauge(
+            f"{PREFIJO_METRICAS}_pool_drive_creados", "Objetos HTTP de Drive creados",
+            registry=self.registro, multiprocess_mode="livesum"
+        )
+        self.pool_drive_tamano = Gauge(
+            f"{PREFIJO_METRICAS}_pool_drive_tamano", "Tamaño máximo del pool de Drive",
+            registry=self.registro, multiprocess_mode="livesum"
+        )
+
+    def observar_etapa(self, etapa, endpoint, segundos, error=False):
+        self.etapas.labels(etapa, endpoint).observe(segundos)
+        if error:
+            self.errores_etapas.labels(etapa, endpoint).inc()
+
+    def observar_peticion(self, endpoint, metodo, codigo, segundos):
+        self.peticiones.labels(endpoint, metodo).observe(segundos)
+        self.respuestas.labels(endpoint, metodo, str(codigo)).inc()
+
+    def exportar_prometheus(self):
+        """
+        Devuelve las métricas en el formato de texto de Prometheus.
+        """
+        if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+            registro = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registro)
+        else:
+            registro = self.registro
+        return generate_latest(registro)
+
+
+registro_metricas = RegistroMetricas()
+
+
+def iniciar_peticion(endpoint):
+    """
+    Marca el inicio de una petición: a partir de aquí las etapas se registran con su endpoint.
+
+    Returns:
+        dict: Contexto de la petición, que se pasa a `terminar_peticion`.
+    """
+    contexto = {"endpoint": endpoint, "inicio": time.perf_counter(), "etapas": {}, "lock": threading.Lock()}
+    contexto["token"] = contexto_peticion.set(contexto)
+    return contexto
+
+
+def terminar_peticion(contexto, metodo, codigo):
+    """
+    Registra la latencia de la petición y devuelve su desglose por etapas, listo para el log.
+    """
+    segundos = time.perf_counter() - contexto["inicio"]
+    contexto_peticion.reset(contexto["token"])
+    registro_metricas.observar_peticion(contexto["endpoint"], metodo, codigo, segundos)
+    with contexto["lock"]:
+        etapas = {
+            etapa: {"llamadas": datos["llamadas"], "errores": datos["errores"], "ms": round(datos["segundos"] * 1000, 1)}
+            for etapa, datos in contexto["etapas"].items()
+        }
+    return {
+        "endpoint": contexto["endpoint"],
+        "metodo": metodo,
+        "codigo": codigo,
+        "ms": round(segundos * 1000, 1),
+        "etapas": etapas,
+    }
+
+
+def registrar_etapa(etapa, segundos, error=False):
+    """
+    Registra una etapa ya medida con el endpoint de la petición en curso.
+    """
+    contexto = contexto_peticion.get()
+    endpoint = contexto["endpoint"] if contexto else ENDPOINT_SEGUNDO_PLANO
+    registro_metricas.observar_etapa(etapa, endpoint, segundos, error)
+    if contexto:
+        with contexto["lock"]:
+            datos = contexto["etapas"].setdefault(etapa, {"llamadas": 0, "errores": 0, "segundos": 0.0})
+            datos["llamadas"] += 1
+            datos["errores"] += int(error)
+            datos["segundos"] += segundos
+
+
+@contextmanager
+def medir_etapa(etapa):
+    """
+    Mide la duración de un bloque `with` y la registra como `etapa`; si el bloque lanza
+    una excepción, la llamada cuenta como error.
+    """
+    inicio = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        registrar_etapa(etapa, time.perf_counter() - inicio, error)
+
+
+def en_contexto(funcion):
+    """
+    Envuelve `funcion` para ejecutarla en otro hilo con el contexto de la petición actual,
+    de modo que sus etapas cuenten para el mismo endpoint y el mismo desglose.
+    """
+    contexto = contextvars.copy_context()
+
+    def ejecutar(*args, **kwargs):
+        # Una copia por llamada: un mismo Context no puede estar activo en dos hilos a la vez
+        return contexto.copy().run(funcion, *args, **kwargs)
+
+    return ejecutar
+
+
+def log_estructurado(evento, **campos):
+    """
+    Escribe una línea de log JSON (una por evento) para poder filtrarla y agregarla.
+    """
+    print(json.dumps({"evento": evento, **campos}, ensure_ascii=False, default=str))
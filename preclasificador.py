@@ -0,0 +1,219 @@
+import os
+from io import BytesIO
+
+# NumPy y Pillow se importan dentro de las funciones que los usan: importarlos aquí alarga el arranque
+# en frío de la API aunque la petición no procese ninguna imagen
+
+
+# Lado máximo de la imagen reducida sobre la que se calculan los rasgos
+PRECLASIFICADOR_LADO = int(os.getenv("PRECLASIFICADOR_LADO", "256"))
+
+# Por debajo de esta puntuación de daño la foto se clasifica como "IA" sin llamar a LLaVA
+PRECLASIFICADOR_UMBRAL_IA = float(os.getenv("PRECLASIFICADOR_UMBRAL_IA", "0.02"))
+
+# Por encima de esta puntuación de daño la foto se clasifica como "PS" sin llamar a LLaVA
+PRECLASIFICADOR_UMBRAL_PS = float(os.getenv("PRECLASIFICADOR_UMBRAL_PS", "0.35"))
+
+# Para clasificar como "PS", puntuación mínima sin contar `perdida_bordes`: el marco por sí solo
+# no basta, tienen que coincidir las manchas o la pérdida de emulsión del resto de la foto
+PRECLASIFICADOR_MIN_SIN_BORDES = float(os.getenv("PRECLASIFICADOR_MIN_SIN_BORDES", "0.05"))
+
+# Fracción máxima de cada lado que puede recortarse como margen liso de la copia
+PRECLASIFICADOR_MARGEN_MAX = float(os.getenv("PRECLASIFICADOR_MARGEN_MAX", "0.15"))
+
+# Peso de cada rasgo en la puntuación de daño
+PESOS_RASGOS = {
+    "manchas": 1.0,
+    "perdida_bordes": 0.6,
+    "area_perdida": 1.5,
+}
+
+
+def cargar_reducida(imagen, lado=None):
+    """
+    Decodifica una imagen (ruta o archivo) y la reduce para que su lado mayor sea `lado`.
+
+    Returns:
+        numpy.ndarray: Matriz RGB float32 con valores entre 0 y 1.
+    """
+    import numpy as np
+    from PIL import Image
+
+    lado = lado or PRECLASIFICADOR_LADO
+    with Image.open(imagen) as img:
+        # En JPEG, draft decodifica directamente a menor resolución
+        img.draft("RGB", (lado, lado))
+        img = img.convert("RGB")
+        img.thumbnail((lado, lado))
+        return np.asarray(img, dtype=np.float32) / 255.0
+
+
+def recortar_margen_liso(rgb, desviacion_max=0.03, fraccion_max=None):
+    """
+    Quita el margen liso (blanco o de un color uniforme) de una copia con borde: las filas y
+    columnas exteriores cuyo brillo apenas varía. La pérdida de emulsión real es irregular y no
+    ocupa filas enteras, así que se conserva.
+
+    Args:
+        rgb: Matriz (alto, ancho, 3) con valores entre 0 y 1.
+        desviacion_max: Desviación típica máxima del brillo de una fila o columna lisa.
+        fraccion_max: Fracción máxima de cada lado que se recorta (por defecto PRECLASIFICADOR_MARGEN_MAX).
+
+    Returns:
+        numpy.ndarray: La imagen sin el margen.
+    """
+    import numpy as np
+
+    fraccion_max = PRECLASIFICADOR_MARGEN_MAX if fraccion_max is None else fraccion_max
+    brillo = rgb.mean(axis=2)
+    alto, ancho = brillo.shape
+
+    def lisas_al_principio(lisas, maximo):
+        # Número de filas (o columnas) lisas seguidas desde el principio, como mucho `maximo`
+        cantidad = len(lisas) if lisas.all() else int(np.argmin(lisas))
+        return min(cantidad, maximo)
+
+    filas_lisas = brillo.std(axis=1) < desviacion_max
+    columnas_lisas = brillo.std(axis=0) < desviacion_max
+    max_y, max_x = int(alto * fraccion_max), int(ancho * fraccion_max)
+    arriba = lisas_al_principio(filas_lisas, max_y)
+    abajo = lisas_al_principio(filas_lisas[::-1], max_y)
+    izquierda = lisas_al_principio(columnas_lisas, max_x)
+    derecha = lisas_al_principio(columnas_lisas[::-1], max_x)
+    return rgb[arriba:alto - abajo, izquierda:ancho - derecha]
+
+
+def calcular_rasgos(rgb):
+    """
+    Calcula rasgos de daño sobre una imagen RGB reducida, con operaciones vectorizadas de NumPy.
+    Antes se quita el margen liso de las copias con borde (`recortar_margen_liso`), que si no
+    contaría como pérdida de emulsión.
+
+    Args:
+        rgb: Matriz (alto, ancho, 3) con valores entre 0 y 1.
+
+    Returns:
+        dict: Fracciones entre 0 y 1:
+            - manchas: píxeles con tono de barro (marrón/ocre: R > G > B, saturados, de brillo medio).
+            - perdida_bordes: píxeles del marco exterior donde falta la emulsión (casi blancos o
+              sin textura).
+            - area_perdida: píxeles del interior (sin el marco) donde falta la emulsión (casi blancos
+              y sin color). Al no solaparse con `perdida_bordes`, sirve para confirmarla.
+    """
+    import numpy as np
+
+    rgb = recortar_margen_liso(rgb)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maximo = rgb.max(axis=2)
+    minimo = rgb.min(axis=2)
+    saturacion = np.where(maximo > 0, (maximo - minimo) / np.maximum(maximo, 1e-6), 0.0)
+    brillo = rgb.mean(axis=2)
+
+    # Barro y manchas: tonos marrones/ocres
+    manchas = (r > g) & (g > b) & ((r - b) > 0.12) & (saturacion > 0.25) & (brillo > 0.15) & (brillo < 0.8)
+
+    # Pérdida de emulsión: papel casi blanco y sin color
+    perdida = (brillo > 0.9) & (saturacion < 0.1)
+
+    # Marco exterior (5 % de cada lado): pérdida de emulsión o zonas sin textura
+    alto, ancho = brillo.shape
+    margen_y, margen_x = max(1, alto // 20), max(1, ancho // 20)
+    marco = np.ones_like(brillo, dtype=bool)
+    marco[margen_y:-margen_y, margen_x:-margen_x] = False
+    gradiente_y, gradiente_x = np.gradient(brillo)
+    sin_textura = np.hypot(gradiente_x, gradiente_y) < 0.005
+    perdida_bordes = (perdida | sin_textura) & marco
+
+    return {
+        "manchas": float(manchas.mean()),
+        "perdida_bordes": float(perdida_bordes.sum() / max(1, marco.sum())),
+        "area_perdida": float((perdida & ~marco).sum() / max(1, (~marco).sum())),
+    }
+
+
+def puntuacion_dano(rasgos):
+    """
+    Combina los rasgos de daño en una única puntuación (suma ponderada con PESOS_RASGOS).
+    """
+    return sum(PESOS_RASGOS[nombre] * valor for nombre, valor in rasgos.items())
+
+
+def decidir(rasgos, umbral_ia=None, umbral_ps=None):
+    """
+    Decide la clasificación a partir de los rasgos. "PS" exige además que las manchas y la pérdida
+    de emulsión sumen al menos PRECLASIFICADOR_MIN_SIN_BORDES: el marco solo no basta.
+
+    Returns:
+        tuple: (clasificación o None si es dudosa y debe decidir LLaVA, puntuación).
+    """
+    umbral_ia = PRECLASIFICADOR_UMBRAL_IA if umbral_ia is None else umbral_ia
+    umbral_ps = PRECLASIFICADOR_UMBRAL_PS if umbral_ps is None else umbral_ps
+
+    puntuacion = puntuacion_dano(rasgos)
+    if puntuacion <= umbral_ia:
+        return "IA", puntuacion
+    sin_bordes = puntuacion - PESOS_RASGOS["perdida_bordes"] * rasgos["perdida_bordes"]
+    if puntuacion >= umbral_ps and sin_bordes >= PRECLASIFICADOR_MIN_SIN_BORDES:
+        return "PS", puntuacion
+    return None, puntuacion
+
+
+def preclasificar(imagen, umbral_ia=None, umbral_ps=None):
+    """
+    Clasifica localmente una imagen si el caso es claro.
+
+    Args:
+        imagen: Ruta o archivo con la imagen.
+        umbral_ia: Puntuación máxima para devolver "IA" (por defecto PRECLASIFICADOR_UMBRAL_IA).
+        umbral_ps: Puntuación mínima para devolver "PS" (por defecto PRECLASIFICADOR_UMBRAL_PS).
+
+    Returns:
+        tuple: (clasificación o None si es dudosa y debe decidir LLaVA, puntuación, rasgos).
+    """
+    rasgos = calcular_rasgos(cargar_reducida(imagen))
+    clasificacion, puntuacion = decidir(rasgos, umbral_ia, umbral_ps)
+    return clasificacion, puntuacion, rasgos
+
+
+def prerreducir_imagen(imagen, lado_max):
+    """
+    Decodifica una imagen (ruta o archivo, que se lee por trozos sin copiarlo entero en memoria)
+    y la reduce por un factor entero hasta que su lado mayor quede por debajo de 2 * `lado_max`.
+    En JPEG, `draft` decodifica directamente a menor resolución; `reduce` promedia bloques de píxeles.
+
+    Returns:
+        tuple: (modo, tamaño, píxeles) de la imagen prerreducida, para `reducir_imagen`.
+    """
+    from PIL import Image
+
+    with Image.open(imagen) as img:
+        img.draft("RGB", (lado_max, lado_max))
+        img = img.convert("RGB")
+        factor = max(img.size) // lado_max
+        if factor > 1:
+            img = img.reduce(factor)
+        return img.mode, img.size, img.tobytes()
+
+
+def reducir_imagen(prerreducida, lado_max, formato="JPEG", calidad=90):
+    """
+    Termina de reducir una imagen de `prerreducir_imagen` para que su lado mayor sea como mucho
+    `lado_max` y la codifica. Se ejecuta en un proceso aparte, por eso recibe píxeles y devuelve bytes.
+
+    Args:
+        prerreducida: Tupla (modo, tamaño, píxeles) de `prerreducir_imagen`.
+        lado_max: Lado mayor máximo de la imagen resultante.
+        formato: Formato de salida de Pillow ("JPEG" o "WEBP").
+        calidad: Calidad de compresión (1-100).
+
+    Returns:
+        bytes: Imagen reducida y codificada.
+    """
+    from PIL import Image
+
+    modo, tamano, pixeles = prerreducida
+    img = Image.frombytes(modo, tamano, pixeles)
+    img.thumbnail((lado_max, lado_max))
+    salida = BytesIO()
+    img.save(salida, format=formato, quality=calidad)
+    return salida.getvalue()
@@ -0,0 +1,80 @@
+"""
+Configuración de las pruebas: la API se importa una sola vez con Drive, MongoDB (mongomock)
+y Replicate falsos (los mismos de benchmark_offline.py), y cada prueba recibe una base de datos vacía.
+"""
+import io
+import types
+import uuid
+
+import gridfs
+import mongomock
+import pytest
+
+import benchmark_offline
+
+
+class BucketGridFSFalso:
+    """
+    GridFSBucket en memoria: mongomock no es compatible con el GridFS de pymongo 4.
+    """
+
+    def __init__(self, almacen):
+        self.almacen = almacen
+
+    def upload_from_stream(self, nombre, lector):
+        gridfs_id = uuid.uuid4().hex
+        self.almacen[gridfs_id] = lector.read()
+        return gridfs_id
+
+    def open_download_stream(self, gridfs_id):
+        return io.BytesIO(self.almacen[gridfs_id])
+
+    def delete(self, gridfs_id):
+        if self.almacen.pop(gridfs_id, None) is None:
+            raise gridfs.errors.NoFile(gridfs_id)
+
+
+@pytest.fixture(scope="session")
+def entorno():
+    argumentos = types.SimpleNamespace(
+        replicate_latencia_arranque_ms=1,
+        replicate_latencia_token_ms=1,
+        drive_latencia_ms=1,
+        drive_cuota_por_segundo=0,
+        drive_prob_cuota=0.0,
+        drive_mbps=1000,
+        mongo_uri=None,
+    )
+    app, drive, _ = benchmark_offline.preparar_entorno(argumentos)
+    return app, drive
+
+
+@pytest.fixture
+def api(entorno, monkeypatch):
+    """
+    Módulo `app` con una base de datos vacía, el Drive falso vacío y las cachés de carpetas limpias.
+    """
+    app, drive = entorno
+    db = mongomock.MongoClient()["ProyectoUPV"]
+    app.crear_indices(db)
+    monkeypatch.setattr(app, "db", db)
+    monkeypatch.setattr(app, "cache_carpetas", app.CacheCarpetas())
+    monkeypatch.setattr(app, "carpetas_indexadas", set())
+    monkeypatch.setattr(app, "carpetas_compartidas", set())
+    drive.archivos.clear()
+    return app
+
+
+@pytest.fixture
+def drive(entorno):
+    return entorno[1]
+
+
+@pytest.fixture
+def archivos_gridfs(api, monkeypatch):
+    """
+    Contenido de GridFS (id -> bytes) de los trabajos de subida.
+    """
+    almacen = {}
+    monkeypatch.setattr(api.gridfs, "GridFSBucket", lambda db, bucket_name="fs": BucketGridFSFalso(almacen))
+    return almacen
@@ -0,0 +1,92 @@
+import time
+
+
+class AlmacenFalso:
+    """
+    Almacén compartido con la interfaz de Redis que usa la caché (get, set con `ex`, delete).
+    """
+
+    def __init__(self, fallar=False):
+        self.valores = {}
+        self.fallar = fallar
+
+    def get(self, clave):
+        if self.fallar:
+            raise ConnectionError("Redis no disponible")
+        return self.valores.get(clave)
+
+    def set(self, clave, valor, ex=None):
+        if self.fallar:
+            raise ConnectionError("Redis no disponible")
+        self.valores[clave] = valor
+
+    def delete(self, clave):
+        if self.fallar:
+            raise ConnectionError("Redis no disponible")
+        self.valores.pop(clave, None)
+
+
+def test_descarta_la_entrada_menos_usada(api):
+    cache = api.CacheCarpetas(max_entradas=2)
+    cache.guardar("A", "id_a")
+    cache.guardar("B", "id_b")
+    cache.obtener("A")
+    cache.guardar("C", "id_c")
+
+    assert cache.obtener("B") == (False, None)
+    assert cache.obtener("A") == (True, "id_a")
+    assert cache.obtener("C") == (True, "id_c")
+
+
+def test_caducidad_de_aciertos_y_de_negativos(api):
+    cache = api.CacheCarpetas(ttl=0.2, ttl_negativo=0.05)
+    cache.guardar("A", "id_a")
+    cache.guardar("B", None)
+    assert cache.obtener("B") == (True, None)
+
+    time.sleep(0.1)
+    assert cache.obtener("A") == (True, "id_a")
+    assert cache.obtener("B") == (False, None)
+    time.sleep(0.15)
+    assert cache.obtener("A") == (False, None)
+
+    estadisticas = cache.estadisticas()
+    assert (estadisticas["aciertos"], estadisticas["aciertos_negativos"], estadisticas["fallos"]) == (1, 1, 2)
+
+
+def test_almacen_compartido_entre_instancias(api):
+    almacen = AlmacenFalso()
+    una, otra = api.CacheCarpetas(compartido=almacen), api.CacheCarpetas(compartido=almacen)
+    una.guardar("A", "id_a")
+    una.guardar("B", None)
+
+    assert otra.obtener("A") == (True, "id_a")
+    assert otra.obtener("B") == (True, None)
+    assert otra.estadisticas()["aciertos_compartido"] == 2
+
+    una.invalidar("A")
+    otra.invalidar("A")
+    assert otra.obtener("A") == (False, None)
+
+
+def test_almacen_compartido_caido_no_rompe_la_cache(api):
+    cache = api.CacheCarpetas(compartido=AlmacenFalso(fallar=True))
+    cache.guardar("A", "id_a")
+
+    assert cache.obtener("A") == (True, "id_a")
+    assert cache.obtener("B") == (False, None)
+    cache.invalidar("A")
+
+
+def test_busqueda_de_carpeta_usa_la_cache(api):
+    api.db.subcarpetas.insert_one({"nRegistro": "L0001-F", "id_subcarpeta": "carpeta_1"})
+
+    assert api.obtener_id_subcarpeta(api.db, "L0001-F") == "carpeta_1"
+    assert api.obtener_id_subcarpeta(api.db, "L0001-A") is None
+    # Los resultados, también los negativos, salen de la caché sin consultar MongoDB
+    api.db.subcarpetas.delete_many({})
+    api.db.subcarpetas.insert_one({"nRegistro": "L0001-A", "id_subcarpeta": "carpeta_2"})
+
+    assert api.obtener_id_subcarpeta(api.db, "L0001-F") == "carpeta_1"
+    assert api.obtener_id_subcarpeta(api.db, "L0001-A") is None
+    assert api.cache_carpetas.estadisticas()["fallos"] == 2
@@ -0,0 +1,147 @@
+import io
+import sys
+import threading
+import time
+import types
+
+import httpx
+import pytest
+from replicate.stream import ServerSentEvent
+
+
+def evento(tipo, datos=""):
+    return ServerSentEvent(event=ServerSentEvent.EventType(tipo), data=datos, id="1", retry=None)
+
+
+class PrediccionGuionada:
+    """
+    Predicción que emite los eventos indicados y, si `bloquear`, se queda esperando hasta que se cancela.
+    """
+
+    def __init__(self, eventos, bloquear=False):
+        self.eventos = eventos
+        self.bloquear = bloquear
+        self.cancelada = threading.Event()
+
+    def cancel(self):
+        self.cancelada.set()
+
+    def stream(self):
+        yield from self.eventos
+        if self.bloquear:
+            self.cancelada.wait(5)
+            yield evento("error", "canceled")
+
+
+@pytest.fixture
+def predicciones(api, monkeypatch):
+    """
+    Sustituye `replicate.predictions.create` por una que devuelve las predicciones de la lista, en orden.
+    """
+    pendientes = []
+    replicate = sys.modules["replicate"]
+    monkeypatch.setattr(replicate, "predictions", types.SimpleNamespace(create=lambda **_: pendientes.pop(0)))
+    return pendientes
+
+
+def test_clasifica_con_la_salida_en_streaming(api, predicciones):
+    predicciones.append(PrediccionGuionada([evento("output", " "), evento("output", "0"), evento("done", "{}")]))
+
+    assert api.classification_llava(b"imagen") == "IA"
+
+
+def test_decide_con_el_primer_token_y_cancela(api, predicciones):
+    # Si no decidiera con el primer token útil, se quedaría esperando al resto de la salida
+    prediccion = PrediccionGuionada([evento("logs", "cargando"), evento("output", "1")], bloquear=True)
+    predicciones.append(prediccion)
+
+    assert api.classification_llava(b"imagen", plazo=10) == "PS"
+    assert prediccion.cancelada.is_set()
+
+
+def test_evento_de_error(api, predicciones):
+    predicciones.append(PrediccionGuionada([evento("error", "modelo caído")]))
+
+    with pytest.raises(ValueError, match="modelo caído"):
+        api.classification_llava(b"imagen")
+
+
+def test_plazo_agotado_durante_el_stream(api, predicciones):
+    prediccion = PrediccionGuionada([evento("output", " ")], bloquear=True)
+    predicciones.append(prediccion)
+
+    with pytest.raises(api.PlazoClasificacionAgotado):
+        api.classification_llava(b"imagen", plazo=0.2)
+    assert prediccion.cancelada.is_set()
+
+
+def test_plazo_agotado_al_crear_la_prediccion(api, monkeypatch):
+    # La creación incluye subir la imagen; el plazo tiene que contarla también
+    prediccion = PrediccionGuionada([evento("output", "0")])
+
+    def crear_lento(**_):
+        time.sleep(0.5)
+        return prediccion
+
+    monkeypatch.setattr(sys.modules["replicate"], "predictions", types.SimpleNamespace(create=crear_lento))
+
+    inicio = time.monotonic()
+    with pytest.raises(api.PlazoClasificacionAgotado):
+        api.classification_llava(b"imagen", plazo=0.2)
+    assert time.monotonic() - inicio < 0.5 + 0.2
+    assert prediccion.cancelada.is_set()
+
+
+def test_la_subida_colgada_agota_el_plazo(api, monkeypatch):
+    # Sin timeout en el cliente, una subida colgada bloquearía el hilo sin límite
+    cliente = api.obtener_cliente_replicate()
+    assert cliente.timeout.read == api.CLASIFICACION_PLAZO_SEGUNDOS
+    assert cliente.timeout.write == api.CLASIFICACION_PLAZO_SEGUNDOS
+
+    def crear_colgado(**_):
+        raise httpx.WriteTimeout("timed out")
+
+    monkeypatch.setattr(sys.modules["replicate"], "predictions", types.SimpleNamespace(create=crear_colgado))
+
+    with pytest.raises(api.PlazoClasificacionAgotado):
+        api.classification_llava(b"imagen")
+
+
+def imagen_jpeg(ancho, alto):
+    from PIL import Image
+
+    salida = io.BytesIO()
+    Image.radial_gradient("L").resize((ancho, alto)).convert("RGB").save(salida, format="JPEG")
+    return salida.getvalue()
+
+
+def lector(api, contenido, nombre="foto.jpg"):
+    return api.LectorCompartido(io.BytesIO(contenido), threading.Lock(), nombre)
+
+
+@pytest.mark.parametrize("procesos", [0, 1])
+def test_reduce_la_imagen_antes_de_enviarla(api, monkeypatch, procesos):
+    from PIL import Image
+
+    monkeypatch.setattr(api, "IMAGEN_PROCESOS", procesos)
+    monkeypatch.setattr(api, "pool_imagenes", None)
+    original = imagen_jpeg(4000, 3000)
+
+    try:
+        enviada = api.preparar_imagen_modelo("foto.jpg", lector(api, original))
+    finally:
+        if api.pool_imagenes is not None:
+            api.pool_imagenes.shutdown()
+
+    with Image.open(enviada) as reducida:
+        assert reducida.format == api.IMAGEN_FORMATO
+        assert max(reducida.size) == api.IMAGEN_LADO_MAX
+        assert reducida.size[0] * 3 == reducida.size[1] * 4
+
+
+def test_imagen_no_valida_se_envia_sin_reducir(api, monkeypatch):
+    monkeypatch.setattr(api, "IMAGEN_PROCESOS", 0)
+    original = lector(api, b"no es una imagen")
+
+    assert api.preparar_imagen_modelo("foto.jpg", original) is original
+    assert original.tell() == 0
@@ -0,0 +1,182 @@
+import itertools
+import json
+import threading
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import benchmark_offline
+
+
+def error_servidor():
+    return HttpError(httplib2.Response({"status": 503}), b'{"error": {"code": 503}}')
+
+
+class PeticionQueFalla:
+    """
+    Petición de Drive que falla con los errores indicados antes de responder.
+    """
+
+    def __init__(self, metodo, errores, cuerpo=None):
+        self.methodId = metodo
+        self.body = json.dumps(cuerpo) if cuerpo is not None else None
+        self.resumable = None
+        self.errores = list(errores)
+        self.ejecuciones = 0
+
+    def execute(self, http=None):
+        self.ejecuciones += 1
+        if self.errores:
+            raise self.errores.pop(0)
+        return {"id": "creado"}
+
+
+@pytest.fixture
+def http_creados(api, monkeypatch):
+    """
+    Objetos HTTP que crea el pool, numerados en orden de creación.
+    """
+    creados = []
+    numeros = itertools.count()
+
+    def crear_http():
+        creados.append(next(numeros))
+        return creados[-1]
+
+    monkeypatch.setattr(api, "crear_http_drive", crear_http)
+    return creados
+
+
+@pytest.fixture
+def sin_esperas(api, monkeypatch):
+    monkeypatch.setattr(api, "espera_reintento_drive", lambda intento: 0)
+    monkeypatch.setattr(api, "limitador_drive", api.LimitadorDrive(0, 100, 1, 200, 0.05))
+
+
+def test_pool_reutiliza_los_objetos_devueltos(api, http_creados):
+    pool = api.PoolDrive(4, 1)
+
+    for _ in range(10):
+        with pool.prestar() as http:
+            assert http == 0
+
+    assert http_creados == [0]
+    assert pool.estadisticas()["prestamos"] == 10
+    assert pool.estadisticas()["en_uso"] == 0
+
+
+def test_pool_crea_hasta_su_tamano_y_luego_espera(api, http_creados):
+    pool = api.PoolDrive(2, 5)
+    primero, segundo = pool.tomar(), pool.tomar()
+    assert pool.intentar_tomar() is None
+
+    tomado = []
+    hilo = threading.Thread(target=lambda: tomado.append(pool.tomar()))
+    hilo.start()
+    time.sleep(0.05)
+    assert not tomado, "con todos prestados hay que esperar a que se devuelva uno"
+    pool.devolver(segundo)
+    hilo.join(1)
+
+    assert tomado == [segundo]
+    assert http_creados == [primero, segundo]
+    estadisticas = pool.estadisticas()
+    assert (estadisticas["creados"], estadisticas["en_uso"], estadisticas["esperas"]) == (2, 2, 1)
+
+
+def test_pool_agotado(api, http_creados):
+    pool = api.PoolDrive(1, 0.05)
+    pool.tomar()
+
+    with pytest.raises(TimeoutError):
+        pool.tomar()
+    assert pool.estadisticas()["agotados"] == 1
+
+
+def test_pool_no_cuenta_los_objetos_que_fallan_al_crearse(api, monkeypatch):
+    def fallar():
+        raise OSError("sin red")
+
+    monkeypatch.setattr(api, "crear_http_drive", fallar)
+    pool = api.PoolDrive(1, 0.05)
+
+    with pytest.raises(OSError):
+        pool.tomar()
+    assert pool.estadisticas()["creados"] == 0
+
+
+def test_limitador_sin_limite_hasta_el_primer_error_de_cuota(api):
+    limitador = api.LimitadorDrive(0, 10, 1, 200, 0.05)
+    for _ in range(40):
+        limitador.adquirir()
+    assert limitador.tasa is None
+
+    limitador.registrar_limite()
+
+    # La tasa pasa a la mitad de la medida en el último segundo
+    assert limitador.tasa == 20
+    limitador.registrar_limite()
+    assert limitador.tasa == 20, "como mucho una reducción por segundo"
+
+
+def test_limitador_respeta_la_tasa(api):
+    limitador = api.LimitadorDrive(50, 1, 1, 200, 0)
+
+    inicio = time.monotonic()
+    for _ in range(6):
+        limitador.adquirir()
+
+    # Una llamada sale con la ráfaga y las otras cinco esperan 1/50 s cada una
+    assert time.monotonic() - inicio >= 5 / 50 * 0.9
+
+
+def test_limitador_recupera_la_tasa_con_exitos(api):
+    limitador = api.LimitadorDrive(10, 1, 1, 12, 0.5)
+
+    limitador.registrar_exito(3)
+    assert limitador.tasa == 11.5
+    limitador.registrar_exito(3)
+    assert limitador.tasa == 12
+
+
+def test_reintenta_errores_de_cuota(api, sin_esperas):
+    peticion = PeticionQueFalla("drive.files.create", [benchmark_offline.error_cuota(429)], {"name": "carpeta"})
+
+    assert api.ejecutar_drive(peticion) == {"id": "creado"}
+    assert peticion.ejecuciones == 2
+
+
+def test_no_reintenta_crear_sin_id_tras_un_5xx(api, sin_esperas):
+    # Drive puede haber creado la carpeta aunque responda 503: repetir la petición la duplicaría
+    peticion = PeticionQueFalla("drive.files.create", [error_servidor()], {"name": "carpeta"})
+
+    with pytest.raises(HttpError):
+        api.ejecutar_drive(peticion)
+    assert peticion.ejecuciones == 1
+
+
+def test_reintenta_crear_con_id_preasignado_tras_un_5xx(api, sin_esperas):
+    peticion = PeticionQueFalla("drive.files.create", [error_servidor()], {"name": "carpeta", "id": "reservado"})
+
+    assert api.ejecutar_drive(peticion) == {"id": "creado"}
+    assert peticion.ejecuciones == 2
+
+
+def test_lote_no_reintenta_crear_sin_id_tras_un_5xx(api, drive, sin_esperas):
+    peticiones = [
+        PeticionQueFalla("drive.files.create", [error_servidor()], {"name": "sin_id"}),
+        PeticionQueFalla("drive.files.create", [error_servidor()], {"name": "con_id", "id": "reservado"}),
+        PeticionQueFalla("drive.files.update", [error_servidor()]),
+    ]
+    # El lote falso ejecuta cada petición con `funcion`
+    for peticion in peticiones:
+        peticion.funcion = peticion.execute
+
+    resultados = api.ejecutar_lote_drive(drive, peticiones)
+
+    assert isinstance(resultados[0][1], HttpError)
+    assert resultados[1] == ({"id": "creado"}, None)
+    assert resultados[2] == ({"id": "creado"}, None)
+    assert [peticion.ejecuciones for peticion in peticiones] == [1, 2, 2]
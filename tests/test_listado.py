@@ -0,0 +1,107 @@
+import types
+
+import pytest
+
+
+CARPETA = "carpeta_listado"
+NREGISTRO = "LOTE0001-001-F"
+
+
+def insertar_archivos(api, nombres):
+    for indice, nombre in enumerate(nombres):
+        api.db.archivos.insert_one({
+            "_id": f"archivo{indice:02}",
+            "carpeta_id": CARPETA,
+            "nombre": nombre,
+            "eliminado": False,
+        })
+
+
+def recorrer_paginas(api, page_size):
+    ids, cursor = [], None
+    while True:
+        pagina, cursor = api.listar_archivos_desde_indice(api.db, CARPETA, page_size, cursor)
+        ids += [archivo["id"] for archivo in pagina]
+        if cursor is None:
+            return ids
+
+
+def test_paginacion_con_nombres_repetidos(api):
+    # Cuatro archivos con el mismo nombre caen a ambos lados de varios cortes de página
+    insertar_archivos(api, ["a", "foto", "foto", "foto", "foto", "z"])
+
+    ids = recorrer_paginas(api, page_size=2)
+
+    assert ids == [f"archivo{indice:02}" for indice in range(6)]
+
+
+def test_paginacion_ignora_eliminados(api):
+    insertar_archivos(api, ["a", "b", "c"])
+    api.db.archivos.update_one({"_id": "archivo01"}, {"$set": {"eliminado": True}})
+
+    assert recorrer_paginas(api, page_size=1) == ["archivo00", "archivo02"]
+
+
+def test_cursor_no_valido(api):
+    with pytest.raises(api.CursorNoValido):
+        api.listar_archivos_desde_indice(api.db, CARPETA, 10, "no-es-un-cursor")
+
+
+def test_endpoint_carpeta_indexada_no_usa_drive(api, monkeypatch):
+    api.db.subcarpetainternas.insert_one({
+        "nRegistro": NREGISTRO, "subcarpetas_internas_id": CARPETA, "compartida": True, "indexada": True
+    })
+    insertar_archivos(api, ["foto", "foto", "foto"])
+
+    def sin_drive():
+        raise AssertionError("No debe usarse Drive para una carpeta compartida e indexada")
+
+    monkeypatch.setattr(api, "obtener_servicio_drive", sin_drive)
+    cliente = api.app.test_client()
+
+    respuesta = cliente.get("/listar_archivos", query_string={"nRegistro": NREGISTRO, "page_size": 2})
+    assert respuesta.status_code == 200
+    primera = respuesta.get_json()
+    respuesta = cliente.get("/listar_archivos", query_string={
+        "nRegistro": NREGISTRO, "page_size": 2, "cursor": primera["siguiente_cursor"]
+    })
+    segunda = respuesta.get_json()
+
+    assert [archivo["id"] for archivo in primera["archivos"] + segunda["archivos"]] == ["archivo00", "archivo01", "archivo02"]
+    assert segunda["siguiente_cursor"] is None
+
+    respuesta = cliente.get("/listar_archivos", query_string={"nRegistro": NREGISTRO, "cursor": "roto"})
+    assert respuesta.status_code == 400
+
+
+def test_compartir_carpeta_guarda_el_estado(api, drive):
+    api.db.subcarpetainternas.insert_one({"nRegistro": NREGISTRO, "subcarpetas_internas_id": CARPETA})
+    permisos_antes = drive.estadisticas["llamadas"].get("drive.permissions.create", 0)
+
+    api.asegurar_carpeta_compartida(drive, api.db, NREGISTRO, CARPETA)
+
+    assert api.db.subcarpetainternas.find_one({"nRegistro": NREGISTRO})["compartida"] is True
+    # Otra instancia (sin la caché del proceso) no vuelve a configurar el permiso
+    api.carpetas_compartidas.clear()
+    api.asegurar_carpeta_compartida(drive, api.db, NREGISTRO, CARPETA)
+    assert drive.estadisticas["llamadas"]["drive.permissions.create"] == permisos_antes + 1
+
+
+def test_reconciliador_marca_archivos_movidos_fuera(api, drive, monkeypatch):
+    api.db.subcarpetainternas.insert_one({"nRegistro": NREGISTRO, "subcarpetas_internas_id": CARPETA})
+    insertar_archivos(api, ["a", "b"])
+    api.db.estado_sincronizacion.insert_one({"_id": "drive_changes", "page_token": "1"})
+    cambios = [
+        {"fileId": "archivo00", "file": {"id": "archivo00", "name": "a", "parents": ["otra_carpeta"]}},
+        {"fileId": "archivo01", "file": {"id": "archivo01", "name": "b2", "parents": [CARPETA]}},
+    ]
+    respuesta = {"changes": cambios, "newStartPageToken": "2"}
+    monkeypatch.setattr(drive, "changes", lambda: types.SimpleNamespace(
+        list=lambda **_: types.SimpleNamespace(methodId="drive.changes.list", execute=lambda **_: respuesta)
+    ))
+
+    assert api.sincronizar_cambios_drive(drive, api.db) == 2
+
+    assert api.db.archivos.find_one({"_id": "archivo00"})["eliminado"] is True
+    assert api.db.archivos.find_one({"_id": "archivo01"})["nombre"] == "b2"
+    assert recorrer_paginas(api, page_size=10) == ["archivo01"]
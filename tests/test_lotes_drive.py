@@ -0,0 +1,81 @@
+import copy
+
+
+def contar_llamadas(drive):
+    """
+    Copia de las estadísticas del Drive falso, para comparar antes y después de una operación.
+    """
+    return copy.deepcopy(drive.estadisticas)
+
+
+def diferencia(antes, despues, metodo):
+    return despues["llamadas"].get(metodo, 0) - antes["llamadas"].get(metodo, 0)
+
+
+def test_estructura_se_crea_nivel_a_nivel_en_lotes(api, drive):
+    estructura = api.planificar_estructura("L0001", 2, 1, 1, 1, 1)
+    internas = [interna for subcarpeta in estructura["subcarpetas"] for interna in subcarpeta.get("subcarpetas_internas", [])]
+    antes = contar_llamadas(drive)
+
+    api.crear_carpetas_de_estructura(drive, estructura)
+
+    despues = contar_llamadas(drive)
+    # Una llamada suelta para la principal, un batch para las 5 subcarpetas y otro para las internas
+    assert despues["lotes"] - antes["lotes"] == 2
+    assert diferencia(antes, despues, "drive.files.create") == 1 + 5 + len(internas)
+
+    principal = drive.archivos[estructura["carpeta_principal_id"]]
+    assert principal["parents"] == [api.CARPETA_RAIZ_ID]
+    for subcarpeta in estructura["subcarpetas"]:
+        carpeta = drive.archivos[subcarpeta["id_subcarpeta"]]
+        assert (carpeta["name"], carpeta["parents"]) == (subcarpeta["nRegistro"], [principal["id"]])
+        for interna in subcarpeta.get("subcarpetas_internas", []):
+            carpeta = drive.archivos[interna["subcarpetas_internas_id"]]
+            assert (carpeta["name"], carpeta["parents"]) == (interna["nRegistro"], [subcarpeta["id_subcarpeta"]])
+
+
+def test_lotes_respetan_drive_batch_size(api, drive, monkeypatch):
+    monkeypatch.setattr(api, "TAMANO_LOTE_DRIVE", 2)
+    carpetas = [(f"carpeta{indice}", "padre") for indice in range(5)]
+    antes = contar_llamadas(drive)
+
+    ids = api.crear_carpetas_en_lote(drive, carpetas)
+
+    assert contar_llamadas(drive)["lotes"] - antes["lotes"] == 3
+    assert [drive.archivos[carpeta_id]["name"] for carpeta_id in ids] == [nombre for nombre, _ in carpetas]
+
+
+def test_carpetas_con_ids_preasignados(api, drive):
+    ids = api.generar_ids_drive(drive, 3)
+
+    creados = api.crear_carpetas_en_lote(drive, [(f"carpeta{indice}", "padre") for indice in range(3)], ids)
+
+    assert creados == ids
+    assert all(drive.archivos[carpeta_id]["parents"] == ["padre"] for carpeta_id in ids)
+
+
+def test_renombrado_en_un_solo_lote(api, drive):
+    ids = api.crear_carpetas_en_lote(drive, [(f"L0001-S-A01-{numero:03}", "padre") for numero in range(4)])
+    archivos = [{"id": archivo_id, "nombre": f"L0001-S-A01-{numero:03}-IA"} for numero, archivo_id in enumerate(ids)]
+    antes = contar_llamadas(drive)
+
+    renombrados = api.renombrar_archivos_en_lote(drive, archivos)
+
+    despues = contar_llamadas(drive)
+    assert despues["lotes"] - antes["lotes"] == 1
+    assert diferencia(antes, despues, "drive.files.update") == 4
+    assert renombrados == archivos
+    assert [drive.archivos[archivo_id]["name"] for archivo_id in ids] == [archivo["nombre"] for archivo in archivos]
+
+
+def test_renombrado_en_lote_con_un_error(api, drive):
+    archivo_id = api.crear_carpetas_en_lote(drive, [("foto", "padre")])[0]
+
+    renombrados = api.renombrar_archivos_en_lote(drive, [
+        {"id": "no_existe", "nombre": "otro"},
+        {"id": archivo_id, "nombre": "foto-PS"},
+    ])
+
+    # El fallo de un archivo no impide renombrar los demás
+    assert renombrados == [None, {"id": archivo_id, "nombre": "foto-PS"}]
+    assert drive.archivos[archivo_id]["name"] == "foto-PS"
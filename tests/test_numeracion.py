@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+
+CARPETA = "carpeta_numeracion"
+NREGISTRO = "LOTE0001-002-F"
+
+
+def crear_en_drive(drive, nombres):
+    for nombre in nombres:
+        drive.archivos[nombre] = {"id": nombre, "name": nombre, "parents": [CARPETA]}
+
+
+def reservar(api, cantidad):
+    return api.reservar_numeros_archivos(api.db, api.obtener_servicio_drive(), NREGISTRO, CARPETA, cantidad)
+
+
+def test_primera_reserva_parte_del_mayor_numero_en_drive(api, drive):
+    crear_en_drive(drive, [f"{NREGISTRO}-004-IA", f"{NREGISTRO}-017", "otra_foto.jpg"])
+
+    assert reservar(api, 3) == 18
+    assert reservar(api, 2) == 21
+
+
+def test_primera_reserva_usa_el_indice_si_la_carpeta_esta_indexada(api, drive, monkeypatch):
+    api.db.subcarpetainternas.insert_one({"nRegistro": NREGISTRO, "subcarpetas_internas_id": CARPETA, "indexada": True})
+    api.db.archivos.insert_many([
+        {"_id": "a", "carpeta_id": CARPETA, "nombre": f"{NREGISTRO}-009-PS", "eliminado": False},
+        {"_id": "b", "carpeta_id": CARPETA, "nombre": f"{NREGISTRO}-030", "eliminado": True},
+    ])
+    monkeypatch.setattr(api, "listar_archivos_drive", lambda *args, **kwargs: pytest.fail("No debe listar Drive"))
+
+    assert reservar(api, 1) == 10
+
+
+def test_carpeta_vacia_empieza_en_uno(api):
+    assert reservar(api, 5) == 1
+    assert reservar(api, 1) == 6
+
+
+def test_secuencia_anterior_sin_base(api):
+    api.db.secuencias.insert_one({"_id": NREGISTRO, "ultimo": 5})
+
+    assert reservar(api, 2) == 6
+
+
+def test_reservas_concurrentes_no_se_solapan(api):
+    resultados = []
+    hilos = [threading.Thread(target=lambda: resultados.append(reservar(api, 3))) for _ in range(8)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+    assert sorted(resultados) == list(range(1, 25, 3))
+
+
+def test_sin_mongodb_falla(api):
+    with pytest.raises(RuntimeError):
+        api.reservar_numeros_archivos(None, None, NREGISTRO, CARPETA, 1)
@@ -0,0 +1,93 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import preclasificador
+
+
+def foto_limpia(alto=300, ancho=400, semilla=0):
+    """
+    Foto sin daños: textura suave en tonos fríos, sin blancos ni marrones.
+    """
+    base = np.random.default_rng(semilla).random((alto // 8, ancho // 8, 3))
+    imagen = Image.fromarray((base * 255).astype(np.uint8)).resize((ancho, alto), Image.BICUBIC)
+    rgb = 0.25 + 0.45 * np.asarray(imagen, dtype=np.float32) / 255
+    rgb[..., 2] += 0.1
+    return rgb
+
+
+def con_margen(rgb, fraccion, color):
+    alto, ancho = rgb.shape[:2]
+    margen_y, margen_x = int(alto * fraccion), int(ancho * fraccion)
+    copia = np.empty((alto + 2 * margen_y, ancho + 2 * margen_x, 3), dtype=np.float32)
+    copia[:] = color
+    copia[margen_y:margen_y + alto, margen_x:margen_x + ancho] = rgb
+    return copia
+
+
+def marco(rgb, fraccion):
+    alto, ancho = rgb.shape[:2]
+    mascara = np.zeros((alto, ancho), dtype=bool)
+    margen_y, margen_x = int(alto * fraccion), int(ancho * fraccion)
+    mascara[:margen_y] = mascara[-margen_y:] = True
+    mascara[:, :margen_x] = mascara[:, -margen_x:] = True
+    return mascara
+
+
+def con_perdida(rgb, mascara, probabilidad, semilla=1):
+    """
+    Pérdida de emulsión irregular (píxeles blancos sueltos) dentro de `mascara`.
+    """
+    rgb = rgb.copy()
+    rgb[mascara & (np.random.default_rng(semilla).random(mascara.shape) < probabilidad)] = 1.0
+    return rgb
+
+
+def clasificar(rgb):
+    salida = io.BytesIO()
+    Image.fromarray((np.clip(rgb, 0, 1) * 255).astype(np.uint8)).save(salida, format="JPEG", quality=90)
+    salida.seek(0)
+    return preclasificador.preclasificar(salida)
+
+
+@pytest.mark.parametrize("fraccion, color", [
+    (0.06, (1.0, 1.0, 1.0)),
+    (0.10, (0.95, 0.93, 0.88)),
+    (0.04, (0.05, 0.05, 0.05)),
+])
+def test_copia_limpia_con_margen_no_es_ps(fraccion, color):
+    clasificacion, puntuacion, rasgos = clasificar(con_margen(foto_limpia(), fraccion, color))
+
+    assert clasificacion != "PS"
+    assert rasgos["perdida_bordes"] < 0.1
+
+
+def test_el_marco_solo_no_decide_ps():
+    rgb = foto_limpia()
+    clasificacion, puntuacion, rasgos = clasificar(con_perdida(rgb, marco(rgb, 0.05), 0.9))
+
+    assert puntuacion >= preclasificador.PRECLASIFICADOR_UMBRAL_PS
+    assert clasificacion is None
+
+
+def test_marco_e_interior_danados_es_ps():
+    rgb = foto_limpia()
+    danada = con_perdida(rgb, marco(rgb, 0.05), 0.9)
+    alto, ancho = rgb.shape[:2]
+    interior = np.zeros((alto, ancho), dtype=bool)
+    interior[alto // 3:alto // 2, ancho // 3:2 * ancho // 3] = True
+
+    clasificacion, _, _ = clasificar(con_perdida(danada, interior, 0.8, semilla=2))
+
+    assert clasificacion == "PS"
+
+
+def test_decidir_exige_rasgos_fuera_del_marco():
+    solo_marco = {"manchas": 0.0, "perdida_bordes": 1.0, "area_perdida": 0.0}
+    con_manchas = {"manchas": 0.1, "perdida_bordes": 1.0, "area_perdida": 0.0}
+
+    assert preclasificador.decidir(solo_marco) == (None, pytest.approx(0.6))
+    assert preclasificador.decidir(con_manchas)[0] == "PS"
+    assert preclasificador.decidir({"manchas": 0.0, "perdida_bordes": 0.0, "area_perdida": 0.0})[0] == "IA"
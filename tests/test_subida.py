@@ -0,0 +1,75 @@
+import io
+import time
+
+import pytest
+
+
+CARPETA = "carpeta_subida"
+NREGISTRO = "LOTE0001-004-S"
+
+
+class ClasificadorFalso:
+    """
+    Clasificador que responde "IA" a las fotos con "limpia" en el contenido y "PS" al resto.
+    Antes de responder espera a que empiece alguna subida a Drive, y anota si llegó a verla.
+    """
+    version = "falso"
+    concurrencia = 2
+
+    def __init__(self, drive):
+        self.drive = drive
+        self.subida_en_curso = []
+
+    def clasificar(self, imagen, nombre_archivo=""):
+        inicio = time.monotonic()
+        while not self.drive.archivos and time.monotonic() - inicio < 0.5:
+            time.sleep(0.01)
+        self.subida_en_curso.append(bool(self.drive.archivos))
+        return "IA" if b"limpia" in imagen.read() else "PS"
+
+
+@pytest.fixture
+def clasificador(api, drive, monkeypatch):
+    clasificador = ClasificadorFalso(drive)
+    monkeypatch.setattr(api, "obtener_clasificador", lambda: clasificador)
+    api.db.subcarpetainternas.insert_one({"nRegistro": NREGISTRO, "subcarpetas_internas_id": CARPETA})
+    return clasificador
+
+
+def subir(api, contenidos):
+    archivos = [(io.BytesIO(contenido), f"foto{indice}.jpg") for indice, contenido in enumerate(contenidos)]
+    return api.app.test_client().post(
+        "/subir_archivos",
+        data={"nRegistro": NREGISTRO, "archivo": archivos},
+        content_type="multipart/form-data"
+    )
+
+
+def test_clasifica_y_sube_a_la_vez(api, drive, clasificador):
+    lotes_antes = drive.estadisticas["lotes"]
+
+    respuesta = subir(api, [b"limpia 0", b"rota 1", b"limpia 2"])
+
+    assert respuesta.status_code == 200
+    nombres = [f"{NREGISTRO}-001-IA", f"{NREGISTRO}-002-PS", f"{NREGISTRO}-003-IA"]
+    assert [archivo["nombre"] for archivo in respuesta.get_json()["archivos_subidos"]] == nombres
+    # Las clasificaciones ven las subidas en curso: las etapas se solapan
+    assert all(clasificador.subida_en_curso)
+    # Los archivos se suben como nRegistro-NNN y el sufijo se añade con un único batch de renombrado
+    assert sorted(archivo["name"] for archivo in drive.archivos.values()) == nombres
+    assert drive.estadisticas["lotes"] - lotes_antes == 1
+    indice = sorted(documento["nombre"] for documento in api.db.archivos.find({"carpeta_id": CARPETA}))
+    assert indice == nombres
+
+
+def test_sin_pipeline_clasifica_antes_de_subir(api, drive, clasificador, monkeypatch):
+    monkeypatch.setattr(api, "SUBIDA_PIPELINE", False)
+    lotes_antes = drive.estadisticas["lotes"]
+
+    respuesta = subir(api, [b"limpia 0", b"rota 1"])
+
+    assert respuesta.status_code == 200
+    assert not any(clasificador.subida_en_curso)
+    # Los archivos se suben ya con su nombre definitivo: no hace falta renombrar
+    assert sorted(archivo["name"] for archivo in drive.archivos.values()) == [f"{NREGISTRO}-001-IA", f"{NREGISTRO}-002-PS"]
+    assert drive.estadisticas["lotes"] == lotes_antes
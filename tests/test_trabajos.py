@@ -0,0 +1,123 @@
+import io
+import threading
+import time
+from datetime import datetime, timedelta
+
+from werkzeug.datastructures import FileStorage
+
+
+CARPETA = "carpeta_trabajos"
+NREGISTRO = "LOTE0001-003-F"
+
+
+def crear_trabajo(api, cantidad=2):
+    api.db.subcarpetainternas.insert_one({"nRegistro": NREGISTRO, "subcarpetas_internas_id": CARPETA})
+    archivos = [
+        FileStorage(stream=io.BytesIO(b"imagen %d" % indice), filename=f"foto{indice}.jpg", content_type="image/jpeg")
+        for indice in range(cantidad)
+    ]
+    return api.crear_trabajo_subida(api.db, NREGISTRO, archivos)
+
+
+def subida_fallida(*args, **kwargs):
+    raise RuntimeError("Drive caído")
+
+
+def test_trabajo_completado(api, drive, archivos_gridfs):
+    trabajo_id = crear_trabajo(api)
+    assert len(archivos_gridfs) == 2
+
+    trabajo = api.reclamar_trabajo(api.db)
+    assert trabajo["_id"] == trabajo_id
+    assert trabajo["estado"] == "en_proceso" and trabajo["intentos"] == 1 and trabajo["propietario"]
+    api.procesar_trabajo(api.obtener_servicio_drive(), api.db, trabajo)
+
+    trabajo = api.db.trabajos.find_one({"_id": trabajo_id})
+    assert trabajo["estado"] == "completado"
+    assert trabajo["lease_hasta"] is None
+    assert [archivo["estado"] for archivo in trabajo["archivos"]] == ["subido", "subido"]
+    assert sorted(archivo["name"] for archivo in drive.archivos.values()) == [f"{NREGISTRO}-001", f"{NREGISTRO}-002"]
+    assert archivos_gridfs == {}
+
+
+def test_error_con_intentos_pendientes_se_reintenta(api, archivos_gridfs, monkeypatch):
+    trabajo_id = crear_trabajo(api)
+    monkeypatch.setattr(api, "procesar_subida", subida_fallida)
+
+    api.procesar_trabajo(api.obtener_servicio_drive(), api.db, api.reclamar_trabajo(api.db))
+
+    trabajo = api.db.trabajos.find_one({"_id": trabajo_id})
+    assert trabajo["estado"] == "pendiente"
+    assert trabajo["lease_hasta"] is None
+    assert trabajo["ultimo_error"] == "Drive caído"
+    assert len(archivos_gridfs) == 2
+    assert api.reclamar_trabajo(api.db)["intentos"] == 2
+
+
+def test_error_al_agotar_los_intentos_borra_los_archivos(api, archivos_gridfs, monkeypatch):
+    trabajo_id = crear_trabajo(api)
+    monkeypatch.setattr(api, "TRABAJOS_MAX_INTENTOS", 1)
+    monkeypatch.setattr(api, "procesar_subida", subida_fallida)
+
+    api.procesar_trabajo(api.obtener_servicio_drive(), api.db, api.reclamar_trabajo(api.db))
+
+    trabajo = api.db.trabajos.find_one({"_id": trabajo_id})
+    assert trabajo["estado"] == "error"
+    assert trabajo["lease_hasta"] is None
+    assert archivos_gridfs == {}
+    assert api.reclamar_trabajo(api.db) is None
+
+
+def test_carpeta_inexistente_borra_los_archivos(api, archivos_gridfs):
+    trabajo_id = crear_trabajo(api)
+    api.db.subcarpetainternas.delete_many({})
+
+    api.procesar_trabajo(api.obtener_servicio_drive(), api.db, api.reclamar_trabajo(api.db))
+
+    assert api.db.trabajos.find_one({"_id": trabajo_id})["estado"] == "error"
+    assert archivos_gridfs == {}
+
+
+def test_trabajo_abandonado_sin_intentos_se_marca_como_error(api, archivos_gridfs, monkeypatch):
+    trabajo_id = crear_trabajo(api)
+    monkeypatch.setattr(api, "TRABAJOS_MAX_INTENTOS", 1)
+    api.reclamar_trabajo(api.db)
+    # El hilo que lo tenía murió sin actualizarlo: su lease caduca
+    api.db.trabajos.update_one(
+        {"_id": trabajo_id},
+        {"$set": {"lease_hasta": datetime.now(api.spain_timezone) - timedelta(seconds=1)}}
+    )
+
+    assert api.reclamar_trabajo(api.db) is None
+    trabajo = api.db.trabajos.find_one({"_id": trabajo_id})
+    assert trabajo["estado"] == "error"
+    assert archivos_gridfs == {}
+
+
+def test_lease_se_renueva_mientras_se_procesa(api, archivos_gridfs, monkeypatch):
+    crear_trabajo(api)
+    monkeypatch.setattr(api, "TRABAJOS_LEASE_SEGUNDOS", 0.3)
+    trabajo = api.reclamar_trabajo(api.db)
+    lease_inicial = api.db.trabajos.find_one({"_id": trabajo["_id"]})["lease_hasta"]
+
+    terminado = threading.Event()
+    hilo = threading.Thread(target=api.mantener_lease, args=(api.db, trabajo, terminado))
+    hilo.start()
+    time.sleep(0.5)
+    terminado.set()
+    hilo.join()
+
+    assert api.db.trabajos.find_one({"_id": trabajo["_id"]})["lease_hasta"] > lease_inicial
+
+
+def test_lease_no_se_renueva_si_otro_hilo_reclamo_el_trabajo(api, archivos_gridfs, monkeypatch):
+    crear_trabajo(api)
+    monkeypatch.setattr(api, "TRABAJOS_LEASE_SEGUNDOS", 0.3)
+    trabajo = api.reclamar_trabajo(api.db)
+    api.db.trabajos.update_one({"_id": trabajo["_id"]}, {"$set": {"propietario": "otro"}})
+
+    hilo = threading.Thread(target=api.mantener_lease, args=(api.db, trabajo, threading.Event()))
+    hilo.start()
+    hilo.join(timeout=2)
+
+    assert not hilo.is_alive()